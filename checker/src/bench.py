@@ -0,0 +1,289 @@
+"""
+Offline throughput benchmark for the checker.
+
+Runs every registered putflag/getflag/putnoise/getnoise/havoc/exploit
+variant in realistic chains (getflag and exploit after their putflag,
+getnoise after its putnoise) against the fake service from fake_service.py,
+or against a real service with --address, and reports tasks/s, latency
+percentiles and checker CPU time per task.
+
+    python bench.py --tasks 2000 --concurrency 100 --teams 4 --latency 0.01
+"""
+import argparse
+import asyncio
+import hashlib
+import inspect
+import logging
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+
+from logging import LoggerAdapter
+from typing import Any, Callable, Dict, List
+
+from enochecker3 import (
+    ChainDB,
+    CheckerTaskMessage,
+    ExploitCheckerTaskMessage,
+    FlagSearcher,
+    GetflagCheckerTaskMessage,
+    GetnoiseCheckerTaskMessage,
+    HavocCheckerTaskMessage,
+    InternalErrorException,
+    MumbleException,
+    OfflineException,
+    PutflagCheckerTaskMessage,
+    PutnoiseCheckerTaskMessage,
+)
+from enochecker_core import CheckerMethod
+
+import checker
+import metrics
+import startup
+from fake_service import parse_fault_args
+
+FLAG_REGEX = r"ENO[A-Za-z0-9+\/=]{48}"
+
+class MemoryChainDB(ChainDB):
+    """ ChainDB on top of a plain dict shared by all tasks of a run. """
+
+    def __init__(self, store: Dict[Any, Any], task_chain_id: str) -> None:
+        self.store = store
+        self.task_chain_id = task_chain_id
+
+    async def get(self, key: str) -> Any:
+        try:
+            return self.store[(self.task_chain_id, key)]
+        except KeyError:
+            raise KeyError(f"Key {key} not found")
+
+    async def set(self, key: str, val: Any) -> None:
+        self.store[(self.task_chain_id, key)] = val
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def gen_flag() -> str:
+    return "ENO" + "".join(random.choices(string.ascii_letters + string.digits + "+/", k=48))
+
+class Bench():
+    def __init__(self, args) -> None:
+        self.args = args
+        self.store: Dict[Any, Any] = {}
+        self.logger = LoggerAdapter(logging.getLogger("bench"), {})
+        self.task_ids = iter(range(1, 1 << 62))
+        self.latencies: Dict[str, List[float]] = {}
+        self.results: Dict[str, Dict[str, int]] = {}
+        self.addresses = args.addresses
+
+    def handler(self, method: CheckerMethod, variant: int) -> Callable:
+        return checker.checker._method_variants[method][variant]
+
+    def variants(self, method: CheckerMethod) -> List[int]:
+        return sorted(checker.checker._method_variants[method])
+
+    def message(self, cls, address: str, chain_id: str, variant: int, **kwargs) -> CheckerTaskMessage:
+        return cls(
+            task_id=next(self.task_ids),
+            address=address,
+            team_id=1,
+            team_name="bench",
+            current_round_id=1,
+            related_round_id=1,
+            variant_id=variant,
+            timeout=self.args.timeout,
+            round_length=60,
+            task_chain_id=chain_id,
+            **kwargs,
+        )
+
+    def inject(self, f: Callable, task: CheckerTaskMessage) -> List[Any]:
+        args = []
+        for parameter in inspect.signature(f).parameters.values():
+            annotation = parameter.annotation
+            if isinstance(annotation, type) and isinstance(task, annotation):
+                args.append(task)
+            elif annotation is ChainDB:
+                args.append(MemoryChainDB(self.store, task.task_chain_id))
+            elif annotation is LoggerAdapter:
+                args.append(self.logger)
+            elif annotation is FlagSearcher:
+                args.append(FlagSearcher(task.flag_regex, task.flag_hash))
+            else:
+                # e.g. the raw AsyncSocket, which no handler uses
+                args.append(None)
+        return args
+
+    async def run_task(self, label: str, method: CheckerMethod, task: CheckerTaskMessage) -> Any:
+        f = self.handler(method, task.variant_id)
+        start = time.perf_counter()
+        outcome, result = "OK", None
+        try:
+            result = await asyncio.wait_for(f(*self.inject(f, task)), task.timeout / 1000)
+        except MumbleException:
+            outcome = "MUMBLE"
+        except OfflineException:
+            outcome = "OFFLINE"
+        except InternalErrorException:
+            outcome = "INTERNAL_ERROR"
+        except (asyncio.TimeoutError, TimeoutError):
+            outcome = "TIMEOUT"
+        except Exception as e:
+            outcome = type(e).__name__
+
+        self.latencies.setdefault(label, []).append(time.perf_counter() - start)
+        counts = self.results.setdefault(label, {})
+        counts[outcome] = counts.get(outcome, 0) + 1
+        return result if outcome == "OK" else None
+
+    async def flag_chain(self, address: str, variant: int) -> int:
+        chain_id = f"bench_flag_{variant}_{random.getrandbits(64):x}"
+        flag = gen_flag()
+        attack_info = await self.run_task(
+            f"putflag{variant}", CheckerMethod.PUTFLAG,
+            self.message(PutflagCheckerTaskMessage, address, chain_id, variant, flag=flag),
+        )
+        await self.run_task(
+            f"getflag{variant}", CheckerMethod.GETFLAG,
+            self.message(GetflagCheckerTaskMessage, address, chain_id, variant, flag=flag),
+        )
+        if attack_info is None or not self.args.exploits:
+            return 2
+
+        for exploit_variant in self.variants(CheckerMethod.EXPLOIT):
+            await self.run_task(
+                f"exploit{exploit_variant}", CheckerMethod.EXPLOIT,
+                self.message(
+                    ExploitCheckerTaskMessage, address, f"bench_exploit_{random.getrandbits(64):x}",
+                    exploit_variant, flag_regex=FLAG_REGEX,
+                    flag_hash=hashlib.sha256(flag.encode()).hexdigest(), attack_info=attack_info,
+                ),
+            )
+        return 2 + len(self.variants(CheckerMethod.EXPLOIT))
+
+    async def noise_chain(self, address: str, variant: int) -> int:
+        chain_id = f"bench_noise_{variant}_{random.getrandbits(64):x}"
+        await self.run_task(
+            f"putnoise{variant}", CheckerMethod.PUTNOISE,
+            self.message(PutnoiseCheckerTaskMessage, address, chain_id, variant),
+        )
+        await self.run_task(
+            f"getnoise{variant}", CheckerMethod.GETNOISE,
+            self.message(GetnoiseCheckerTaskMessage, address, chain_id, variant),
+        )
+        return 2
+
+    async def havoc(self, address: str, variant: int) -> int:
+        await self.run_task(
+            f"havoc{variant}", CheckerMethod.HAVOC,
+            self.message(HavocCheckerTaskMessage, address, f"bench_havoc_{random.getrandbits(64):x}", variant),
+        )
+        return 1
+
+    def chains(self):
+        """ Endless round-robin over every chain of every variant and team. """
+        kinds = [(self.flag_chain, v) for v in self.variants(CheckerMethod.PUTFLAG)]
+        kinds += [(self.noise_chain, v) for v in self.variants(CheckerMethod.PUTNOISE)]
+        kinds += [(self.havoc, v) for v in self.variants(CheckerMethod.HAVOC)]
+        while True:
+            for kind, variant in kinds:
+                for address in self.addresses:
+                    yield kind, address, variant
+
+    async def run(self) -> float:
+        chains = self.chains()
+        started = 0
+
+        async def worker():
+            nonlocal started
+            while started < self.args.tasks:
+                kind, address, variant = next(chains)
+                # Reserve a rough share up front so we stop close to --tasks
+                started += 2
+                await kind(address, variant)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+        return time.perf_counter() - start
+
+    def report(self, elapsed: float, cpu: float):
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        print(f"{'task':<12} {'count':>7} {'p50 ms':>9} {'p99 ms':>9}  results")
+        for label in sorted(self.latencies):
+            latencies = self.latencies[label]
+            results = ", ".join(f"{k}={v}" for k, v in sorted(self.results[label].items()))
+            print(f"{label:<12} {len(latencies):>7} {percentile(latencies, 0.5) * 1000:>9.2f} "
+                  f"{percentile(latencies, 0.99) * 1000:>9.2f}  {results}")
+
+        everything = [l for latencies in self.latencies.values() for l in latencies]
+        print()
+        print(f"tasks:        {total} in {elapsed:.2f}s, {total / elapsed:.1f} tasks/s")
+        print(f"latency:      p50 {percentile(everything, 0.5) * 1000:.2f}ms, p99 {percentile(everything, 0.99) * 1000:.2f}ms")
+        print(f"checker cpu:  {cpu:.2f}s, {cpu / max(total, 1) * 1000:.3f}ms per task")
+        print(f"checker rss:  {startup.rss_kib()}KiB")
+        lag = metrics.LOOP_LAG
+        print(f"loop lag:     mean {lag.total / max(lag.samples, 1) * 1000:.2f}ms, max {lag.max * 1000:.2f}ms")
+
+def spawn_fake_service(args) -> subprocess.Popen:
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_service.py"),
+               "--port", str(checker.SERVICE_PORT)]
+    for address in args.addresses:
+        command += ["--host", address]
+    for option in ("latency", "jitter", "max_segment", "drop_rate", "corrupt_rate", "stall_rate", "stall_time"):
+        command += ["--" + option.replace("_", "-"), str(getattr(args, option))]
+    return subprocess.Popen(command)
+
+async def wait_for_service(address: str, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(address, checker.SERVICE_PORT)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+async def main(args):
+    fake = None
+    if args.address is None:
+        args.addresses = [f"127.0.1.{team}" for team in range(1, args.teams + 1)]
+        fake = spawn_fake_service(args)
+    else:
+        args.addresses = [args.address]
+
+    try:
+        for address in args.addresses:
+            await wait_for_service(address)
+
+        bench = Bench(args)
+        # Keep the one-off Faker import out of the measured latencies
+        checker.NOISE_POOL.fill()
+        cpu = time.process_time()
+        elapsed = await bench.run()
+        bench.report(elapsed, time.process_time() - cpu)
+    finally:
+        if fake is not None:
+            fake.terminate()
+            fake.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=1000, help="approximate number of tasks to run")
+    parser.add_argument("--concurrency", type=int, default=50, help="chains running at the same time")
+    parser.add_argument("--timeout", type=int, default=15000, help="task timeout in ms")
+    parser.add_argument("--teams", type=int, default=1, help="fake services to spread the load over")
+    parser.add_argument("--address", default=None, help="benchmark a real service instead")
+    parser.add_argument("--no-exploits", dest="exploits", action="store_false")
+    parse_fault_args(parser)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(main(args))
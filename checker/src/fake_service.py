@@ -0,0 +1,530 @@
+"""
+In-memory stand-in for the bambi-notes service, for benchmarking and
+testing the checker without the real binary.
+
+It replays the exact output of service_hidden/bambi-notes.c, including the
+fgets/strtol input handling and the slot 0 heap overflow the exploit relies
+on, and can add latency, jitter, fragmented writes and faults on top.
+
+    python fake_service.py --port 8204 --latency 0.02 --jitter 0.01
+"""
+import argparse
+import asyncio
+import logging
+import random
+
+from asyncio import StreamReader, StreamWriter
+from typing import Dict, List, Optional, Tuple
+
+NOTE_SIZE = 0x60
+NOTE_COUNT = 10
+DEFAULT_NOTE = b"Well, it's a note-taking service. What did you expect?"
+# struct User (and with it the username) sits right behind the chunk the
+# default note gets from calloc, 0x40 bytes after the start of the note
+USERNAME_OFFSET = 0x40
+USERNAME_SIZE = 40
+
+# Users are sharded by the top two bytes of user_hash(), see bambi-notes.c
+STORAGE_DIR = b"/service/data/%02x/%02x/%s/%s"
+# Reserved for the path in front of a filename, the same as in the old flat
+# layout: sizeof(STORAGE_ROOT "%s/%s") + sizeof("ab/cd/") - 1
+STORAGE_DIR_SIZE = len(b"/service/data/%s/%s") + 1 + len(b"ab/cd/")
+FILTERED_CHARS = b"./\n"
+
+class Fault(Exception):
+    pass
+
+class FaultConfig():
+    def __init__(self, latency=0.0, jitter=0.0, max_segment=0, drop_rate=0.0,
+                 corrupt_rate=0.0, stall_rate=0.0, stall_time=5.0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.max_segment = max_segment
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.stall_rate = stall_rate
+        self.stall_time = stall_time
+
+class Storage():
+    """ The /service/data tree: username -> filename -> contents. """
+
+    def __init__(self) -> None:
+        self.users: Dict[bytes, Dict[bytes, bytes]] = {}
+
+def sanitize(data: bytes) -> bytes:
+    # Every filtered char is replaced by a NUL, so the C string ends at the first one
+    for pos, char in enumerate(data):
+        if char in FILTERED_CHARS or char == 0:
+            return bytes(data[:pos])
+    return bytes(data)
+
+def user_hash(username: bytes) -> int:
+    # FNV-1a
+    value = 2166136261
+    for char in username:
+        value = ((value ^ char) * 16777619) & 0xffffffff
+    return value
+
+def cstr(data: bytes) -> bytes:
+    return bytes(data.split(b"\0", 1)[0])
+
+def strtol(data: bytes) -> Optional[int]:
+    """ strtol(data, &endp, 0), None if no digits were consumed. """
+    return strtol_end(data)[0]
+
+def strtol_end(data: bytes) -> Tuple[Optional[int], int]:
+    """ Like strtol, and where endp ends up, 0 if no digits were consumed. """
+    text = data.lstrip(b" \t\n\r\f\v")
+    pos = len(data) - len(text)
+    sign = 1
+    if text[:1] in (b"+", b"-"):
+        sign = -1 if text[:1] == b"-" else 1
+        text = text[1:]
+        pos += 1
+
+    base = 10
+    if text[:2].lower() == b"0x" and text[2:3] and text[2:3] in b"0123456789abcdefABCDEF":
+        base, text = 16, text[2:]
+        pos += 2
+    elif text[:1] == b"0":
+        base = 8
+
+    digits = b""
+    for char in text:
+        try:
+            int(bytes([char]), base)
+        except ValueError:
+            break
+        digits += bytes([char])
+
+    if not digits:
+        return None, 0
+    return sign * int(digits, base), pos + len(digits)
+
+class Session():
+    def __init__(self, reader: StreamReader, writer: StreamWriter, storage: Storage, faults: FaultConfig) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.storage = storage
+        self.faults = faults
+        self.inbuf = bytearray()
+        self.out = bytearray()
+        self.eof = False
+
+        self.username = b""
+        self.notes: List[Optional[bytearray]] = [None] * NOTE_COUNT
+        self.default_note: Optional[bytearray] = None
+
+    # I/O, as the buffered stdio of the real binary behaves: output is sent
+    # once the session would wait for input
+
+    def emit(self, data: bytes):
+        self.out += data
+
+    async def flush(self):
+        if not self.out:
+            return
+        data, self.out = bytes(self.out), bytearray()
+        faults = self.faults
+
+        delay = faults.latency + random.uniform(0, faults.jitter)
+        if random.random() < faults.stall_rate:
+            delay += faults.stall_time
+        if delay:
+            await asyncio.sleep(delay)
+
+        if random.random() < faults.drop_rate:
+            raise Fault("dropped connection")
+        if random.random() < faults.corrupt_rate:
+            pos = random.randrange(len(data))
+            data = data[:pos] + bytes([data[pos] ^ 0x20]) + data[pos + 1:]
+
+        if faults.max_segment:
+            while data:
+                cut = random.randint(1, faults.max_segment)
+                self.writer.write(data[:cut])
+                data = data[cut:]
+                await self.writer.drain()
+        else:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    async def fgets(self, size: int) -> Optional[bytes]:
+        """ Reads at most size - 1 bytes, up to and including a newline. """
+        if b"\n" not in self.inbuf:
+            await self.flush()
+        while True:
+            newline = self.inbuf.find(b"\n", 0, size - 1)
+            if newline >= 0:
+                end = newline + 1
+                break
+            if len(self.inbuf) >= size - 1 or (self.eof and self.inbuf):
+                end = min(len(self.inbuf), size - 1)
+                break
+            if self.eof:
+                return None
+
+            chunk = await self.reader.read(0x1000)
+            if not chunk:
+                self.eof = True
+            self.inbuf += chunk
+
+        line = bytes(self.inbuf[:end])
+        del self.inbuf[:end]
+        return line
+
+    async def getlong(self) -> int:
+        line = await self.fgets(40)
+        value = strtol(line or b"")
+        return -1 if value is None else value
+
+    # Menus
+
+    async def run(self):
+        self.emit(b"Welcome to Bambi-Notes!\n")
+
+        while True:
+            self.emit(
+                b"===== [Unauthenticated] =====\n"
+                b"   1. Register\n"
+                b"   2. Login\n"
+                b"> "
+            )
+            option = await self.getlong()
+            if option in (0, -1):
+                return
+            elif option == 1:
+                authenticated = await self.user_register()
+            elif option == 2:
+                authenticated = await self.user_login()
+            elif option == 1337:
+                self.emit(b"Nice Try!\nYeah this isn't going to do anything\n")
+                authenticated = False
+            else:
+                authenticated = False
+
+            if authenticated:
+                break
+
+        while True:
+            self.emit(
+                b"===== [" + self.username + b"] =====\n"
+                b"   1. Create\n"
+                b"   2. Print\n"
+                b"   3. List Saved\n"
+                b"   4. Delete\n"
+                b"   5. Load\n"
+                b"   6. Save\n"
+                b"> "
+            )
+            option = await self.getlong()
+            if option in (0, -1):
+                return
+            elif option == 1:
+                await self.create_note()
+            elif option == 3:
+                self.list_saved_notes()
+            elif option == 4:
+                await self.delete_note()
+            elif option == 5:
+                await self.load_note()
+            elif option == 6:
+                await self.save_note()
+            elif option == 7:
+                await self.save_notes()
+            elif option == 8:
+                await self.load_notes()
+
+    def init_user(self, username: bytes):
+        self.username = username
+        self.default_note = bytearray(DEFAULT_NOTE)
+        self.notes = [None] * NOTE_COUNT
+        self.notes[0] = self.default_note
+
+    async def user_register(self) -> bool:
+        self.emit(b"Username:\n> ")
+        line = await self.fgets(USERNAME_SIZE)
+        if line is None:
+            raise Fault("Failed to read username")
+        username = sanitize(line)
+
+        if username in self.storage.users:
+            self.emit(b"Username already taken!\n")
+            return False
+
+        self.emit(b"Password:\n> ")
+        password = sanitize(await self.fgets(USERNAME_SIZE) or b"")
+        if not username:
+            # mkdir("/service/data//") fails
+            raise Fault("Failed to create user directory!")
+
+        self.storage.users[username] = {b"passwd": password}
+        self.emit(b"Registration successful!\n")
+        self.init_user(username)
+        return True
+
+    async def user_login(self) -> bool:
+        self.emit(b"Username:\n> ")
+        line = await self.fgets(USERNAME_SIZE)
+        if line is None:
+            raise Fault("Failed to read username")
+        username = sanitize(line)
+
+        files = self.storage.users.get(username)
+        if files is None or b"passwd" not in files:
+            self.emit(b"User " + username + b" does not exist!\n")
+            return False
+
+        self.emit(b"Password:\n> ")
+        password = sanitize(await self.fgets(USERNAME_SIZE) or b"")
+        if cstr(files[b"passwd"][:USERNAME_SIZE - 1]) != password:
+            self.emit(b"Wrong password!\n")
+            return False
+
+        self.emit(b"Login successful!\n")
+        self.init_user(username)
+        return True
+
+    # Notes
+
+    async def create_note(self):
+        self.emit(b"Which slot to save the note into?\n> ")
+        idx = await self.getlong()
+        if not 0 <= idx < NOTE_COUNT:
+            self.emit(b"Nice Try!\n")
+            return
+        if self.notes[idx] is not None:
+            self.emit(b"Already Occupied!\n")
+            return
+
+        self.notes[idx] = bytearray()
+        self.emit(b"Note [%d]\n> " % idx)
+        line = await self.fgets(NOTE_SIZE)
+        if line is None:
+            raise Fault("EOF while creating a note")
+        self.notes[idx] = bytearray(line[:-1] if line.endswith(b"\n") else line)
+        self.emit(b"Note Created!\n")
+
+    def list_saved_notes(self):
+        self.emit(b"\n\n===== [" + self.username + b"'s Notes] =====\n")
+
+        loaded = [(idx, note) for idx, note in enumerate(self.notes) if note is not None]
+        if loaded:
+            self.emit(b"Currently Loaded:\n")
+        for idx, note in loaded:
+            self.emit(b"    %d | %s\n" % (idx, cstr(note)))
+
+        files = self.storage.users.get(self.username)
+        if files is None:
+            raise Fault("Failed to open user directory")
+
+        # In the order of the service's .index: the directory, then every save
+        self.emit(b"Saved Notes:\n | .\n | ..\n")
+        for filename in files:
+            if filename != b"passwd":
+                self.emit(b" | " + filename + b"\n")
+        self.emit(b"===== [End of Notes] =====\n")
+
+    async def delete_note(self):
+        self.emit(b"<Idx> of Note to delete?\n> ")
+        idx = await self.getlong()
+        if not 0 <= idx < NOTE_COUNT:
+            self.emit(b"Invalid Idx!\n")
+        elif self.notes[idx] is None:
+            self.emit(b"Note %d doesn't exist!\n" % idx)
+        else:
+            if self.notes[idx] is self.default_note:
+                self.default_note = None
+            self.notes[idx] = None
+            self.emit(b"Note deleted!\n")
+
+    def user_dir(self) -> bytes:
+        value = user_hash(self.username)
+        return STORAGE_DIR % (value >> 24, (value >> 16) & 0xff, self.username, b"")
+
+    async def load_note(self):
+        self.emit(b"Which note to load?\nFilename > ")
+        # path_buf[STORAGE_DIR_SIZE + sizeof(username) + 0x20]
+        room = STORAGE_DIR_SIZE + USERNAME_SIZE + 0x20 - len(self.user_dir())
+        line = await self.fgets(room)
+        if line is None:
+            return
+        filename = sanitize(line)
+
+        self.emit(b"Which slot should it be stored in?\n> ")
+        idx = await self.getlong()
+        if not 0 <= idx < NOTE_COUNT:
+            self.emit(b"Invalid Idx!\n")
+            return
+
+        path = self.user_dir() + filename
+        if not self.read_note_file(filename, idx):
+            self.emit(b"Failed to open " + path + b"\n")
+            return
+        self.emit(b"Note " + path + b" was loaded into Slot %d.\n" % idx)
+
+    def read_note_file(self, filename: bytes, idx: int) -> bool:
+        if self.notes[idx] is None:
+            self.notes[idx] = bytearray()
+
+        files = self.storage.users.get(self.username, {})
+        if not filename and self.username in self.storage.users:
+            # Opening the directory works, reading from it doesn't
+            raise Fault("Note read failed")
+        if filename not in files:
+            return False
+
+        data = files[filename][:NOTE_SIZE]
+        note = self.notes[idx]
+        if note is self.default_note and len(data) > USERNAME_OFFSET:
+            # read() runs past the 0x38 byte chunk into struct User. Printing
+            # the note still shows everything up to the terminating NUL.
+            self.username = cstr(data[USERNAME_OFFSET:])
+        note[:] = data
+        return True
+
+    async def save_note(self):
+        self.emit(b"Which note to save?\n> ")
+        idx = await self.getlong()
+        if not 0 <= idx < NOTE_COUNT:
+            self.emit(b"Invalid Idx!\n")
+            return
+        if self.notes[idx] is None:
+            self.emit(b"Note %d does not exist!\n" % idx)
+            return
+
+        self.emit(b"Which file to save into?\nFilename > ")
+        room = STORAGE_DIR_SIZE + USERNAME_SIZE + 0x20 - len(self.user_dir())
+        filename = sanitize(await self.fgets(room) or b"")
+
+        if not self.write_note_file(filename, idx):
+            raise Fault("Failed to open file!")
+        self.emit(b"Note saved!\n")
+
+    def write_note_file(self, filename: bytes, idx: int) -> bool:
+        files = self.storage.users.get(self.username)
+        if files is None or not filename or filename in files:
+            return False
+        files[filename] = cstr(self.notes[idx])
+        return True
+
+    # Bulk commands, options 7 and 8: all "<idx> <filename>" lines first,
+    # then a single reply
+
+    async def read_bulk_count(self, prompt: bytes) -> int:
+        self.emit(prompt + b"\n> ")
+        count = await self.getlong()
+        if not 1 <= count <= NOTE_COUNT:
+            self.emit(b"Invalid count!\n")
+            return 0
+        return count
+
+    async def read_bulk_entry(self):
+        # char line[BULK_LINE_SIZE]
+        line = await self.fgets(0x20 + STORAGE_DIR_SIZE + USERNAME_SIZE + 0x20)
+        if line is None:
+            raise Fault("EOF in a bulk command")
+        idx, end = strtol_end(line)
+        if idx is None:
+            idx = -1
+        rest = line[end:]
+        if rest[:1] == b" ":
+            rest = rest[1:]
+        room = STORAGE_DIR_SIZE + USERNAME_SIZE + 0x20 - len(self.user_dir())
+        return idx, sanitize(rest)[:room - 1]
+
+    async def save_notes(self):
+        count = await self.read_bulk_count(b"How many notes to save?")
+        if not count:
+            return
+
+        reply = bytearray()
+        saved = 0
+        for _ in range(count):
+            idx, filename = await self.read_bulk_entry()
+            if not 0 <= idx < NOTE_COUNT:
+                reply += b"Invalid Idx!\n"
+            elif self.notes[idx] is None:
+                reply += b"Note %d does not exist!\n" % idx
+            elif not self.write_note_file(filename, idx):
+                reply += b"Failed to save " + self.user_dir() + filename + b"\n"
+            else:
+                reply += b"Note %d saved!\n" % idx
+                saved += 1
+        reply += b"Saved %d of %d notes!\n" % (saved, count)
+        self.emit(bytes(reply))
+
+    async def load_notes(self):
+        count = await self.read_bulk_count(b"How many notes to load?")
+        if not count:
+            return
+
+        reply = bytearray()
+        loaded = 0
+        for _ in range(count):
+            idx, filename = await self.read_bulk_entry()
+            path = self.user_dir() + filename
+            if not 0 <= idx < NOTE_COUNT:
+                reply += b"Invalid Idx!\n"
+            elif not self.read_note_file(filename, idx):
+                reply += b"Failed to open " + path + b"\n"
+            else:
+                reply += b"Note " + path + b" was loaded into Slot %d.\n" % idx
+                loaded += 1
+        reply += b"Loaded %d of %d notes!\n" % (loaded, count)
+        self.emit(bytes(reply))
+
+class FakeService():
+    def __init__(self, faults: Optional[FaultConfig] = None) -> None:
+        self.faults = faults or FaultConfig()
+        self.storage = Storage()
+        self.connections = 0
+
+    async def handle(self, reader: StreamReader, writer: StreamWriter):
+        self.connections += 1
+        session = Session(reader, writer, self.storage, self.faults)
+        try:
+            await session.run()
+            await session.flush()
+        except (Fault, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=0) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle, host, port, backlog=1024)
+
+def parse_fault_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added before every reply")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many seconds on top")
+    parser.add_argument("--max-segment", type=int, default=0, help="split replies into random segments")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="chance to drop the connection per reply")
+    parser.add_argument("--corrupt-rate", type=float, default=0.0, help="chance to flip a byte per reply")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="chance to stall per reply")
+    parser.add_argument("--stall-time", type=float, default=5.0)
+
+def faults_from_args(args) -> FaultConfig:
+    return FaultConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        max_segment=args.max_segment,
+        drop_rate=args.drop_rate,
+        corrupt_rate=args.corrupt_rate,
+        stall_rate=args.stall_rate,
+        stall_time=args.stall_time,
+    )
+
+async def serve(args):
+    service = FakeService(faults_from_args(args))
+    server = await service.start(args.host or "127.0.0.1", args.port)
+    logging.info("Fake bambi-notes listening on %s", ", ".join(str(s.getsockname()) for s in server.sockets))
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", action="append", help="address to listen on, may be repeated")
+    parser.add_argument("--port", type=int, default=8204)
+    parse_fault_args(parser)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(parser.parse_args()))
@@ -0,0 +1,637 @@
+"""
+Protocol conformance fuzzer for the checker's client.
+
+Every case is a random session: register, or log into a user whose
+directory already holds up to --max-files files of players, then creates,
+deletes, saves and loads, the bulk commands, pipelined batches, the
+exploit's search over every listed file, with some of them expired before
+they are loaded, and listings in between. Players pick filenames and note
+texts too, so theirs are built from every byte the service lets through,
+protocol markers like "> " and " | " included.
+
+A case is first recorded against the fake service from fake_service.py,
+running in the same process and connected through in-memory pipes, and
+every listing the client returns has to match what the fake service holds.
+The service side of that recording is then replayed to the client
+--replays times, cut into reads differently each time:
+
+    whole     one read per reply
+    coalesce  one read for everything the client may see so far
+    random    reads of random size
+    bytes     one byte per read
+    markers   reads that end inside "> ", "=====" and " | ", and around newlines
+
+A reply is only handed out once the client sent everything the service had
+read before writing it, like the real service behaves. With --mutate-rate,
+one reply of a replay gets two adjacent lines swapped, a prompt moved in
+front of the line it ends, a line dropped or a line repeated.
+
+Outcomes are judged the way enochecker3 turns exceptions into results:
+
+- A replay without a mutation must end exactly like the recording, with
+  the same listings and the same bytes sent.
+- A mutated replay may end in MUMBLE: a MumbleException, EOF, or a step
+  timeout, which the replay raises as soon as both sides would wait for each
+  other. Or it returns listings, and those missing anything the checker
+  expects count as caught by NoteList.verify.
+- INTERNAL_ERROR, any other exception, is never fine. The checker would
+  blame itself for what a team's service sent.
+
+Violations are printed with the seed of their case, --seed <seed> --cases 1
+-v runs that case again with the client's debug log. The replays only run
+the client, so the throughput reported for them is the rate it parses
+service output at; --throughput replays clean cases only, for comparing
+parser changes:
+
+    python fuzz.py --cases 2000 --replays 8 --mutate-rate 0.3
+    python fuzz.py --throughput --cases 200 --replays 50
+"""
+import argparse
+import asyncio
+import logging
+import random
+import re
+import sys
+import time
+
+from collections import deque
+from logging import LoggerAdapter
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from enochecker3 import HavocCheckerTaskMessage, MumbleException, OfflineException
+
+import checker
+from checker import CHARSET, DEFAULT_NOTE, BambiNoteClient, saved_filenames, search_saved_notes
+from fake_service import FaultConfig, Session, Storage
+from protocol import NOTE_COUNT, NoteList, ProtocolReader
+
+SEGMENTATIONS = ("whole", "coalesce", "random", "bytes", "markers")
+MUTATIONS = ("swap", "prompt", "drop", "repeat")
+MARKER_RE = re.compile(rb"> |=====| \| |\n")
+
+# Pieces of the protocol players can put into filenames and notes
+TRICKY = (
+    b"> ", b" | ", b"===== [", b"] =====", b"===== [End of Notes] =====", b"Saved Notes:",
+    b"Currently Loaded:", b"    1 | ", b"Note Created!", b"Filename > ", b"'s Notes", b"   1. Create",
+    b" was loaded into Slot 1", b"\r", b"\t", b"\x1b[0m", b"\xff\xfe",
+)
+FILENAME_BYTES = bytes(c for c in range(1, 256) if c not in b"./\n")
+ASCII_FILENAME_BYTES = bytes(c for c in FILENAME_BYTES if c < 0x80)
+NOTE_BYTES = bytes(c for c in range(1, 256) if c != 0x0a)
+MAX_FILENAME = 40
+MAX_NOTE = 0x50
+# Far more than any case needs, only a broken recording runs into it
+RECORD_TIMEOUT = 10.0
+
+Op = Tuple
+
+def tricky_bytes(rng: random.Random, alphabet: bytes, max_len: int) -> bytes:
+    tokens = [token for token in TRICKY if all(c in alphabet for c in token)]
+    target = rng.randint(1, max_len)
+    data = bytearray()
+    while len(data) < target:
+        if rng.random() < 0.3:
+            data += rng.choice(tokens)
+        else:
+            data += bytes(rng.choices(alphabet, k=rng.randint(1, 8)))
+    return bytes(data[:target])
+
+def random_name(rng: random.Random, k=16) -> str:
+    return "".join(rng.choices(CHARSET, k=k))
+
+def same_listing(a: NoteList, b: NoteList) -> bool:
+    return a.slots == b.slots and a.filenames == b.filenames
+
+class NoFlags():
+    """ FlagSearcher for the exploit's search, which then loads every file. """
+
+    def search_flag(self, data: bytes) -> Optional[str]:
+        return None
+
+class Model():
+    """ What the fake service holds for the case's user. """
+
+    def __init__(self, files: Dict[bytes, bytes]) -> None:
+        self.slots: List[Optional[bytes]] = [DEFAULT_NOTE] + [None] * (NOTE_COUNT - 1)
+        self.files = dict(files)
+        self.own: List[bytes] = []
+
+    def listing(self) -> NoteList:
+        return NoteList(list(self.slots), [b".", b".."] + list(self.files))
+
+    def expected(self) -> NoteList:
+        """ What the checker itself put there, as it would verify a listing. """
+        return NoteList(list(self.slots), self.own)
+
+class Case():
+    """ One generated session and the listings it has to produce. """
+
+    def __init__(self, seed: int, args) -> None:
+        self.seed = seed
+        rng = random.Random(seed)
+        self.username = random_name(rng)
+        self.password = random_name(rng)
+        self.login = rng.random() < 0.5
+
+        count = rng.choice((0, rng.randint(1, 10), rng.randint(0, args.max_files)))
+        self.players = self.player_files(rng, count, {})
+
+        self.ops: List[Op] = []
+        self.listings: List[NoteList] = []
+        self.expected: List[NoteList] = []
+        model = Model(self.players if self.login else {})
+        for _ in range(rng.randint(1, args.max_ops)):
+            self.ops.append(self.next_op(rng, model, batched=False))
+        self.ops.append(self.apply(model, ("list_notes",)))
+
+    def player_files(self, rng: random.Random, count: int, taken) -> Dict[bytes, bytes]:
+        files: Dict[bytes, bytes] = {}
+        while len(files) < count:
+            alphabet = ASCII_FILENAME_BYTES if rng.random() < 0.5 else FILENAME_BYTES
+            name = tricky_bytes(rng, alphabet, MAX_FILENAME)
+            if name != b"passwd" and name not in taken:
+                files[name] = tricky_bytes(rng, NOTE_BYTES[1:], MAX_NOTE)
+        return files
+
+    def own_name(self, rng: random.Random, model: Model) -> str:
+        while True:
+            name = random_name(rng)
+            if name.encode() not in model.files:
+                return name
+
+    def next_op(self, rng: random.Random, model: Model, batched: bool) -> Op:
+        occupied = [idx for idx, note in enumerate(model.slots) if note is not None]
+        empty = [idx for idx, note in enumerate(model.slots) if note is None]
+        # Names the client can be given as they are, the search loads the rest
+        loadable = [name.decode() for name in model.files if name.isascii()]
+
+        choices = ["list_notes"] * 2
+        if empty:
+            choices += ["create_note"] * 3
+        if occupied:
+            choices += ["delete_note", "save_note", "save_note", "save_notes"]
+        if loadable:
+            choices += ["load_note", "load_note", "load_notes"]
+        if not batched:
+            choices += ["batch", "inject"]
+            if model.files and len(model.files) <= 3 * checker.EXPLOIT_SLOTS:
+                choices.append("search")
+        kind = rng.choice(choices)
+
+        if kind == "create_note":
+            text = tricky_bytes(rng, NOTE_BYTES[1:], MAX_NOTE) if rng.random() < 0.5 else random_name(rng, 0x30).encode()
+            op = (kind, rng.choice(empty), text)
+        elif kind == "delete_note":
+            op = (kind, rng.choice(occupied))
+        elif kind == "save_note":
+            op = (kind, rng.choice(occupied), self.own_name(rng, model))
+        elif kind == "load_note":
+            op = (kind, rng.randint(1, NOTE_COUNT - 1), rng.choice(loadable))
+        elif kind == "save_notes":
+            entries = []
+            for _ in range(rng.randint(1, NOTE_COUNT)):
+                name = self.own_name(rng, model)
+                if all(name != other for _, other in entries):
+                    entries.append((rng.choice(occupied), name))
+            op = (kind, entries)
+        elif kind == "load_notes":
+            op = (kind, [(rng.randint(1, NOTE_COUNT - 1), rng.choice(loadable)) for _ in range(rng.randint(1, NOTE_COUNT))])
+        elif kind == "batch":
+            ops = []
+            for _ in range(rng.randint(2, 6)):
+                ops.append(self.next_op(rng, model, batched=True))
+            return (kind, ops)
+        elif kind == "inject":
+            op = (kind, self.player_files(rng, rng.randint(1, 5), model.files))
+        elif kind == "search":
+            # Players' files the cleaner expires between the listing and the loads
+            players = [name for name in model.files if name not in model.own]
+            op = (kind, rng.sample(players, rng.randint(0, min(3, len(players)))))
+        else:
+            op = (kind,)
+        return self.apply(model, op)
+
+    def apply(self, model: Model, op: Op) -> Op:
+        kind = op[0]
+        if kind == "create_note":
+            model.slots[op[1]] = op[2]
+        elif kind == "delete_note":
+            model.slots[op[1]] = None
+        elif kind in ("save_note", "save_notes"):
+            for idx, name in (op[1:],) if kind == "save_note" else op[1]:
+                model.files[name.encode()] = model.slots[idx]
+                model.own.append(name.encode())
+        elif kind in ("load_note", "load_notes"):
+            for idx, name in (op[1:],) if kind == "load_note" else op[1]:
+                model.slots[idx] = model.files[name.encode()]
+        elif kind == "inject":
+            model.files.update(op[1])
+        elif kind == "search":
+            names = list(model.files)
+            for start in range(0, len(names), checker.EXPLOIT_SLOTS):
+                for slot, name in enumerate(names[start:start + checker.EXPLOIT_SLOTS], 1):
+                    if name not in op[1]:
+                        model.slots[slot] = model.files[name]
+                    elif model.slots[slot] is None:
+                        # The service allocates the slot before it opens the file
+                        model.slots[slot] = b""
+            for name in op[1]:
+                del model.files[name]
+        elif kind == "list_notes":
+            self.listings.append(model.listing())
+            self.expected.append(model.expected())
+        return op
+
+async def run_case(client: BambiNoteClient, case: Case, storage: Optional[Storage] = None) -> List[NoteList]:
+    """ Runs the case's session, returns every listing the client read. """
+    await client.readuntil(checker.BANNER)
+    if case.login:
+        await client.login(case.username, case.password)
+    else:
+        await client.register(case.username, case.password)
+
+    listings = []
+    for op in case.ops:
+        kind = op[0]
+        if kind == "batch":
+            async with client.batch() as batch:
+                results = [(getattr(batch, inner[0])(*inner[1:]), inner[0]) for inner in op[1]]
+            listings += [result.result() for result, kind in results if kind == "list_notes"]
+        elif kind == "inject":
+            # Another team's files showing up, only the fake service sees it
+            if storage is not None:
+                storage.users[case.username.encode()].update(op[1])
+        elif kind == "search":
+            notes = await client.list_notes()
+            if storage is not None:
+                for name in op[1]:
+                    del storage.users[case.username.encode()][name]
+            await search_saved_notes(client, saved_filenames(notes), NoFlags())
+        elif kind == "list_notes":
+            listings.append(await client.list_notes())
+        else:
+            await getattr(client, kind)(*op[1:])
+    return listings
+
+class Pipe():
+    """
+    One direction of an in-memory connection, written to like a
+    StreamWriter and read from like a StreamReader. Everything written is
+    logged to the shared transcript.
+    """
+
+    def __init__(self, transcript: List[Tuple[bool, bytes]], from_service: bool) -> None:
+        self.transcript = transcript
+        self.from_service = from_service
+        self.buffer = bytearray()
+        self.closed = False
+        self.ready = asyncio.Event()
+
+    def write(self, data: bytes):
+        self.transcript.append((self.from_service, bytes(data)))
+        self.buffer += data
+        self.ready.set()
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    async def read(self, n: int) -> bytes:
+        while not self.buffer and not self.closed:
+            self.ready.clear()
+            await self.ready.wait()
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+class Link():
+    """ The client's end of a recorded connection. """
+
+    def __init__(self, incoming: Pipe, outgoing: Pipe) -> None:
+        self.incoming = incoming
+        self.outgoing = outgoing
+
+    def write(self, data: bytes):
+        self.outgoing.write(data)
+
+    async def drain(self):
+        pass
+
+    async def read(self, n: int) -> bytes:
+        return await self.incoming.read(n)
+
+class Replay():
+    """
+    The service side of a recording played back to the client. Every reply
+    is held back until the client sent everything the service had read
+    before writing it, and is then cut into reads by cut.
+    """
+
+    def __init__(self, transcript: List[Tuple[bool, bytes]], cut: Callable[[bytes], List[bytes]], coalesce=False) -> None:
+        # (client bytes the service had read, reply)
+        self.replies: Deque[Tuple[int, bytes]] = deque()
+        read = 0
+        for from_service, data in transcript:
+            if from_service:
+                self.replies.append((read, data))
+            else:
+                read += len(data)
+        self.cut = cut
+        self.coalesce = coalesce
+        self.reads: Deque[bytes] = deque()
+        self.sent = bytearray()
+        self.received = 0
+        self.read_calls = 0
+
+    def write(self, data: bytes):
+        self.sent += data
+
+    async def drain(self):
+        pass
+
+    async def read(self, n: int) -> bytes:
+        while self.replies and self.replies[0][0] <= len(self.sent):
+            self.reads.extend(self.cut(self.replies.popleft()[1]))
+        if self.coalesce and len(self.reads) > 1:
+            self.reads = deque([b"".join(self.reads)])
+        if not self.reads:
+            # The service waits for the client and the client for the
+            # service, which the client's step timeout would end
+            raise TimeoutError("Both sides wait for each other")
+
+        data = self.reads.popleft()
+        if len(data) > n:
+            self.reads.appendleft(data[n:])
+            data = data[:n]
+        self.read_calls += 1
+        self.received += len(data)
+        return data
+
+def segmenter(name: str, rng: random.Random) -> Callable[[bytes], List[bytes]]:
+    def split(data: bytes, points) -> List[bytes]:
+        bounds = [0] + sorted(set(p for p in points if 0 < p < len(data))) + [len(data)]
+        return [data[a:b] for a, b in zip(bounds, bounds[1:])]
+
+    if name == "bytes":
+        return lambda data: [data[i:i + 1] for i in range(len(data))]
+    if name == "random":
+        most = rng.randint(1, 64)
+        def cut_random(data: bytes) -> List[bytes]:
+            points, pos = [], 0
+            while pos < len(data):
+                pos += rng.randint(1, most)
+                points.append(pos)
+            return split(data, points)
+        return cut_random
+    if name == "markers":
+        def cut_markers(data: bytes) -> List[bytes]:
+            points = []
+            for match in MARKER_RE.finditer(data):
+                if rng.random() < 0.5:
+                    continue
+                if match.group() == b"\n":
+                    points.append(match.start() + rng.randint(0, 1))
+                else:
+                    points.append(match.start() + rng.randint(1, len(match.group()) - 1))
+            return split(data, points)
+        return cut_markers
+    return lambda data: [data]
+
+def mutate(kind: str, data: bytes, rng: random.Random) -> Optional[bytes]:
+    """ data with one mutation of kind, None if it has nothing to apply it to. """
+    lines = data.splitlines(keepends=True)
+    if kind == "prompt":
+        prompts = [m.start() for m in re.finditer(rb"> ", data)]
+        if not prompts:
+            return None
+        pos = rng.choice(prompts)
+        begin = data.rfind(b"\n", 0, pos) + 1
+        result = data[:begin] + b"> " + data[begin:pos] + data[pos + 2:]
+    elif kind == "swap":
+        if len(lines) < 2:
+            return None
+        i = rng.randrange(len(lines) - 1)
+        lines[i], lines[i + 1] = lines[i + 1], lines[i]
+        result = b"".join(lines)
+    elif kind == "drop":
+        del lines[rng.randrange(len(lines))]
+        result = b"".join(lines)
+    else:
+        i = rng.randrange(len(lines))
+        lines.insert(i, lines[i])
+        result = b"".join(lines)
+    return result if result != data else None
+
+def offline_client(transport, logger: LoggerAdapter) -> BambiNoteClient:
+    """ A BambiNoteClient reading from and writing to transport instead of a service. """
+    task = HavocCheckerTaskMessage(
+        task_id=1,
+        address="127.0.0.1",
+        team_id=1,
+        team_name="offline",
+        current_round_id=1,
+        related_round_id=1,
+        variant_id=0,
+        timeout=15000,
+        round_length=60,
+        task_chain_id="offline",
+    )
+    client = BambiNoteClient(task, logger, deadline=float("inf"))
+    client.reader = client.writer = transport
+    client.stream = ProtocolReader(transport)
+    return client
+
+def verdict(e: Optional[BaseException]) -> str:
+    """ The result enochecker3 would make of a task ending with e. """
+    if e is None:
+        return "OK"
+    if isinstance(e, OfflineException):
+        return "OFFLINE"
+    if isinstance(e, (MumbleException, EOFError, TimeoutError, ConnectionResetError)):
+        return "MUMBLE"
+    return "INTERNAL_ERROR"
+
+class Fuzzer():
+    def __init__(self, args) -> None:
+        self.args = args
+        self.logger = LoggerAdapter(logging.getLogger("fuzz"), {})
+
+        self.cases = 0
+        self.violations = 0
+        # segmentation or mutation -> outcome -> count
+        self.outcomes: Dict[str, Dict[str, int]] = {}
+        self.replays = 0
+        self.listings = 0
+        self.received = 0
+        self.read_calls = 0
+        self.replay_time = 0.0
+        self.record_time = 0.0
+
+    def client(self, transport) -> BambiNoteClient:
+        return offline_client(transport, self.logger)
+
+    def violation(self, case: Case, where: str, message: str):
+        self.violations += 1
+        if self.violations <= self.args.max_reports:
+            print(f"VIOLATION seed {case.seed} {where}: {message}")
+
+    def count(self, label: str, outcome: str):
+        counts = self.outcomes.setdefault(label, {})
+        counts[outcome] = counts.get(outcome, 0) + 1
+
+    async def record(self, case: Case) -> Optional[List[Tuple[bool, bytes]]]:
+        transcript: List[Tuple[bool, bytes]] = []
+        to_service, to_client = Pipe(transcript, False), Pipe(transcript, True)
+        storage = Storage()
+        if case.login:
+            storage.users[case.username.encode()] = {b"passwd": case.password.encode(), **case.players}
+
+        session = Session(to_service, to_client, storage, FaultConfig())
+        service = asyncio.ensure_future(session.run())
+        service.add_done_callback(lambda _: to_client.close())
+        start = time.perf_counter()
+        try:
+            async with asyncio.timeout(RECORD_TIMEOUT):
+                listings = await run_case(self.client(Link(to_client, to_service)), case, storage)
+        except Exception as e:
+            self.violation(case, "recording", f"{verdict(e)} on valid service output: {e!r}")
+            return None
+        finally:
+            self.record_time += time.perf_counter() - start
+            service.cancel()
+            await asyncio.gather(service, return_exceptions=True)
+
+        for i, (got, want) in enumerate(zip(listings, case.listings)):
+            if not same_listing(got, want):
+                self.violation(case, "recording", f"listing {i} is {got!r}, the service holds {want!r}")
+                return None
+        if len(listings) != len(case.listings):
+            self.violation(case, "recording", f"{len(listings)} listings instead of {len(case.listings)}")
+            return None
+        return transcript
+
+    async def replay(self, case: Case, transcript, listings: List[NoteList], number: int):
+        rng = random.Random(f"{case.seed}/{number}")
+        segmentation = rng.choice(self.args.segmentation)
+        mutation = None
+        if rng.random() < self.args.mutate_rate:
+            mutation = rng.choice(MUTATIONS)
+            replies = [i for i, (from_service, _) in enumerate(transcript) if from_service]
+            for _ in range(10):
+                i = rng.choice(replies)
+                mutated = mutate(mutation, transcript[i][1], rng)
+                if mutated is not None:
+                    transcript = transcript[:i] + [(True, mutated)] + transcript[i + 1:]
+                    break
+            else:
+                mutation = None
+
+        replay = Replay(transcript, segmenter(segmentation, rng), coalesce=segmentation == "coalesce")
+        error: Optional[BaseException] = None
+        results: List[NoteList] = []
+        start = time.perf_counter()
+        try:
+            results = await run_case(self.client(replay), case)
+        except Exception as e:
+            error = e
+        self.replay_time += time.perf_counter() - start
+        self.replays += 1
+        self.listings += len(results)
+        self.received += replay.received
+        self.read_calls += replay.read_calls
+
+        where = f"replay {number} ({segmentation}{', ' + mutation if mutation else ''})"
+        if mutation is None:
+            sent = b"".join(data for from_service, data in transcript if not from_service)
+            if error is not None:
+                outcome = "deviates"
+                self.violation(case, where, f"{verdict(error)} where the recording succeeded: {error!r}")
+            elif len(results) != len(listings) or not all(map(same_listing, results, listings)):
+                outcome = "deviates"
+                self.violation(case, where, "listings differ from the recording")
+            elif bytes(replay.sent) != sent:
+                outcome = "deviates"
+                self.violation(case, where, "sent different bytes than in the recording")
+            else:
+                outcome = "OK"
+            self.count(segmentation, outcome)
+            return
+
+        outcome = verdict(error)
+        if outcome == "OK" and any(got.verify(want) for got, want in zip(results, case.expected)):
+            outcome = "caught by verify"
+        elif outcome == "INTERNAL_ERROR":
+            self.violation(case, where, f"INTERNAL_ERROR on mutated output: {error!r}")
+        self.count(segmentation, outcome)
+        self.count(mutation, outcome)
+
+    async def run_one(self, seed: int):
+        case = Case(seed, self.args)
+        self.cases += 1
+        transcript = await self.record(case)
+        if transcript is None:
+            return
+        listings = case.listings
+        for number in range(self.args.replays):
+            await self.replay(case, transcript, listings, number)
+
+    async def run(self):
+        start = time.perf_counter()
+        seed = self.args.seed if self.args.seed is not None else random.randrange(1 << 32)
+        print(f"seeds {seed} to {seed + self.args.cases - 1}")
+        for offset in range(self.args.cases):
+            await self.run_one(seed + offset)
+            if self.args.duration and time.perf_counter() - start > self.args.duration:
+                break
+
+    def report(self, cpu: float):
+        print()
+        outcomes = sorted({outcome for counts in self.outcomes.values() for outcome in counts})
+        print(f"{'replays':<12}" + "".join(f" {outcome:>17}" for outcome in outcomes))
+        for label in list(SEGMENTATIONS) + list(MUTATIONS):
+            if label in self.outcomes:
+                counts = self.outcomes[label]
+                print(f"{label:<12}" + "".join(f" {counts.get(outcome, 0):>17}" for outcome in outcomes))
+
+        elapsed = max(self.replay_time, 1e-9)
+        print()
+        print(f"cases:        {self.cases}, recorded in {self.record_time:.2f}s")
+        print(f"replays:      {self.replays} in {self.replay_time:.2f}s, {self.replays / elapsed:.0f}/s")
+        print(f"parsed:       {self.received / elapsed / 1e6:.2f}MB/s in {self.read_calls / elapsed:.0f} reads/s, "
+              f"{self.listings / elapsed:.0f} listings/s")
+        print(f"fuzzer cpu:   {cpu:.2f}s")
+        print(f"violations:   {self.violations}")
+
+async def main(args) -> int:
+    fuzzer = Fuzzer(args)
+    cpu = time.process_time()
+    await fuzzer.run()
+    fuzzer.report(time.process_time() - cpu)
+    return 1 if fuzzer.violations else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", type=int, default=500, help="sessions to generate")
+    parser.add_argument("--replays", type=int, default=8, help="replays of every recorded session")
+    parser.add_argument("--duration", type=float, default=0, help="stop after this many seconds")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the first case, the next ones count up")
+    parser.add_argument("--mutate-rate", type=float, default=0.25, help="share of replays with a mutated reply")
+    parser.add_argument("--segmentation", type=lambda value: value.split(","), default=list(SEGMENTATIONS),
+                        help="comma separated, of " + ",".join(SEGMENTATIONS))
+    parser.add_argument("--max-files", type=int, default=300, help="most files players have in a directory")
+    parser.add_argument("--max-ops", type=int, default=12, help="most commands per session")
+    parser.add_argument("--max-reports", type=int, default=20, help="violations to print")
+    parser.add_argument("--throughput", action="store_true", help="clean replays only, cut like the service writes")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log the client's traffic")
+    args = parser.parse_args()
+    if args.throughput:
+        args.mutate_rate = 0.0
+        if args.segmentation == list(SEGMENTATIONS):
+            args.segmentation = ["whole"]
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("fuzz").setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    sys.exit(asyncio.run(main(args)))
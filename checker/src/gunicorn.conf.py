@@ -1,8 +1,61 @@
+import gc
 import multiprocessing
+import os
+import threading
+
+import startup
 
 worker_class = "uvicorn.workers.UvicornWorker"
 workers = min(4, multiprocessing.cpu_count())
 bind = "0.0.0.0:8000"
 timeout = 90
 keepalive = 3600
-preload_app = True
\ No newline at end of file
+preload_app = True
+
+# With BAMBI_PRELOAD_NOISE=1 Faker and the noise pool are built once in the
+# master and shared with the workers, otherwise every worker builds its own
+# in the background right after it started.
+PRELOAD_NOISE = os.getenv("BAMBI_PRELOAD_NOISE", "0") == "1"
+
+def when_ready(server):
+    import checker
+    import metrics
+
+    metrics.REGISTRY.reset()
+
+    if PRELOAD_NOISE:
+        checker.NOISE_POOL.fill()
+        startup.mark("noise pool")
+
+    # Move everything preloaded out of the collector's reach, so collections
+    # in the workers don't write to (and thereby unshare) the inherited pages
+    gc.collect()
+    gc.freeze()
+    startup.mark("gc freeze")
+    server.log.info(startup.summary())
+
+def child_exit(server, worker):
+    import metrics
+
+    # Otherwise the dead worker's gauges stay in the totals forever
+    try:
+        metrics.REGISTRY.retire(worker.pid)
+    except OSError as e:
+        server.log.warning("Failed to retire metrics of worker %s: %s", worker.pid, e)
+
+def post_fork(server, worker):
+    import checker
+
+    startup.forked()
+    checker.NOISE_POOL.reseed()
+
+def post_worker_init(worker):
+    import checker
+    import offload
+
+    # Threads don't survive the fork, so this has to happen in every worker
+    offload.offload_logging()
+
+    if not PRELOAD_NOISE:
+        threading.Thread(target=checker.NOISE_POOL.prefill, daemon=True).start()
+    worker.log.info(startup.worker_summary())
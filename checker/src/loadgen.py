@@ -0,0 +1,292 @@
+"""
+Open-loop load generator for sizing the service box and the checker.
+
+Sessions arrive as a Poisson process at a target rate that ramps up
+linearly from --start-rate to --rate over --ramp seconds and is then held
+for --duration seconds. Every arrival starts a session right away, no matter
+how many earlier ones are still running, so a service that falls behind
+sees its queue grow instead of the generator politely slowing down. Latency
+is measured from the scheduled arrival, so time spent waiting for a
+connection counts as well.
+
+Each session is one of the scenarios below, picked by --mix weights, and
+runs through BambiNoteClient exactly like the checker's own tasks:
+
+    register  register, create up to three notes, save them, list
+    revisit   log back into a user from an earlier register session, load
+              its files and verify the listing
+    browse    log in with a wrong password, then the right one, list
+    churn     register, create and delete notes, list
+
+Runs against the fake service from fake_service.py unless --address is set:
+
+    python loadgen.py --address 10.1.5.1 --rate 200 --ramp 60 --duration 120
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from logging import LoggerAdapter
+from typing import Dict, List, Tuple
+
+from enochecker3 import HavocCheckerTaskMessage, InternalErrorException, MumbleException, OfflineException
+
+import checker
+from bench import percentile, spawn_fake_service, wait_for_service
+from checker import BambiNoteClient, InvalidCredentialsException, generate_creds, gen_random_str, gen_rando_bs
+from fake_service import parse_fault_args
+from protocol import NoteList
+
+SCENARIOS = ("register", "revisit", "browse", "churn")
+REPORT_INTERVAL = 5
+# Users from register sessions that later sessions log back into
+MAX_KNOWN_USERS = 10000
+
+User = Tuple[str, str, Dict[int, bytes], List[str]]
+
+def error_class(e: BaseException) -> str:
+    if isinstance(e, MumbleException):
+        return "MUMBLE"
+    if isinstance(e, OfflineException):
+        return "OFFLINE"
+    if isinstance(e, InternalErrorException):
+        return "INTERNAL_ERROR"
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+        return "TIMEOUT"
+    return type(e).__name__
+
+class Window():
+    """ Outcomes of the sessions that finished during one report interval. """
+
+    def __init__(self) -> None:
+        self.arrivals = 0
+        self.latencies: List[float] = []
+        self.errors = 0
+
+class LoadGenerator():
+    def __init__(self, args) -> None:
+        self.args = args
+        self.logger = LoggerAdapter(logging.getLogger("loadgen"), {})
+        self.mix = [(scenario, weight) for scenario, weight in zip(SCENARIOS, args.mix) if weight > 0]
+        self.task_ids = iter(range(1, 1 << 62))
+
+        self.users: List[User] = []
+        self.running: set = set()
+        self.dropped = 0
+        self.window = Window()
+
+        self.sessions: Dict[str, List[float]] = {}
+        self.operations: Dict[str, List[float]] = {}
+        self.results: Dict[str, Dict[str, int]] = {}
+
+    def task(self) -> HavocCheckerTaskMessage:
+        return HavocCheckerTaskMessage(
+            task_id=next(self.task_ids),
+            address=self.args.address,
+            team_id=1,
+            team_name="loadgen",
+            current_round_id=1,
+            related_round_id=1,
+            variant_id=0,
+            timeout=self.args.timeout,
+            round_length=60,
+            task_chain_id=f"loadgen_{random.getrandbits(64):x}",
+        )
+
+    def rate_at(self, elapsed: float) -> float:
+        if self.args.ramp <= 0 or elapsed >= self.args.ramp:
+            return self.args.rate
+        return self.args.start_rate + (self.args.rate - self.args.start_rate) * elapsed / self.args.ramp
+
+    async def op(self, name: str, step):
+        start = time.perf_counter()
+        result = await step
+        self.operations.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    async def register(self, client: BambiNoteClient):
+        username, password = generate_creds()
+        await self.op("register", client.register(username, password))
+
+        notes = {idx: gen_rando_bs() for idx in random.sample(range(1, 10), random.randint(1, 3))}
+        filenames = [gen_random_str() for _ in notes]
+        for (idx, note), filename in zip(notes.items(), filenames):
+            await self.op("create", client.create_note(idx, note))
+            await self.op("save", client.save_note(idx, filename))
+        await self.op("list", client.list_notes())
+
+        if len(self.users) >= MAX_KNOWN_USERS:
+            self.users[random.randrange(len(self.users))] = (username, password, notes, filenames)
+        else:
+            self.users.append((username, password, notes, filenames))
+
+    async def revisit(self, client: BambiNoteClient):
+        if not self.users:
+            return await self.register(client)
+
+        username, password, notes, filenames = random.choice(self.users)
+        await self.op("login", client.login(username, password))
+        expected = NoteList(saved=(filename.encode() for filename in filenames))
+        for slot, (note, filename) in enumerate(zip(notes.values(), filenames), 1):
+            await self.op("load", client.load_note(slot, filename))
+            expected[slot] = note
+
+        diff = (await self.op("list", client.list_notes())).verify(expected)
+        if diff:
+            raise MumbleException("Notelist differs! (" + "; ".join(diff) + ")")
+
+    async def browse(self, client: BambiNoteClient):
+        if not self.users:
+            return await self.register(client)
+
+        username, password, _, _ = random.choice(self.users)
+        try:
+            await self.op("login", client.login(username, password + "x"))
+            raise MumbleException("Login with a wrong password succeeded!")
+        except InvalidCredentialsException:
+            pass
+        await self.op("login", client.login(username, password))
+        await self.op("list", client.list_notes())
+
+    async def churn(self, client: BambiNoteClient):
+        username, password = generate_creds()
+        await self.op("register", client.register(username, password))
+        for idx in random.sample(range(1, 10), random.randint(1, 5)):
+            await self.op("create", client.create_note(idx, gen_rando_bs()))
+            await self.op("delete", client.delete_note(idx))
+        await self.op("list", client.list_notes())
+
+    async def session(self, scenario: str, scheduled: float):
+        outcome = "OK"
+        try:
+            async with BambiNoteClient(self.task(), self.logger) as client:
+                await getattr(self, scenario)(client)
+        except BaseException as e:
+            outcome = error_class(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+
+        latency = time.perf_counter() - scheduled
+        self.sessions.setdefault(scenario, []).append(latency)
+        counts = self.results.setdefault(scenario, {})
+        counts[outcome] = counts.get(outcome, 0) + 1
+        self.window.latencies.append(latency)
+        if outcome != "OK":
+            self.window.errors += 1
+
+    def arrive(self, scheduled: float):
+        self.window.arrivals += 1
+        if len(self.running) >= self.args.max_inflight:
+            # The generator's own limit, not the service's
+            self.dropped += 1
+            return
+
+        scenario = random.choices([s for s, _ in self.mix], [w for _, w in self.mix])[0]
+        session = asyncio.create_task(self.session(scenario, scheduled))
+        self.running.add(session)
+        session.add_done_callback(self.running.discard)
+
+    def report_window(self, elapsed: float):
+        window, self.window = self.window, Window()
+        latencies = window.latencies
+        print(f"{elapsed:7.1f}s  target {self.rate_at(elapsed):7.1f}/s  arrived {window.arrivals / REPORT_INTERVAL:7.1f}/s  "
+              f"done {len(latencies) / REPORT_INTERVAL:7.1f}/s  errors {window.errors:5d}  in flight {len(self.running):5d}  "
+              f"p50 {percentile(latencies, 0.5) * 1000:8.1f}ms  p99 {percentile(latencies, 0.99) * 1000:8.1f}ms")
+
+    async def run(self) -> float:
+        loop = asyncio.get_running_loop()
+        total = self.args.ramp + self.args.duration
+        start = time.perf_counter()
+        next_arrival = 0.0
+        next_report = REPORT_INTERVAL
+
+        while True:
+            elapsed = time.perf_counter() - start
+            while next_arrival <= elapsed and next_arrival < total:
+                self.arrive(start + next_arrival)
+                next_arrival += random.expovariate(max(self.rate_at(next_arrival), 1e-3))
+            if elapsed >= next_report:
+                self.report_window(next_report)
+                next_report += REPORT_INTERVAL
+            if next_arrival >= total:
+                break
+            await asyncio.sleep(max(min(next_arrival, next_report) - (time.perf_counter() - start), 0))
+
+        if self.running:
+            await asyncio.wait(list(self.running))
+        elapsed = time.perf_counter() - start
+        if self.window.latencies:
+            self.report_window(elapsed)
+        return elapsed
+
+    def report(self, elapsed: float, cpu: float):
+        print()
+        print(f"{'scenario':<12} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9}  results")
+        for label in sorted(self.sessions):
+            latencies = self.sessions[label]
+            results = ", ".join(f"{k}={v}" for k, v in sorted(self.results[label].items()))
+            print(f"{label:<12} {len(latencies):>7} {percentile(latencies, 0.5) * 1000:>9.2f} "
+                  f"{percentile(latencies, 0.9) * 1000:>9.2f} {percentile(latencies, 0.99) * 1000:>9.2f}  {results}")
+
+        print()
+        print(f"{'operation':<12} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9}")
+        for label in sorted(self.operations):
+            latencies = self.operations[label]
+            print(f"{label:<12} {len(latencies):>7} {percentile(latencies, 0.5) * 1000:>9.2f} "
+                  f"{percentile(latencies, 0.9) * 1000:>9.2f} {percentile(latencies, 0.99) * 1000:>9.2f}")
+
+        everything = [l for latencies in self.sessions.values() for l in latencies]
+        errors: Dict[str, int] = {}
+        for counts in self.results.values():
+            for outcome, count in counts.items():
+                if outcome != "OK":
+                    errors[outcome] = errors.get(outcome, 0) + count
+        ok = len(everything) - sum(errors.values())
+        print()
+        print(f"sessions:     {len(everything)} in {elapsed:.2f}s, {ok / elapsed:.1f} ok/s, {self.dropped} dropped by --max-inflight")
+        print(f"errors:       " + (", ".join(f"{k}={v}" for k, v in sorted(errors.items())) or "none"))
+        print(f"latency:      p50 {percentile(everything, 0.5) * 1000:.2f}ms, p99 {percentile(everything, 0.99) * 1000:.2f}ms")
+        print(f"loadgen cpu:  {cpu:.2f}s, {cpu / max(len(everything), 1) * 1000:.3f}ms per session")
+
+async def main(args):
+    fake = None
+    if args.address is None:
+        args.address = "127.0.1.1"
+        args.addresses = [args.address]
+        fake = spawn_fake_service(args)
+
+    # The checker's per-team admission would cap the offered load
+    checker.SCHEDULER.max_per_target = args.max_inflight
+    checker.SCHEDULER.max_total = args.max_inflight
+    checker.SCHEDULER.max_waiting = args.max_inflight
+
+    try:
+        await wait_for_service(args.address)
+        generator = LoadGenerator(args)
+        checker.NOISE_POOL.fill()
+        cpu = time.process_time()
+        elapsed = await generator.run()
+        generator.report(elapsed, time.process_time() - cpu)
+    finally:
+        if fake is not None:
+            fake.terminate()
+            fake.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=50, help="sessions per second after the ramp")
+    parser.add_argument("--start-rate", type=float, default=1, help="sessions per second at the start of the ramp")
+    parser.add_argument("--ramp", type=float, default=30, help="seconds to ramp up to --rate")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to hold --rate")
+    parser.add_argument("--mix", type=lambda value: [float(w) for w in value.split(",")], default=[3, 4, 2, 1],
+                        help="weights of " + ",".join(SCENARIOS))
+    parser.add_argument("--max-inflight", type=int, default=2000, help="sessions running at once before arrivals are dropped")
+    parser.add_argument("--timeout", type=int, default=15000, help="session timeout in ms")
+    parser.add_argument("--address", default=None, help="load a real service instead")
+    parse_fault_args(parser)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(main(args))
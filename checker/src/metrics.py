@@ -0,0 +1,337 @@
+"""
+Timing of checker tasks and of the phases inside them.
+
+Wrap a phase in `with span("login"):` anywhere below a handler. The duration
+goes into the phase histograms (one family per variant, one per team
+address), into an OpenTelemetry span next to the ones enochecker3 already
+emits, and into the per-task summary that is logged through the task's
+logger once the handler returns, fails or is cancelled:
+
+    putflag 0 against 10.1.5.1 OK in 41.2ms: admit=0.0ms connect=1.3ms banner=0.4ms db.set=2.1ms register=9.8ms ...
+
+Every gunicorn worker keeps its own histograms and periodically dumps them
+into BAMBI_METRICS_DIR, so /metrics on any worker serves the sum over all of
+them in the Prometheus text format. When a worker exits, the master folds its
+histograms into retired.json and drops its gauges.
+
+Once the first task ran, every worker also measures how late a short sleep
+on its event loop wakes up, into bambi_event_loop_lag_seconds. Whatever
+blocks the loop shows up there, as it delays every task of the worker.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from logging import LoggerAdapter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from opentelemetry import trace
+
+from enochecker3 import ChainDB, CheckerTaskMessage, MumbleException, OfflineException
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRICS_DIR = os.getenv("BAMBI_METRICS_DIR", "/tmp/bambi-metrics")
+DUMP_INTERVAL = 5
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class Histogram():
+    __slots__ = ("counts", "sum")
+
+    def __init__(self) -> None:
+        # One slot per bucket plus the +Inf overflow
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def merge(self, counts: List[int], total: float):
+        for i, count in enumerate(counts):
+            self.counts[i] += count
+        self.sum += total
+
+class Registry():
+    def __init__(self) -> None:
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.help: Dict[str, str] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self.dumper: "asyncio.Task | None" = None
+
+    def describe(self, name: str, text: str):
+        self.help[name] = text
+
+    def gauge(self, name: str, text: str, value: Callable[[], float]):
+        """ Exported as the sum of value() over all workers. """
+        self.help[name] = text
+        self.gauges[name] = value
+
+    def observe(self, name: str, labels: Labels, value: float):
+        family = self.histograms.setdefault(name, {})
+        histogram = family.get(labels)
+        if histogram is None:
+            histogram = family[labels] = Histogram()
+        histogram.observe(value)
+
+        if METRICS_DIR and self.dumper is None:
+            self.dumper = asyncio.get_running_loop().create_task(self.dump_periodically())
+
+    def snapshot(self) -> dict:
+        return {
+            "histograms": histogram_series(self.histograms),
+            "gauges": {name: value() for name, value in self.gauges.items()},
+        }
+
+    def dump(self):
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+    async def dump_periodically(self):
+        while True:
+            await asyncio.sleep(DUMP_INTERVAL)
+            try:
+                self.dump()
+            except OSError as e:
+                logging.warning("Failed to dump metrics: %s", e)
+
+    def collect(self) -> List[dict]:
+        """ Snapshots of all workers, with this one's being current. """
+        if not METRICS_DIR:
+            return [self.snapshot()]
+
+        self.dump()
+        snapshots = []
+        for entry in os.scandir(METRICS_DIR):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass
+        return snapshots
+
+    def render(self) -> str:
+        snapshots = self.collect()
+        histograms = merge_histograms(snapshots)
+        gauges: Dict[str, float] = {}
+        for snapshot in snapshots:
+            for name, value in snapshot["gauges"].items():
+                gauges[name] = gauges.get(name, 0) + value
+
+        lines = []
+        for name in sorted(histograms):
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in sorted(histograms[name].items()):
+                pairs = [f'{key}="{value}"' for key, value in labels]
+                text = "{" + ",".join(pairs) + "}" if pairs else ""
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    bucket = ",".join(pairs + [f'le="{bound}"'])
+                    lines.append(f'{name}_bucket{{{bucket}}} {cumulative}')
+                lines.append(f"{name}_sum{text} {histogram.sum}")
+                lines.append(f"{name}_count{text} {cumulative}")
+        for name in sorted(gauges):
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {gauges[name]}")
+        return "\n".join(lines) + "\n"
+
+    def retire(self, pid: int):
+        """
+        Folds the dump of an exited worker into retired.json, call from the
+        master. Its histograms stay in the totals, so they never go down, but
+        its gauges are dropped and a new worker with the same pid starts over.
+        """
+        if not METRICS_DIR:
+            return
+        path = os.path.join(METRICS_DIR, f"{pid}.json")
+        retired = os.path.join(METRICS_DIR, "retired.json")
+        snapshots = []
+        for name in (retired, path):
+            try:
+                with open(name) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass
+        histograms = merge_histograms(snapshots)
+        with open(retired + ".tmp", "w") as f:
+            json.dump({"histograms": histogram_series(histograms), "gauges": {}}, f)
+        os.replace(retired + ".tmp", retired)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def reset(self):
+        """ Drop the dumps of an earlier run, call once before forking. """
+        if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+            return
+        for entry in os.scandir(METRICS_DIR):
+            if entry.name.endswith((".json", ".tmp")):
+                os.unlink(entry.path)
+
+def histogram_series(histograms: Dict[str, Dict[Labels, Histogram]]) -> dict:
+    return {
+        name: [[list(labels), h.counts, h.sum] for labels, h in family.items()]
+        for name, family in histograms.items()
+    }
+
+def merge_histograms(snapshots: List[dict]) -> Dict[str, Dict[Labels, Histogram]]:
+    histograms: Dict[str, Dict[Labels, Histogram]] = {}
+    for snapshot in snapshots:
+        for name, series in snapshot["histograms"].items():
+            family = histograms.setdefault(name, {})
+            for labels, counts, total in series:
+                labels = tuple(tuple(label) for label in labels)
+                family.setdefault(labels, Histogram()).merge(counts, total)
+    return histograms
+
+REGISTRY = Registry()
+REGISTRY.describe("bambi_task_seconds", "Duration of checker tasks")
+REGISTRY.describe("bambi_phase_seconds", "Duration of task phases per variant")
+REGISTRY.describe("bambi_target_phase_seconds", "Duration of task phases per team address")
+REGISTRY.describe("bambi_event_loop_lag_seconds", "How late the event loop woke up from a short sleep")
+
+class LoopLagMonitor():
+    """ Sleeps interval seconds over and over and records how late it woke up. """
+
+    def __init__(self, interval=0.05) -> None:
+        self.interval = interval
+        self.task: "asyncio.Task | None" = None
+        self.samples = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            self.samples += 1
+            self.total += lag
+            self.max = max(self.max, lag)
+            REGISTRY.observe("bambi_event_loop_lag_seconds", (), lag)
+
+LOOP_LAG = LoopLagMonitor()
+
+TRACER = trace.get_tracer(__name__)
+
+class TaskTimer():
+    """ Phase durations of a single task, in the order they finished. """
+
+    def __init__(self, task: CheckerTaskMessage) -> None:
+        self.method = str(task.method)
+        self.variant = str(task.variant_id)
+        self.address = task.address
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+
+    def record(self, phase: str, duration: float):
+        self.phases.append((phase, duration))
+        REGISTRY.observe(
+            "bambi_phase_seconds",
+            (("method", self.method), ("variant", self.variant), ("phase", phase)),
+            duration,
+        )
+        REGISTRY.observe("bambi_target_phase_seconds", (("target", self.address), ("phase", phase)), duration)
+
+    def summary(self) -> str:
+        return " ".join(f"{phase}={duration * 1000:.1f}ms" for phase, duration in self.phases)
+
+CURRENT: ContextVar[Optional[TaskTimer]] = ContextVar("bambi_task_timer", default=None)
+
+@contextmanager
+def span(phase: str):
+    timer = CURRENT.get()
+    if timer is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        with TRACER.start_as_current_span(phase):
+            yield
+    finally:
+        timer.record(phase, time.perf_counter() - start)
+
+class TimedChainDB(ChainDB):
+    """ Times the calls to the wrapped (possibly cached) ChainDB. """
+
+    def __init__(self, db: ChainDB) -> None:
+        self.db = db
+        self.collection = db.collection
+        self.task_chain_id = db.task_chain_id
+
+    async def get(self, key: str):
+        with span("db.get"):
+            return await self.db.get(key)
+
+    async def set(self, key: str, val) -> None:
+        with span("db.set"):
+            await self.db.set(key, val)
+
+def outcome(e: BaseException) -> str:
+    if isinstance(e, MumbleException):
+        return "MUMBLE"
+    if isinstance(e, OfflineException):
+        return "OFFLINE"
+    if isinstance(e, (asyncio.CancelledError, TimeoutError)):
+        return "TIMEOUT"
+    return "ERROR"
+
+def timed(f):
+    """
+    Times a handler as a whole. Keeps its signature for enochecker3's
+    dependency injection, which passes everything positionally.
+    """
+    @wraps(f)
+    async def wrapper(*args):
+        task = next(arg for arg in args if isinstance(arg, CheckerTaskMessage))
+        logger = next((arg for arg in args if isinstance(arg, LoggerAdapter)), None)
+
+        LOOP_LAG.start()
+        timer = TaskTimer(task)
+        token = CURRENT.set(timer)
+        result = "OK"
+        try:
+            return await f(*args)
+        except BaseException as e:
+            result = outcome(e)
+            raise
+        finally:
+            CURRENT.reset(token)
+            duration = time.perf_counter() - timer.started
+            REGISTRY.observe(
+                "bambi_task_seconds",
+                (("method", timer.method), ("variant", timer.variant), ("result", result)),
+                duration,
+            )
+            if logger is not None:
+                logger.info("%s %s against %s %s in %.1fms: %s", timer.method, timer.variant,
+                            timer.address, result, duration * 1000, timer.summary())
+    return wrapper
+
+def instrument(variants: Dict[object, Dict[int, Callable]]):
+    """ Wraps every registered handler, call after the last one was registered. """
+    for handlers in variants.values():
+        for variant, f in handlers.items():
+            handlers[variant] = timed(f)
@@ -0,0 +1,94 @@
+"""
+Keeps CPU-bound work away from the event loop.
+
+Two things run outside of it now:
+
+- Log records. enochecker3's handler writes every record to stdout right
+  in the task that logged it, and with OTEL_EXPORTER_OTLP_ENDPOINT set its
+  telemetry adds an OpenTelemetry handler that turns every record into a
+  log record for the exporter. After offload_logging() the record is only
+  put on a queue, a listener thread does the formatting and writing.
+- Noise pool refills, on OFFLOAD: a fixed number of threads, or of
+  processes with BAMBI_OFFLOAD_PROCESSES, which keeps Faker from even
+  competing for the GIL. Every process loads Faker itself, which costs
+  memory, so threads are the default.
+
+Flag searching stays on the loop, a listing is searched in well under a
+microsecond per note, much less than any hand-off would cost.
+bambi_event_loop_lag_seconds in metrics.py shows whether the loop stalls.
+"""
+import atexit
+import logging
+import multiprocessing
+import os
+
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Optional
+
+class Offloader(Executor):
+    """
+    Executor with a fixed number of workers that is only started on first
+    use, and started anew in a forked child. The checker creates it at
+    import, in the gunicorn master, but it runs in the workers.
+    """
+
+    def __init__(self, workers=1, processes=False) -> None:
+        self.workers = workers
+        self.processes = processes
+        self.pid: Optional[int] = None
+        self._executor: Optional[Executor] = None
+        self.jobs = 0
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None or self.pid != os.getpid():
+            if self.processes:
+                # A fresh interpreter per worker instead of a fork of a
+                # process with an event loop and threads
+                context = multiprocessing.get_context("forkserver")
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=context)
+            else:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="offload")
+            self.pid = os.getpid()
+        return self._executor
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        self.jobs += 1
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        if self._executor is not None and self.pid == os.getpid():
+            self._executor.shutdown(wait, cancel_futures=cancel_futures)
+        self._executor = None
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queues the record untouched: unlike QueueHandler, which formats the
+    message before queueing, so it could be pickled. The queue never leaves
+    the process, so the listener can do all of the formatting.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+_listener: Optional[QueueListener] = None
+
+def offload_logging(logger: Optional[logging.Logger] = None) -> QueueListener:
+    """
+    Moves the handlers of logger (the root logger) to a listener thread.
+    Calling it again moves the handlers added since onto the same listener,
+    the telemetry handler only shows up once the app lifespan started.
+    """
+    global _listener
+    logger = logger or logging.getLogger()
+    if _listener is None:
+        _listener = QueueListener(SimpleQueue(), respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+    added = [h for h in logger.handlers if not isinstance(h, DeferredQueueHandler)]
+    # The listener thread only ever reads the attribute, so swapping the tuple is safe
+    _listener.handlers = _listener.handlers + tuple(added)
+    logger.handlers = [DeferredQueueHandler(_listener.queue)]
+    return _listener
@@ -0,0 +1,137 @@
+import asyncio
+import random
+import threading
+
+from collections import deque
+from concurrent.futures import Executor
+from typing import Deque, List, Optional
+
+# Faker instance of a process pool worker, see generate_phrases
+_faker = None
+
+def make_faker():
+    import faker
+    return faker.Faker(faker.config.AVAILABLE_LOCALES)
+
+def phrases(fake, count: int, max_len: int) -> List[bytes]:
+    result = []
+    for _ in range(count):
+        if random.getrandbits(1):
+            phrase = fake.bs()
+        else:
+            phrase = fake.catch_phrase()
+        result.append(phrase.encode()[:max_len])
+    return result
+
+# Until Faker delivered its first batch, phrases are thrown together from these
+FALLBACK_WORDS = (
+    ("streamline", "leverage", "synergize", "incubate", "monetize", "revolutionize", "deploy", "orchestrate"),
+    ("scalable", "seamless", "end-to-end", "proactive", "robust", "holistic", "mission-critical", "virtual"),
+    ("platforms", "paradigms", "deliverables", "mindshare", "solutions", "infrastructures", "web services", "synergies"),
+)
+
+def fallback_phrase(max_len: int) -> bytes:
+    return " ".join(random.choice(words) for words in FALLBACK_WORDS).encode()[:max_len]
+
+def generate_phrases(count: int, max_len: int) -> List[bytes]:
+    """ Entry point for process pools, every process builds its own Faker. """
+    global _faker
+    if _faker is None:
+        _faker = make_faker()
+    return phrases(_faker, count, max_len)
+
+class StringPool():
+    """
+    Hands out random strings over charset. Characters are drawn in large
+    chunks, so a task only slices a prepared string instead of calling
+    random.choices itself.
+    """
+
+    def __init__(self, charset: str, chunk_size=0x4000) -> None:
+        self.charset = charset
+        self.chunk_size = chunk_size
+        self.chunk = ""
+        self.pos = 0
+
+    def take(self, k: int) -> str:
+        if self.pos + k > len(self.chunk):
+            self.chunk = "".join(random.choices(self.charset, k=max(k, self.chunk_size)))
+            self.pos = 0
+
+        result = self.chunk[self.pos:self.pos + k]
+        self.pos += k
+        return result
+
+class PhrasePool():
+    """
+    Pool of pre-generated Faker bs/catch phrases, already encoded and cut to
+    max_len bytes. Faker (with all of its locales) is only imported once the
+    first phrase is needed, and the pool is topped up from a worker thread
+    whenever it drops below low_water. take() never touches Faker or the
+    lock itself: building the all-locale Faker takes seconds, and a filling
+    thread holds the lock for as long, so an empty pool hands out a
+    fallback_phrase() while the refill runs.
+
+    With an Offloader running processes as executor, refills run
+    generate_phrases in there instead, with a Faker of its own, and don't
+    compete with the event loop for the GIL at all.
+    """
+
+    def __init__(self, max_len=0x40, size=2048, low_water=512, batch=64, executor: Optional[Executor] = None) -> None:
+        self.max_len = max_len
+        self.size = size
+        self.low_water = low_water
+        self.batch = batch
+        self.executor = executor
+
+        self.phrases: Deque[bytes] = deque()
+        self.faker = None
+        self.lock = threading.Lock()
+        self.refill: "asyncio.Future | None" = None
+
+    def generate(self, count: int) -> List[bytes]:
+        with self.lock:
+            if self.faker is None:
+                self.faker = make_faker()
+            return phrases(self.faker, count, self.max_len)
+
+    def reseed(self):
+        # Forked workers would otherwise all continue the same Faker sequence
+        if self.faker is not None:
+            self.faker.seed_instance(random.getrandbits(64))
+
+    def fill(self):
+        while len(self.phrases) < self.size:
+            self.phrases.extend(self.generate(self.batch))
+
+    def prefill(self):
+        """ fill() for the background thread a worker starts with. """
+        if getattr(self.executor, "processes", False):
+            count = self.size - len(self.phrases)
+            self.phrases.extend(self.executor.submit(generate_phrases, count, self.max_len).result())
+        else:
+            self.fill()
+
+    def take(self) -> bytes:
+        if not self.phrases:
+            if self.refill is None or self.refill.done():
+                self.start_refill()
+            return fallback_phrase(self.max_len)
+
+        phrase = self.phrases.popleft()
+        if len(self.phrases) < self.low_water and (self.refill is None or self.refill.done()):
+            self.start_refill()
+        return phrase
+
+    def start_refill(self):
+        loop = asyncio.get_running_loop()
+        if not getattr(self.executor, "processes", False):
+            self.refill = loop.run_in_executor(self.executor, self.fill)
+            return
+
+        self.refill = loop.run_in_executor(self.executor, generate_phrases, self.size - len(self.phrases), self.max_len)
+        self.refill.add_done_callback(self.refilled)
+
+    def refilled(self, refill: asyncio.Future):
+        if not refill.cancelled() and refill.exception() is None:
+            self.phrases.extend(refill.result())
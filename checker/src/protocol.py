@@ -0,0 +1,227 @@
+import asyncio
+
+from asyncio import IncompleteReadError, LimitOverrunError, StreamReader
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+
+from enochecker3 import MumbleException
+
+PROMPT = b"> "
+NOTES_BEGIN = b"Currently Loaded:"
+SAVED_BEGIN = b"Saved Notes:"
+NOTES_END = b"===== [End of Notes] =====\n"
+NOTE_COUNT = 10
+
+class Menu(NamedTuple):
+    title: bytes
+    options: Tuple[bytes, ...]
+
+class LoadedNote(NamedTuple):
+    idx: int
+    text: bytes
+
+class SavedNote(NamedTuple):
+    filename: bytes
+
+Event = Union[Menu, LoadedNote, SavedNote]
+
+class NoteList():
+    """
+    A note listing: the text of every slot, None where it is empty, and the
+    saved filenames, both in listing order and as a set for lookups.
+
+    Expectations are NoteLists as well, with None meaning "don't care" for a
+    slot. Players can add saved files and notes of their own, so verify only
+    checks that expected is a subset of the listing.
+    """
+    __slots__ = ("slots", "filenames", "saved")
+
+    def __init__(self, slots: Optional[List[Optional[bytes]]] = None, saved: Iterable[bytes] = ()) -> None:
+        self.slots = slots if slots is not None else [None] * NOTE_COUNT
+        self.filenames = list(saved)
+        self.saved: Set[bytes] = set(self.filenames)
+
+    @classmethod
+    def from_events(cls, events: Iterable[Event]) -> "NoteList":
+        notes = cls()
+        for event in events:
+            if isinstance(event, LoadedNote):
+                if not 0 <= event.idx < NOTE_COUNT:
+                    raise MumbleException("Failed to list Notes!")
+                notes.slots[event.idx] = event.text
+            else:
+                notes.add_saved(event.filename)
+        return notes
+
+    def __getitem__(self, idx: int) -> Optional[bytes]:
+        return self.slots[idx]
+
+    def __setitem__(self, idx: int, text: Optional[bytes]):
+        self.slots[idx] = text
+
+    def __repr__(self) -> str:
+        return f"NoteList({self.slots!r}, {self.filenames!r})"
+
+    def add_saved(self, filename: bytes):
+        self.filenames.append(filename)
+        self.saved.add(filename)
+
+    def copy(self) -> "NoteList":
+        return NoteList(list(self.slots), self.filenames)
+
+    def verify(self, expected: "NoteList") -> List[str]:
+        """
+        Everything expected that is missing from this listing, one entry per
+        slot or file. Only says which slot differs, not what it held, so it
+        can go straight into the message teams get to see.
+        """
+        diff = []
+        for idx, (want, got) in enumerate(zip(expected.slots, self.slots)):
+            if want is None or want == got:
+                continue
+            diff.append(f"slot {idx} is empty" if got is None else f"slot {idx} differs")
+        missing = expected.saved - self.saved
+        if missing:
+            diff.append("not saved: " + ", ".join(sorted(f.decode(errors="replace") for f in missing)))
+        return diff
+
+class ProtocolReader():
+    """
+    Incremental reader for the bambi-notes menu protocol.
+
+    Everything received from the service is kept in a single buffer, and a
+    search only ever rescans the bytes that arrived since the previous
+    attempt, no matter how the output was split into TCP segments. Whole menus
+    and note listings are tokenized in one pass over a memoryview of that
+    buffer. All positions below are relative to the first unread byte.
+
+    If timeout is set, every wait for more data gives up with a TimeoutError
+    after that many seconds without a byte from the service. Once sent() was
+    called, the time until the next data arrives is passed to on_reply.
+    Every chunk received is passed to tap, if set.
+    """
+
+    def __init__(self, reader: StreamReader, chunk_size=0x4000, limit=0x400000) -> None:
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self.buffer = bytearray()
+        self.offset = 0
+
+        self.timeout: Optional[float] = None
+        self.on_reply: Optional[Callable[[float], None]] = None
+        self.sent_at: Optional[float] = None
+        self.tap: Optional[Callable[[bytes], None]] = None
+
+    def sent(self):
+        """ Starts a round trip sample, unless one is running already. """
+        if self.sent_at is None and self.on_reply is not None:
+            self.sent_at = asyncio.get_running_loop().time()
+
+    def available(self) -> int:
+        return len(self.buffer) - self.offset
+
+    def pending(self) -> bytes:
+        return bytes(self.buffer[self.offset:])
+
+    async def fill(self):
+        if self.offset:
+            del self.buffer[:self.offset]
+            self.offset = 0
+
+        if len(self.buffer) > self.limit:
+            raise LimitOverrunError("Service output exceeds the buffer limit", len(self.buffer))
+
+        if self.timeout is None:
+            chunk = await self.reader.read(self.chunk_size)
+        else:
+            async with asyncio.timeout(self.timeout):
+                chunk = await self.reader.read(self.chunk_size)
+        if not chunk:
+            raise IncompleteReadError(self.pending(), None)
+        if self.tap is not None:
+            self.tap(chunk)
+        self.buffer += chunk
+
+        if self.sent_at is not None:
+            self.on_reply(asyncio.get_running_loop().time() - self.sent_at)
+            self.sent_at = None
+
+    async def find(self, separator: bytes, start=0) -> int:
+        """
+        Waits until separator shows up at or behind start and returns the
+        position right after it, without consuming anything.
+        """
+        while True:
+            pos = self.buffer.find(separator, self.offset + start)
+            if pos >= 0:
+                return pos - self.offset + len(separator)
+            start = max(start, self.available() - len(separator) + 1)
+            await self.fill()
+
+    async def find_line(self, line: bytes, start=0) -> int:
+        """ Like find, but only matches line if it starts a new line. """
+        while True:
+            end = await self.find(line, start)
+            begin = end - len(line)
+            if begin == 0 or self.buffer[self.offset + begin - 1] == 0xa:
+                return end
+            start = begin + 1
+
+    def consume(self, end: int) -> bytes:
+        with memoryview(self.buffer) as view:
+            result = bytes(view[self.offset:self.offset + end])
+        self.offset += end
+        return result
+
+    async def readuntil(self, separator=b"\n") -> bytes:
+        return self.consume(await self.find(separator))
+
+    async def readexactly(self, n: int) -> bytes:
+        while self.available() < n:
+            await self.fill()
+        return self.consume(n)
+
+    async def read_menu(self, title: bytes) -> Menu:
+        """
+        Skips ahead to the menu called title and returns its option lines.
+        The trailing prompt is left unread for the next command.
+        """
+        await self.readuntil(b"===== [" + title + b"] =====\n")
+        end = await self.find(PROMPT) - len(PROMPT)
+        options = self.consume(end).split(b"\n")
+        # The last option is newline terminated as well
+        return Menu(title, tuple(options[:-1]))
+
+    async def read_note_list(self, header: bytes) -> NoteList:
+        """
+        Skips ahead to header and tokenizes the note listing behind it, up to
+        and including the end marker.
+        """
+        await self.readuntil(header)
+        end = await self.find_line(NOTES_END)
+        listing = self.consume(end)
+        return NoteList.from_events(tokenize_note_list(listing[:-len(NOTES_END)]))
+
+def tokenize_note_list(listing: bytes) -> Iterator[Event]:
+    lines = listing.split(b"\n")
+    if lines.pop() != b"":
+        raise MumbleException("Failed to list Notes!")
+
+    section = None
+    for line in lines:
+        if line == NOTES_BEGIN and section is None:
+            section = NOTES_BEGIN
+        elif line == SAVED_BEGIN and section is not SAVED_BEGIN:
+            section = SAVED_BEGIN
+        elif section is NOTES_BEGIN and line.startswith(b"    "):
+            idx, sep, text = line[4:].partition(b" | ")
+            try:
+                if not sep:
+                    raise ValueError
+                yield LoadedNote(int(idx), text)
+            except ValueError:
+                raise MumbleException("Failed to list Notes!")
+        elif section is SAVED_BEGIN and line.startswith(b" | "):
+            yield SavedNote(line[3:])
+        else:
+            raise MumbleException("Failed to list Notes!")
@@ -0,0 +1,289 @@
+"""
+Spreads checker tasks over several checker instances.
+
+The engine talks to the router exactly like to a single checker. Every task
+is forwarded to the instance that owns hash(address) on a consistent hash
+ring, so all tasks against one team, and with them putflag and getflag of
+every chain, land on the same instance. Its chain cache, round trip
+estimates and session pool stay warm, and BAMBI_MAX_TASKS_PER_TARGET still
+bounds the connections to a team as a whole, not once per instance. With
+a few dozen teams and REPLICAS points per instance they spread evenly
+enough, and adding or removing an instance only moves the teams next to
+it on the ring.
+
+An instance that refuses connections is skipped for
+BAMBI_ROUTER_RETRY_AFTER seconds, its tasks go to the next instance on the
+ring in the meantime. A task that was written to an instance is never
+resent, the engine gets whatever that instance answered, or a 502 if the
+connection broke. Idle connections are dropped after
+BAMBI_ROUTER_IDLE_TIMEOUT seconds, well before the instances' keepalive in
+gunicorn.conf.py closes them, so a request doesn't go out on a connection
+the instance is about to close.
+
+The router only looks at two fields of a task and passes the bytes through
+otherwise, so it is a bare ASGI app with a small keep-alive HTTP/1.1 client
+instead of FastAPI and httpx, which cost several times the CPU per task.
+
+    BAMBI_ROUTER_BACKENDS=http://checker-1:8000,http://checker-2:8000 uvicorn router:app --port 8000
+
+See docker-compose.sharded.yaml for the deployment.
+"""
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import time
+
+from asyncio import StreamReader, StreamWriter
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+BACKENDS = [url.strip().rstrip("/") for url in os.getenv("BAMBI_ROUTER_BACKENDS", "").split(",") if url.strip()]
+# Points per instance on the ring, more spread the keys more evenly
+REPLICAS = int(os.getenv("BAMBI_ROUTER_REPLICAS", 160))
+RETRY_AFTER = float(os.getenv("BAMBI_ROUTER_RETRY_AFTER", 5))
+# Waited for on top of the task's own timeout, the instance gives up before that
+TIMEOUT_SLACK = 5.0
+CONNECT_TIMEOUT = 2.0
+MAX_IDLE_PER_BACKEND = 256
+# Has to stay below the instances' keepalive
+IDLE_TIMEOUT = float(os.getenv("BAMBI_ROUTER_IDLE_TIMEOUT", 60))
+
+class BackendDown(Exception):
+    pass
+
+def ring_point(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+def task_key(task: dict) -> str:
+    return str(task.get("address"))
+
+class HashRing():
+    def __init__(self, nodes: List[str], replicas=REPLICAS) -> None:
+        self.nodes = list(nodes)
+        points = sorted((ring_point(f"{node}#{replica}"), node) for node in self.nodes for replica in range(replicas))
+        self.points = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def candidates(self, key: str) -> Iterator[str]:
+        """ Every node once, starting with the owner of key and going around the ring. """
+        if not self.points:
+            return
+        start = bisect.bisect(self.points, ring_point(key))
+        seen = set()
+        for step in range(len(self.points)):
+            node = self.owners[(start + step) % len(self.points)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+class Backend():
+    """ One checker instance and the idle keep-alive connections to it. """
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        parts = urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 80
+        # Connections with when they went idle, the most recent last
+        self.idle: List[Tuple[StreamReader, StreamWriter, float]] = []
+        self.down_until = 0.0
+
+        self.forwarded = 0
+        self.failed = 0
+        self.rerouted = 0
+
+    def up(self, now: float) -> bool:
+        return self.down_until <= now
+
+    async def connect(self) -> Tuple[StreamReader, StreamWriter]:
+        try:
+            async with asyncio.timeout(CONNECT_TIMEOUT):
+                return await asyncio.open_connection(self.host, self.port)
+        except (OSError, TimeoutError) as e:
+            raise BackendDown(f"{self.url}: {e!r}")
+
+    async def request(self, method: str, path: str, body: bytes, timeout: float) -> Tuple[int, bytes, bytes]:
+        """
+        Status, content type and body. Raises BackendDown if the request
+        can't have reached the instance, so it may go to another one.
+        """
+        head = (
+            f"{method} {path} HTTP/1.1\r\nhost: {self.host}\r\n"
+            f"content-type: application/json\r\ncontent-length: {len(body)}\r\n\r\n"
+        ).encode()
+
+        self.drop_stale(time.monotonic() - IDLE_TIMEOUT)
+        while self.idle:
+            reader, writer, _ = self.idle.pop()
+            if reader.at_eof() or writer.is_closing():
+                # Closed by the instance before anything was written to it
+                writer.close()
+                continue
+            return await self.exchange((reader, writer), head + body, timeout)
+        return await self.exchange(await self.connect(), head + body, timeout)
+
+    def drop_stale(self, cutoff: float):
+        """ Closes the connections that went idle before cutoff. """
+        stale = 0
+        while stale < len(self.idle) and self.idle[stale][2] < cutoff:
+            self.idle[stale][1].close()
+            stale += 1
+        del self.idle[:stale]
+
+    async def exchange(self, connection: Tuple[StreamReader, StreamWriter], request: bytes, timeout: float):
+        reader, writer = connection
+        keep = False
+        try:
+            writer.write(request)
+            async with asyncio.timeout(timeout):
+                try:
+                    status_line = await reader.readuntil(b"\r\n")
+                except asyncio.IncompleteReadError as e:
+                    if not e.partial:
+                        raise ConnectionResetError("closed before replying")
+                    raise
+                status = int(status_line.split(b" ", 2)[1])
+
+                headers: Dict[bytes, bytes] = {}
+                while True:
+                    line = await reader.readuntil(b"\r\n")
+                    if line == b"\r\n":
+                        break
+                    name, _, value = line.partition(b":")
+                    headers[name.strip().lower()] = value.strip()
+
+                if headers.get(b"transfer-encoding", b"").lower() == b"chunked":
+                    content = await read_chunked(reader)
+                else:
+                    content = await reader.readexactly(int(headers.get(b"content-length", b"0")))
+            keep = headers.get(b"connection", b"").lower() != b"close"
+            return status, headers.get(b"content-type", b"application/json"), content
+        finally:
+            if keep and len(self.idle) < MAX_IDLE_PER_BACKEND:
+                self.idle.append((reader, writer, time.monotonic()))
+            else:
+                writer.close()
+
+async def read_chunked(reader: StreamReader) -> bytes:
+    content = bytearray()
+    while True:
+        size = int((await reader.readuntil(b"\r\n")).split(b";", 1)[0], 16)
+        if not size:
+            # Trailers, if any, end with an empty line
+            while await reader.readuntil(b"\r\n") != b"\r\n":
+                pass
+            return bytes(content)
+        content += await reader.readexactly(size)
+        await reader.readexactly(2)
+
+class Router():
+    def __init__(self, backends: List[str], replicas=REPLICAS, retry_after=RETRY_AFTER) -> None:
+        self.backends: Dict[str, Backend] = {url: Backend(url) for url in backends}
+        self.ring = HashRing(backends, replicas)
+        self.retry_after = retry_after
+        self.service_info: Optional[bytes] = None
+
+    def route(self, key: str) -> List[Backend]:
+        """ Instances to try for key: those up in ring order, then those down. """
+        now = time.monotonic()
+        backends = [self.backends[url] for url in self.ring.candidates(key)]
+        return [b for b in backends if b.up(now)] + [b for b in backends if not b.up(now)]
+
+    async def forward(self, key: str, method: str, path: str, body: bytes, timeout: float) -> Tuple[int, bytes, bytes]:
+        for attempt, backend in enumerate(self.route(key)):
+            try:
+                response = await backend.request(method, path, body, timeout)
+            except BackendDown as e:
+                backend.failed += 1
+                now = time.monotonic()
+                if backend.up(now):
+                    logging.warning("router: instance down, rerouting its tasks for %.0fs: %s", self.retry_after, e)
+                backend.down_until = now + self.retry_after
+                continue
+            except TimeoutError:
+                return 504, b"text/plain", f"{backend.url} did not answer in time".encode()
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                # It may have run the task, so no other instance gets it
+                return 502, b"text/plain", f"{backend.url}: {e!r}".encode()
+
+            backend.forwarded += 1
+            if attempt:
+                backend.rerouted += 1
+            return response
+        return 502, b"text/plain", b"No checker instance is reachable"
+
+    async def task(self, body: bytes) -> Tuple[int, bytes, bytes]:
+        try:
+            task = json.loads(body)
+        except ValueError:
+            return 400, b"text/plain", b"Invalid task"
+        timeout = task.get("timeout", 30000) / 1000 + TIMEOUT_SLACK
+        return await self.forward(task_key(task), "POST", "/", body, timeout)
+
+    async def service(self) -> Tuple[int, bytes, bytes]:
+        if self.service_info is None:
+            status, content_type, content = await self.forward("", "GET", "/service", b"", TIMEOUT_SLACK)
+            if status != 200:
+                return status, content_type, content
+            # Every instance runs the same checker
+            self.service_info = content
+        return 200, b"application/json", self.service_info
+
+    def metrics(self) -> str:
+        lines = []
+        for name, text, attr in (
+            ("bambi_router_forwarded", "Tasks forwarded to the instance", "forwarded"),
+            ("bambi_router_rerouted", "Tasks the instance got because the owner was down", "rerouted"),
+            ("bambi_router_failed", "Failed connects to the instance", "failed"),
+        ):
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} counter")
+            for backend in self.backends.values():
+                lines.append(f'{name}{{instance="{backend.url}"}} {getattr(backend, attr)}')
+        now = time.monotonic()
+        lines.append("# HELP bambi_router_up Whether the instance is taking tasks")
+        lines.append("# TYPE bambi_router_up gauge")
+        for backend in self.backends.values():
+            lines.append(f'bambi_router_up{{instance="{backend.url}"}} {int(backend.up(now))}')
+        return "\n".join(lines) + "\n"
+
+ROUTER = Router(BACKENDS)
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+
+    method, path = scope["method"], scope["path"]
+    if method == "POST" and path == "/":
+        status, content_type, content = await ROUTER.task(bytes(body))
+    elif method == "GET" and path == "/service":
+        status, content_type, content = await ROUTER.service()
+    elif method == "GET" and path == "/metrics":
+        status, content_type, content = 200, b"text/plain; version=0.0.4", ROUTER.metrics().encode()
+    else:
+        status, content_type, content = 404, b"text/plain", b"Not Found"
+
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(content)).encode())],
+    })
+    await send({"type": "http.response.body", "body": content})
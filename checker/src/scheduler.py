@@ -0,0 +1,122 @@
+import asyncio
+
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict
+
+from enochecker3 import InternalErrorException
+
+class Target():
+    __slots__ = ("active", "waiters", "queued")
+
+    def __init__(self) -> None:
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.queued = False
+
+class TargetScheduler():
+    """
+    Admission control for service connections.
+
+    Every address may only have max_per_target connections open at once and
+    the whole worker no more than max_total. Tasks beyond that wait in a FIFO
+    queue per address, and whenever a slot frees up the queues are served
+    round-robin, so a single slow team can neither hog the worker's sockets
+    nor delay the tasks for everyone else. Waiting is bounded by whatever
+    deadline the caller is running under; if more than max_waiting tasks
+    queue up for one address, new ones are turned away right away. That
+    is the checker falling behind, not the team's service, so they end in
+    INTERNAL_ERROR rather than OFFLINE.
+    """
+
+    def __init__(self, max_per_target=16, max_total=512, max_waiting=64) -> None:
+        self.max_per_target = max_per_target
+        self.max_total = max_total
+        self.max_waiting = max_waiting
+
+        self.targets: Dict[str, Target] = {}
+        self.ready: Deque[str] = deque()
+        self.active = 0
+        self.rejected = 0
+
+    def can_admit(self, target: Target) -> bool:
+        return target.active < self.max_per_target and self.active < self.max_total
+
+    def admit(self, target: Target):
+        target.active += 1
+        self.active += 1
+
+    async def acquire(self, address: str):
+        target = self.targets.setdefault(address, Target())
+        if not target.waiters and self.can_admit(target):
+            self.admit(target)
+            return
+
+        if len(target.waiters) >= self.max_waiting:
+            self.rejected += 1
+            self.forget(address)
+            raise InternalErrorException(f"Checker overloaded, too many tasks queued for {address}")
+
+        waiter = asyncio.get_running_loop().create_future()
+        target.waiters.append(waiter)
+        if not target.queued:
+            target.queued = True
+            self.ready.append(address)
+
+        try:
+            await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # Admitted just as we were cancelled, pass the slot on
+                self.release(address)
+            else:
+                if waiter in target.waiters:
+                    target.waiters.remove(waiter)
+                self.forget(address)
+            raise
+
+    def release(self, address: str):
+        target = self.targets[address]
+        target.active -= 1
+        self.active -= 1
+        self.wake()
+        self.forget(address)
+
+    def forget(self, address: str):
+        target = self.targets.get(address)
+        if target is not None and not target.active and not target.waiters:
+            if target.queued:
+                # A new Target for the address would be queued a second time
+                self.ready.remove(address)
+            del self.targets[address]
+
+    def wake(self):
+        for _ in range(len(self.ready)):
+            if self.active >= self.max_total:
+                return
+
+            address = self.ready.popleft()
+            target = self.targets.get(address)
+            if target is None:
+                continue
+
+            # Waiters that were cancelled haven't had the chance to leave yet
+            while target.waiters and target.waiters[0].cancelled():
+                target.waiters.popleft()
+
+            if target.waiters and target.active < self.max_per_target:
+                self.admit(target)
+                target.waiters.popleft().set_result(None)
+
+            if target.waiters:
+                self.ready.append(address)
+            else:
+                target.queued = False
+
+    @asynccontextmanager
+    async def slot(self, address: str):
+        await self.acquire(address)
+        try:
+            yield
+        finally:
+            self.release(address)
@@ -0,0 +1,99 @@
+from asyncio import StreamReader, StreamWriter
+import asyncio
+import time
+
+from typing import Dict, List, Optional
+
+from protocol import ProtocolReader
+
+class Session():
+    """ An open service connection together with everything read ahead on it. """
+
+    def __init__(self, reader: StreamReader, writer: StreamWriter, stream: ProtocolReader) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.stream = stream
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+    def alive(self) -> bool:
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    async def close(self):
+        try:
+            # Quit the menu, so the service process exits right away
+            if not self.writer.is_closing():
+                self.writer.write(b"0\n")
+            self.writer.close()
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+class SessionPool():
+    """
+    Keeps idle, unauthenticated connections per address around, so the next
+    task against the same team can skip the connect, the handoff to a child
+    of the service's prefork front end and its exec of the service. A session
+    is only handed back if the next thing to read on it is the
+    unauthenticated menu; it is dropped once it has been idle for
+    idle_timeout seconds or is older than max_age seconds, which has to stay
+    well below the service's alarm(120).
+    """
+
+    def __init__(self, idle_timeout=10.0, max_age=30.0, max_idle_per_address=2) -> None:
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.max_idle_per_address = max_idle_per_address
+        self.sessions: Dict[str, List[Session]] = {}
+        self.reaper: Optional[asyncio.Task] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+        self.closing = set()
+
+    def expired_at(self, session: Session, now: float) -> bool:
+        return now - session.last_used > self.idle_timeout or now - session.created > self.max_age
+
+    def acquire(self, address: str) -> Optional[Session]:
+        sessions = self.sessions.get(address, [])
+        now = time.monotonic()
+        while sessions:
+            session = sessions.pop()
+            if session.alive() and not self.expired_at(session, now):
+                self.hits += 1
+                return session
+            self.discard(session)
+
+        self.misses += 1
+        return None
+
+    def release(self, address: str, session: Session):
+        sessions = self.sessions.setdefault(address, [])
+        if not session.alive() or len(sessions) >= self.max_idle_per_address:
+            self.discard(session)
+            return
+
+        session.last_used = time.monotonic()
+        sessions.append(session)
+
+        if self.reaper is None or self.reaper.done():
+            self.reaper = asyncio.create_task(self.reap())
+
+    def discard(self, session: Session):
+        self.dropped += 1
+        task = asyncio.create_task(session.close())
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    async def reap(self):
+        while self.sessions:
+            await asyncio.sleep(self.idle_timeout / 2)
+
+            now = time.monotonic()
+            for address, sessions in list(self.sessions.items()):
+                for session in [s for s in sessions if self.expired_at(s, now) or not s.alive()]:
+                    sessions.remove(session)
+                    self.discard(session)
+                if not sessions:
+                    del self.sessions[address]
@@ -0,0 +1,43 @@
+"""
+Startup timing of the checker. Import this before anything heavy, then
+mark() the end of each phase; the gunicorn hooks in gunicorn.conf.py log the
+breakdown once the master is ready and again for every worker. For a
+per-module view run `python -X importtime -c "import checker"`.
+"""
+import os
+import time
+
+STARTED = time.perf_counter()
+
+phases = []
+last = STARTED
+forked_at = None
+
+def mark(phase: str):
+    global last
+    now = time.perf_counter()
+    phases.append((phase, now - last))
+    last = now
+
+def forked():
+    global forked_at
+    forked_at = time.perf_counter()
+
+def rss_kib() -> int:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return -1
+
+def summary() -> str:
+    breakdown = " ".join(f"{phase}={duration:.3f}s" for phase, duration in phases)
+    return f"startup: {breakdown} total={last - STARTED:.3f}s rss={rss_kib()}KiB"
+
+def worker_summary() -> str:
+    since_fork = time.perf_counter() - forked_at if forked_at is not None else float("nan")
+    return f"worker {os.getpid()} ready: {since_fork:.3f}s after fork, " \
+        f"{time.perf_counter() - STARTED:.3f}s after start, rss={rss_kib()}KiB"
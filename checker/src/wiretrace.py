@@ -0,0 +1,449 @@
+"""
+Binary record of everything a checker exchanged with the services.
+
+With BAMBI_TRACE_DIR set, every BambiNoteClient session is written to a
+ring buffer file there: an open frame with the task's metadata, one frame
+per write to and per read from the service, with the bytes exactly as they
+went over the wire, and a close frame with the outcome. Recording a frame
+is a struct.pack_into and a slice copy into a shared memory mapping, no
+syscall, no formatting, no logging.
+
+Each worker locks one of trace-0.ring ... trace-<N-1>.ring and appends to
+it, across restarts as well. A file has a fixed size, once it is full the
+oldest frames are overwritten, so the disk space used is bounded by
+BAMBI_TRACE_FILES * BAMBI_TRACE_SIZE no matter how long the CTF runs.
+
+Frames never wrap around the end of the file, and every one carries a CRC,
+so a reader can pick up the oldest intact frame after the write position,
+even in a file that is being written to or was left behind by a crash.
+
+    python wiretrace.py list /tmp/bambi-trace --address 10.1.5.1
+    python wiretrace.py show /tmp/bambi-trace --task 4711
+    python wiretrace.py replay /tmp/bambi-trace --chain putflag_s0_r12_t5_i0
+
+replay runs the BambiNoteClient commands the checker sent in a session
+against the service output it got, every read in the segment it arrived
+in, and prints what each command returned and where the client failed.
+"""
+import argparse
+import asyncio
+import fcntl
+import json
+import mmap
+import os
+import random
+import re
+import struct
+import time
+import zlib
+
+from collections import deque
+from typing import Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+TRACE_DIR = os.getenv("BAMBI_TRACE_DIR", "")
+TRACE_SIZE = int(os.getenv("BAMBI_TRACE_SIZE", 64)) << 20
+TRACE_FILES = int(os.getenv("BAMBI_TRACE_FILES", 16))
+
+MAGIC = b"BAMBIWT1"
+# magic, capacity of the data area, logical bytes written. The write
+# position is head % capacity, the ring has wrapped once head >= capacity.
+FILE_HEADER = struct.Struct("<8sQQ")
+DATA_OFFSET = 64
+
+FRAME_MAGIC = 0xb7a3
+FRAME_MAGIC_BYTES = struct.pack("<H", FRAME_MAGIC)
+# magic, kind, payload length, crc32, session, unix time
+FRAME_HEADER = struct.Struct("<HBxIIQd")
+
+OPEN, WRITE, READ, CLOSE = range(1, 5)
+KIND_NAMES = {OPEN: "open", WRITE: "<<<", READ: ">>>", CLOSE: "close"}
+
+class Frame(NamedTuple):
+    kind: int
+    session: int
+    time: float
+    payload: bytes
+
+class TraceRing():
+    """ One ring buffer file, mapped into memory. """
+
+    def __init__(self, fd: int, size: int) -> None:
+        self.fd = fd
+        if os.fstat(fd).st_size != DATA_OFFSET + size:
+            os.ftruncate(fd, DATA_OFFSET + size)
+        self.map = mmap.mmap(fd, 0)
+
+        magic, capacity, head = FILE_HEADER.unpack_from(self.map)
+        if magic != MAGIC or capacity != len(self.map) - DATA_OFFSET:
+            # New, resized, or written by something else: start over
+            magic, capacity, head = MAGIC, len(self.map) - DATA_OFFSET, 0
+            FILE_HEADER.pack_into(self.map, 0, magic, capacity, head)
+        self.capacity = capacity
+        self.head = head
+        # Anything bigger is cut off, a single frame must not eat the ring
+        self.max_payload = capacity // 4
+
+    def append(self, kind: int, session: int, payload: bytes):
+        payload = payload[:self.max_payload]
+        length = FRAME_HEADER.size + len(payload)
+        pos = self.head % self.capacity
+        if pos + length > self.capacity:
+            # Frames don't wrap, the tail is zeroed so no stale frame is left
+            # between the last one of this lap and the end
+            self.map[DATA_OFFSET + pos:DATA_OFFSET + self.capacity] = bytes(self.capacity - pos)
+            self.head += self.capacity - pos
+            pos = 0
+
+        start = DATA_OFFSET + pos
+        crc = zlib.crc32(payload, zlib.crc32(struct.pack("<BQ", kind, session)))
+        FRAME_HEADER.pack_into(self.map, start, FRAME_MAGIC, kind, len(payload), crc, session, time.time())
+        self.map[start + FRAME_HEADER.size:start + length] = payload
+        self.head += length
+        FILE_HEADER.pack_into(self.map, 0, MAGIC, self.capacity, self.head)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+def open_ring(directory: str, size: int, files: int) -> Optional[TraceRing]:
+    """ The first of the directory's ring files no other process holds. """
+    os.makedirs(directory, exist_ok=True)
+    for slot in range(files):
+        fd = os.open(os.path.join(directory, f"trace-{slot}.ring"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Held until the process exits
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            continue
+        return TraceRing(fd, size)
+    return None
+
+class WireTrace():
+    """
+    The process wide recorder. The file is only opened on first use, and
+    opened anew after a fork, the gunicorn master never writes to it.
+    """
+
+    def __init__(self, directory: str = TRACE_DIR, size=TRACE_SIZE, files=TRACE_FILES) -> None:
+        self.directory = directory
+        self.size = size
+        self.files = files
+        self.pid: Optional[int] = None
+        self.ring: Optional[TraceRing] = None
+        self.frames = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def open_session(self, task) -> "Optional[TraceSession]":
+        if not self.directory:
+            return None
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.ring = open_ring(self.directory, self.size, self.files)
+        if self.ring is None:
+            return None
+
+        session = TraceSession(self, random.getrandbits(63))
+        session.record(OPEN, json.dumps({
+            "task_id": task.task_id,
+            "method": str(getattr(task.method, "value", task.method)),
+            "variant": task.variant_id,
+            "address": task.address,
+            "team": task.team_name,
+            "round": task.current_round_id,
+            "chain": task.task_chain_id,
+            "pid": self.pid,
+        }).encode())
+        return session
+
+class TraceSession():
+    """ The frames of one client connection. """
+    __slots__ = ("trace", "session")
+
+    def __init__(self, trace: WireTrace, session: int) -> None:
+        self.trace = trace
+        self.session = session
+
+    def record(self, kind: int, payload: bytes):
+        self.trace.frames += 1
+        self.trace.ring.append(kind, self.session, payload)
+
+    def sent(self, data: bytes):
+        self.record(WRITE, data)
+
+    def received(self, data: bytes):
+        self.record(READ, data)
+
+    def close(self, exc: Optional[BaseException]):
+        outcome = "OK" if exc is None else f"{type(exc).__name__}: {exc}"
+        self.record(CLOSE, outcome.encode())
+
+# Reading
+
+def read_frames(path: str) -> Iterator[Frame]:
+    """ The intact frames of a ring file, oldest first. """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < DATA_OFFSET:
+        return
+    magic, capacity, head = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a wire trace")
+
+    pos = DATA_OFFSET + head % capacity
+    if head >= capacity:
+        # What is left of the previous lap comes first
+        yield from scan(data, pos, DATA_OFFSET + capacity)
+    yield from scan(data, DATA_OFFSET, pos)
+
+def scan(data: bytes, start: int, end: int) -> Iterator[Frame]:
+    pos = start
+    while pos + FRAME_HEADER.size <= end:
+        magic, kind, length, crc, session, timestamp = FRAME_HEADER.unpack_from(data, pos)
+        payload_end = pos + FRAME_HEADER.size + length
+        if magic == FRAME_MAGIC and kind in KIND_NAMES and payload_end <= end:
+            payload = data[pos + FRAME_HEADER.size:payload_end]
+            if zlib.crc32(payload, zlib.crc32(struct.pack("<BQ", kind, session))) == crc:
+                yield Frame(kind, session, timestamp, payload)
+                pos = payload_end
+                continue
+        # Partly overwritten, torn or zeroed, resynchronize on the next frame
+        pos = data.find(FRAME_MAGIC_BYTES, pos + 1, end)
+        if pos < 0:
+            return
+
+class Session():
+    def __init__(self, session: int) -> None:
+        self.session = session
+        self.meta: dict = {}
+        self.frames: List[Frame] = []
+        self.outcome: Optional[str] = None
+
+    @property
+    def start(self) -> float:
+        return self.frames[0].time
+
+    def describe(self) -> str:
+        meta = self.meta
+        return (f"{self.session:016x}  {time.strftime('%H:%M:%S', time.localtime(self.start))}  "
+                f"task {meta.get('task_id', '?')}  {meta.get('method', '?')} {meta.get('variant', '?')}  "
+                f"{meta.get('address', '?')}  chain {meta.get('chain', '?')}  {self.outcome or 'unfinished'}")
+
+def load_sessions(paths: List[str]) -> List[Session]:
+    sessions: Dict[int, Session] = {}
+    for path in paths:
+        for frame in read_frames(path):
+            session = sessions.get(frame.session)
+            if session is None:
+                session = sessions[frame.session] = Session(frame.session)
+            session.frames.append(frame)
+            if frame.kind == OPEN:
+                session.meta = json.loads(frame.payload)
+            elif frame.kind == CLOSE:
+                session.outcome = frame.payload.decode(errors="replace")
+    return sorted(sessions.values(), key=lambda s: s.start)
+
+def ring_files(target: str) -> List[str]:
+    if os.path.isdir(target):
+        return sorted(os.path.join(target, name) for name in os.listdir(target) if name.endswith(".ring"))
+    return [target]
+
+def select(sessions: List[Session], args) -> List[Session]:
+    def matches(session: Session) -> bool:
+        meta = session.meta
+        return ((args.session is None or f"{session.session:016x}".startswith(args.session))
+                and (args.task is None or meta.get("task_id") == args.task)
+                and (args.chain is None or meta.get("chain") == args.chain)
+                and (args.address is None or meta.get("address") == args.address))
+    return [session for session in sessions if matches(session)]
+
+def show(session: Session):
+    print(session.describe())
+    for frame in session.frames:
+        if frame.kind in (WRITE, READ):
+            print(f"  +{(frame.time - session.start) * 1000:9.3f}ms {KIND_NAMES[frame.kind]} {frame.payload!r}")
+
+class Command(NamedTuple):
+    method: str
+    args: tuple
+    # The write all of its lines went out in, as a CommandBatch sends them,
+    # or None if they took several
+    write: Optional[int]
+    lines: List[Tuple[int, int, bytes]]
+
+class CommandDecoder():
+    """
+    Turns what the checker sent in a session back into the BambiNoteClient
+    calls that sent it. Which menu a choice belongs to depends on whether
+    the client is logged in by then, so next() is asked with that.
+    """
+
+    def __init__(self, frames: List[Frame]) -> None:
+        self.frames = frames
+        self.writes = [i for i, frame in enumerate(frames) if frame.kind == WRITE]
+        # (write the line started in, write it ended in, line)
+        self.lines: Deque[Tuple[int, int, bytes]] = deque()
+        partial, started = b"", 0
+        for number, frame in enumerate(frames[i] for i in self.writes):
+            data = partial + frame.payload
+            if not partial:
+                started = number
+            *lines, partial = data.split(b"\n")
+            for line in lines:
+                self.lines.append((started, number, line))
+                started = number
+
+    def take(self, count: int) -> Optional[List[Tuple[int, int, bytes]]]:
+        if len(self.lines) < count:
+            return None
+        return [self.lines.popleft() for _ in range(count)]
+
+    def reply_to(self, write: int) -> bytes:
+        for frame in self.frames[self.writes[write] + 1:]:
+            if frame.kind == READ:
+                return frame.payload
+        return b""
+
+    def put_back(self, command: Command):
+        self.lines.extendleft(reversed(command.lines))
+
+    def next(self, authenticated: bool) -> "Optional[Command | str]":
+        """ The next command, None at the end, or a description of input no command sends. """
+        if not self.lines:
+            return None
+        choice = self.lines[0][2]
+        if not authenticated:
+            # Only a user that exists is asked for the password
+            asked = len(self.lines) > 1 and self.reply_to(self.lines[1][1]).startswith(b"Password:")
+            commands = {b"1": ("register", 3), b"2": ("login", 3 if asked else 2)}
+        else:
+            commands = {b"1": ("create_note", 3), b"3": ("list_notes", 1), b"4": ("delete_note", 2),
+                        b"5": ("load_note", 3), b"6": ("save_note", 3)}
+        if authenticated and choice in (b"7", b"8") and len(self.lines) > 1 and self.lines[1][2].isdigit():
+            method, count = "save_notes" if choice == b"7" else "load_notes", 2 + int(self.lines[1][2])
+        elif choice in commands:
+            method, count = commands[choice]
+        else:
+            return f"no client command sends {choice!r} {'after' if authenticated else 'before'} login"
+
+        lines = self.take(count)
+        if lines is None:
+            return f"the session ends in the middle of {method}"
+        values = [line for _, _, line in lines[1:]]
+        text = [value.decode(errors="surrogateescape") for value in values]
+        writes = {number for started, ended, _ in lines for number in (started, ended)}
+        write = writes.pop() if len(writes) == 1 else None
+
+        if method in ("register", "login"):
+            args: tuple = (text[0], text[1] if len(text) > 1 else "")
+        elif method == "create_note":
+            args = (int(values[0]), values[1])
+        elif method == "delete_note":
+            args = (int(values[0]),)
+        elif method == "load_note":
+            # The exploit's search tolerates files that are gone, print it either way
+            args = (int(values[1]), text[0], True)
+        elif method == "save_note":
+            args = (int(values[0]), text[1])
+        elif method in ("save_notes", "load_notes"):
+            entries = [entry.split(" ", 1) for entry in text[1:]]
+            args = ([(int(idx, 0), filename) for idx, filename in entries],)
+        else:
+            args = ()
+        return Command(method, args, write, lines)
+
+async def replay(session: Session):
+    """
+    Runs BambiNoteClient against the session's recorded service output. The
+    commands are decoded from what the checker sent, and every recorded read
+    is handed to the client as one read of its own, once the client sent
+    what had been sent before it. The parser sees the segments exactly as
+    they arrived, and a client that reads past a reply shows up as a stall.
+    Prints every command with what it returned, up to where the client
+    failed.
+    """
+    import logging
+    from logging import LoggerAdapter
+    from checker import BANNER, BambiNoteClient, InvalidCredentialsException
+    from fuzz import Replay, offline_client, verdict
+
+    print(session.describe())
+    transcript = [(frame.kind == READ, frame.payload) for frame in session.frames if frame.kind in (READ, WRITE)]
+    transport = Replay(transcript, lambda data: [data])
+    client = offline_client(transport, LoggerAdapter(logging.getLogger("wiretrace"), {}))
+    decoder = CommandDecoder(session.frames)
+
+    try:
+        # Pooled sessions were picked up after the banner
+        if transcript and transcript[0][0] and transcript[0][1].startswith(BANNER):
+            await client.readuntil(BANNER)
+
+        while True:
+            command = decoder.next(client.state != BambiNoteClient.UNAUTHENTICATED)
+            if command is None:
+                break
+            if isinstance(command, str):
+                print(f"  stopped, {command}")
+                break
+
+            if command.write is None:
+                try:
+                    result = await getattr(client, command.method)(*command.args)
+                except InvalidCredentialsException as e:
+                    # havoc tries wrong passwords on purpose
+                    result = e
+                print(f"  {command.method}{command.args!r:.160} -> {result!r}")
+                if command.method == "load_note" and command.args[0] == 0 and result is True:
+                    # Slot 0 runs over into the username, the exploit's
+                    # impersonate() then switches to the name the menu shows
+                    title = re.search(rb"===== \[(.*)\] =====\n", client.stream.pending())
+                    if title is not None:
+                        client.state = (title.group(1).decode(errors="surrogateescape"), client.state[1])
+                continue
+
+            # Everything else that went out in the same write was queued with it
+            commands = [command]
+            while True:
+                following = decoder.next(True)
+                if not isinstance(following, Command) or following.write != command.write:
+                    if isinstance(following, Command):
+                        decoder.put_back(following)
+                    break
+                commands.append(following)
+            async with client.batch() as batch:
+                results = [getattr(batch, c.method)(*c.args) for c in commands]
+            for c, result in zip(commands, results):
+                print(f"  batch {c.method}{c.args!r:.160} -> {result.result()!r}")
+    except Exception as e:
+        print(f"  FAILED with {verdict(e)}: {e!r} at {client.stream.pending()[:200]!r}")
+        return
+
+    # The menu that was waiting for the next command is never read
+    unread = client.stream.pending()
+    if transport.replies or not re.fullmatch(rb"(===== \[.*\] =====\n(   \d\. .*\n)+> )?", unread):
+        print(f"  unread service output: {unread[:200]!r}, {len(transport.replies)} more replies")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("list", "show", "replay"))
+    parser.add_argument("trace", help="a ring file or the directory holding them")
+    parser.add_argument("--session", help="session id prefix, as printed by list")
+    parser.add_argument("--task", type=int)
+    parser.add_argument("--chain")
+    parser.add_argument("--address")
+    args = parser.parse_args()
+
+    sessions = select(load_sessions(ring_files(args.trace)), args)
+    for session in sessions:
+        if args.command == "list":
+            print(session.describe())
+        elif args.command == "show":
+            show(session)
+        else:
+            asyncio.run(replay(session))
+
+if __name__ == "__main__":
+    main()
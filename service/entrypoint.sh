@@ -1,16 +1,17 @@
 #!/bin/sh
-cleaner () {
-    CLEANUP_DIR=$1;
-    while true; do
-        echo "$CLEANUP_DIR" $(whoami)
-        find "$CLEANUP_DIR" -regex "$CLEANUP_DIR/.+" -mmin +30 -user author -delete
-        sleep 60
-    done
-}
-
 DATA_DIR="/service/data"
 
-xinetd
 chown author:author "$DATA_DIR"
-cleaner "$DATA_DIR" &
-tail -f /var/log/xinetd.log
\ No newline at end of file
+# Moves users of the old flat layout into their shards, see tools/migrate.c
+./migrate "$DATA_DIR"
+# Expires everything older than 30 minutes, see tools/cleaner.c
+./cleaner -t 1800 -i 60 -u author "$DATA_DIR" &
+# One process per session like before, but forked ahead of time, see
+# tools/prefork.c. The checkers connect from a single address, so keep the
+# per address limit well above what they open in parallel.
+exec ./prefork -p 8204 -u author \
+    -n "${PREFORK_POOL_SIZE:-16}" \
+    -m "${PREFORK_MAX_SESSIONS:-1024}" \
+    -l "${PREFORK_MAX_PER_IP:-256}" \
+    -b "${PREFORK_BACKLOG:-1024}" \
+    /service/bambi-notes
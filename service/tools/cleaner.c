@@ -0,0 +1,299 @@
+// Expires old user directories below the data directory.
+//
+// User directories live in DIR/ab/cd/<username>/, see user_path() in
+// bambi-notes.c. Instead of walking the whole tree every minute, the cleaner
+// keeps one entry per leaf shard (DIR/ab/cd) with the time its oldest file
+// expires. A sweep stats the 256 top shards and the leaves that exist,
+// which costs the same at any user count, and only reads the leaves that
+// are due or changed since the last look, i.e. got a new user. In those,
+// files older than the ttl are unlinked, empty user directories are removed,
+// and the leaf is due again when its oldest remaining file expires. Shard
+// directories themselves are never removed, bambi-notes could be about to
+// register a user in them.
+//
+// A user directory that lost files also loses its .index, the listing
+// bambi-notes keeps of it, and the next listing rebuilds that from what is
+// left. The directory is flock()ed meanwhile like bambi-notes does for
+// saves and rebuilds, so a rebuild can't put back the files unlinked here.
+//
+// usage: cleaner [-t ttl] [-i interval] [-b max_unlinks] [-u user] DIR
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <ctype.h>
+#include <time.h>
+#include <pwd.h>
+
+#include <dirent.h>
+#include <fcntl.h>
+#include <sys/file.h>
+#include <sys/stat.h>
+
+#define SHARDS 256
+// Has to agree with INDEX_FILE in bambi-notes.c
+#define INDEX_FILE ".index"
+#define LEAVES (SHARDS * SHARDS)
+
+struct leaf {
+    int present;
+    // Earliest expiry of a file below the leaf, 0 while it has no users
+    time_t due;
+    // Creating or removing a user directory bumps it
+    struct timespec mtime;
+};
+
+struct stats {
+    size_t leaves;
+    size_t dirs;
+    size_t files;
+    size_t unlinked;
+    size_t removed;
+};
+
+static const char *data_dir;
+static int data_fd = -1;
+static time_t ttl = 30 * 60;
+static time_t interval = 60;
+static size_t max_unlinks = 5000;
+static uid_t owner = (uid_t) -1;
+
+static struct timespec shard_mtimes[SHARDS];
+static struct leaf leaves[LEAVES];
+// Where the next sweep starts, so a sweep that runs out of unlinks does not
+// starve the leaves behind it
+static size_t cursor;
+
+static double now_ms() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1000.0 + ts.tv_nsec / 1e6;
+}
+
+static int is_dot(const char *name) {
+    return strcmp(name, ".") == 0 || strcmp(name, "..") == 0;
+}
+
+static int owned(const struct stat *st) {
+    return owner == (uid_t) -1 || st->st_uid == owner;
+}
+
+static int same_time(const struct timespec *a, const struct timespec *b) {
+    return a->tv_sec == b->tv_sec && a->tv_nsec == b->tv_nsec;
+}
+
+static int shard_index(const char *name) {
+    if (strlen(name) != 2 || !isxdigit((unsigned char) name[0]) || !isxdigit((unsigned char) name[1])) return -1;
+    return (int) strtol(name, NULL, 16);
+}
+
+// Marks the leaves that exist, only reading the top shards that changed
+static void discover() {
+    for (int top = 0; top < SHARDS; top++) {
+        char name[sizeof("ab")];
+        snprintf(name, sizeof(name), "%02x", top);
+
+        struct stat st;
+        if (fstatat(data_fd, name, &st, AT_SYMLINK_NOFOLLOW) < 0 || !S_ISDIR(st.st_mode)) continue;
+        if (same_time(&st.st_mtim, &shard_mtimes[top])) continue;
+        // Taken before reading, a leaf created meanwhile shows up next time
+        shard_mtimes[top] = st.st_mtim;
+
+        int fd = openat(data_fd, name, O_RDONLY | O_DIRECTORY | O_NOFOLLOW);
+        if (fd < 0) continue;
+        DIR *dir = fdopendir(fd);
+        if (!dir) {
+            close(fd);
+            continue;
+        }
+
+        struct dirent *ent;
+        while ((ent = readdir(dir)) != NULL) {
+            int bottom = shard_index(ent->d_name);
+            if (bottom >= 0) leaves[top * SHARDS + bottom].present = 1;
+        }
+        closedir(dir);
+    }
+}
+
+// Unlinks the expired files of one user directory. Returns when the
+// directory is due again, or 0 once it is gone.
+static time_t expire_dir(int leaf_fd, const char *name, time_t now, struct stats *stats) {
+    int fd = openat(leaf_fd, name, O_RDONLY | O_DIRECTORY | O_NOFOLLOW);
+    if (fd < 0) return 0;
+
+    struct stat st;
+    if (fstat(fd, &st) < 0 || !owned(&st)) {
+        close(fd);
+        return 0;
+    }
+
+    DIR *dir = fdopendir(fd);
+    if (!dir) {
+        close(fd);
+        return 0;
+    }
+    // Released by closedir, bambi-notes never holds it for long
+    flock(fd, LOCK_EX);
+    stats->dirs++;
+
+    // The directory's own mtime is no help here, our unlinks bump it. New
+    // files can only be younger than the ones seen now.
+    time_t oldest = 0;
+    size_t remaining = 0;
+    size_t unlinked = stats->unlinked;
+    int deferred = 0;
+    struct dirent *ent;
+    while ((ent = readdir(dir)) != NULL) {
+        if (is_dot(ent->d_name)) continue;
+        stats->files++;
+        remaining++;
+
+        struct stat file_st;
+        if (fstatat(fd, ent->d_name, &file_st, AT_SYMLINK_NOFOLLOW) < 0) continue;
+        if (file_st.st_mtime + ttl > now) {
+            if (!oldest || file_st.st_mtime < oldest) oldest = file_st.st_mtime;
+            continue;
+        }
+
+        if (stats->unlinked >= max_unlinks) {
+            deferred = 1;
+        } else if (owned(&file_st) && !S_ISDIR(file_st.st_mode) && unlinkat(fd, ent->d_name, 0) == 0) {
+            stats->unlinked++;
+            remaining--;
+        }
+    }
+    // After the notes, so an index rebuilt meanwhile goes as well. It may
+    // not have been there when the directory was read, rmdir below only
+    // succeeds if the directory is really empty.
+    if (stats->unlinked != unlinked && unlinkat(fd, INDEX_FILE, 0) == 0) {
+        stats->unlinked++;
+        if (remaining) remaining--;
+    }
+    closedir(dir);
+
+    if (!remaining) {
+        if (unlinkat(leaf_fd, name, AT_REMOVEDIR) == 0) {
+            stats->removed++;
+            return 0;
+        }
+        // A file showed up in the meantime
+        return now + ttl;
+    }
+
+    // Out of unlinks, first in line for the next sweep
+    if (deferred) return now;
+    if (oldest) return oldest + ttl;
+    // Only files we may not delete are left
+    return now + ttl;
+}
+
+// Expires every user directory of one leaf, returns when the leaf is due again
+static time_t expire_leaf(int leaf_fd, time_t now, struct stats *stats) {
+    DIR *dir = fdopendir(dup(leaf_fd));
+    if (!dir) return now;
+    stats->leaves++;
+
+    time_t due = 0;
+    struct dirent *ent;
+    while ((ent = readdir(dir)) != NULL) {
+        if (is_dot(ent->d_name)) continue;
+        time_t dir_due = expire_dir(leaf_fd, ent->d_name, now, stats);
+        if (dir_due && (!due || dir_due < due)) due = dir_due;
+    }
+    closedir(dir);
+    return due;
+}
+
+static void sweep() {
+    double start = now_ms();
+    time_t now = time(NULL);
+    struct stats stats = {0};
+    size_t checked = 0;
+
+    discover();
+    for (size_t step = 0; step < LEAVES; step++) {
+        size_t idx = (cursor + step) % LEAVES;
+        struct leaf *leaf = &leaves[idx];
+        if (!leaf->present) continue;
+        if (stats.unlinked >= max_unlinks) {
+            // Pick up from here next time
+            cursor = idx;
+            break;
+        }
+        checked++;
+
+        char name[sizeof("ab/cd")];
+        snprintf(name, sizeof(name), "%02zx/%02zx", idx / SHARDS, idx % SHARDS);
+        struct stat st;
+        if (fstatat(data_fd, name, &st, AT_SYMLINK_NOFOLLOW) < 0 || !S_ISDIR(st.st_mode)) {
+            leaf->present = 0;
+            continue;
+        }
+
+        int changed = !same_time(&st.st_mtim, &leaf->mtime);
+        if (!changed && (!leaf->due || leaf->due > now)) continue;
+
+        int fd = openat(data_fd, name, O_RDONLY | O_DIRECTORY | O_NOFOLLOW);
+        if (fd < 0) continue;
+        // Taken before reading, so a user registered meanwhile is not missed.
+        // Our own removals bump it as well, which only costs one more look.
+        leaf->mtime = st.st_mtim;
+        leaf->due = expire_leaf(fd, now, &stats);
+        close(fd);
+    }
+
+    printf(
+        "cleaner: checked %zu leaves, swept %zu (%zu directories, %zu files) in %.1fms, "
+        "unlinked %zu files, removed %zu directories\n",
+        checked, stats.leaves, stats.dirs, stats.files, now_ms() - start, stats.unlinked, stats.removed
+    );
+}
+
+int main(int argc, char * const argv[]) {
+    int opt;
+    while ((opt = getopt(argc, argv, "t:i:b:u:")) != -1) {
+        switch (opt) {
+        case 't':
+            ttl = atol(optarg);
+            break;
+        case 'i':
+            interval = atol(optarg);
+            break;
+        case 'b':
+            max_unlinks = atol(optarg);
+            break;
+        case 'u': {
+            struct passwd *pw = getpwnam(optarg);
+            if (!pw) {
+                fprintf(stderr, "Unknown user %s\n", optarg);
+                return EXIT_FAILURE;
+            }
+            owner = pw->pw_uid;
+            break;
+        }
+        default:
+            fprintf(stderr, "usage: %s [-t ttl] [-i interval] [-b max_unlinks] [-u user] DIR\n", argv[0]);
+            return EXIT_FAILURE;
+        }
+    }
+    if (optind != argc - 1) {
+        fprintf(stderr, "usage: %s [-t ttl] [-i interval] [-b max_unlinks] [-u user] DIR\n", argv[0]);
+        return EXIT_FAILURE;
+    }
+    setvbuf(stdout, NULL, _IOLBF, 0);
+
+    data_dir = argv[optind];
+    data_fd = open(data_dir, O_RDONLY | O_DIRECTORY);
+    if (data_fd < 0) {
+        perror("Failed to open data directory");
+        return EXIT_FAILURE;
+    }
+
+    // The first sweep reads every leaf and builds the index
+    while (1) {
+        sweep();
+        sleep(interval);
+    }
+}
@@ -0,0 +1,148 @@
+// Moves user directories from the old flat layout, DIR/<username>/, into the
+// sharded one, DIR/ab/cd/<username>/, that bambi-notes expects now.
+//
+// ab and cd are the top two bytes of the FNV-1a hash of the username, the
+// same hash as user_hash() in bambi-notes.c. Every move is a single rename
+// within the data directory, so notes keep their mtime and the cleaner
+// expires them as before. Safe to run again, e.g. after being interrupted:
+// shard directories are left alone and directories already moved are not
+// in the top level anymore. Run it before the service accepts connections.
+//
+// usage: migrate DIR
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <ctype.h>
+#include <errno.h>
+#include <limits.h>
+
+#include <dirent.h>
+#include <fcntl.h>
+#include <sys/stat.h>
+
+#define PARKED_PREFIX ".migrating."
+
+static int data_fd = -1;
+static uid_t data_uid;
+static gid_t data_gid;
+
+// FNV-1a, has to agree with bambi-notes.c
+static unsigned int user_hash(const char *username) {
+    unsigned int hash = 2166136261u;
+    for (size_t offset = 0; username[offset] != 0; offset++) {
+        hash ^= (unsigned char) username[offset];
+        hash *= 16777619u;
+    }
+    return hash;
+}
+
+static int is_shard_name(const char *name) {
+    return strlen(name) == 2 && isxdigit((unsigned char) name[0]) && isxdigit((unsigned char) name[1])
+        && !isupper((unsigned char) name[0]) && !isupper((unsigned char) name[1]);
+}
+
+static int has_passwd(const char *name) {
+    char path[PATH_MAX];
+    snprintf(path, sizeof(path), "%s/passwd", name);
+    return faccessat(data_fd, path, F_OK, AT_SYMLINK_NOFOLLOW) == 0;
+}
+
+static int make_shard(const char *path) {
+    if (mkdirat(data_fd, path, 0775) == 0) {
+        // The service runs as the owner of the data directory and has to be
+        // able to add users to the shard
+        fchownat(data_fd, path, data_uid, data_gid, AT_SYMLINK_NOFOLLOW);
+        return 0;
+    }
+    return errno == EEXIST ? 0 : -1;
+}
+
+// Moves the directory at `from` into the shard of `username`
+static int move_user(const char *from, const char *username) {
+    unsigned int hash = user_hash(username);
+    char shard[sizeof("ab/cd")];
+    char to[PATH_MAX];
+
+    snprintf(shard, sizeof(shard), "%02x", hash >> 24);
+    if (make_shard(shard) < 0) {
+        perror(shard);
+        return -1;
+    }
+    snprintf(shard, sizeof(shard), "%02x/%02x", hash >> 24, (hash >> 16) & 0xff);
+    if (make_shard(shard) < 0) {
+        perror(shard);
+        return -1;
+    }
+
+    snprintf(to, sizeof(to), "%s/%s", shard, username);
+    if (faccessat(data_fd, to, F_OK, AT_SYMLINK_NOFOLLOW) == 0) {
+        fprintf(stderr, "migrate: %s already exists, leaving %s in place\n", to, from);
+        return -1;
+    }
+    if (renameat(data_fd, from, data_fd, to) < 0) {
+        perror(from);
+        return -1;
+    }
+    return 0;
+}
+
+int main(int argc, char * const argv[]) {
+    if (argc != 2) {
+        fprintf(stderr, "usage: %s DIR\n", argv[0]);
+        return EXIT_FAILURE;
+    }
+
+    data_fd = open(argv[1], O_RDONLY | O_DIRECTORY);
+    struct stat st;
+    if (data_fd < 0 || fstat(data_fd, &st) < 0) {
+        perror("Failed to open data directory");
+        return EXIT_FAILURE;
+    }
+    data_uid = st.st_uid;
+    data_gid = st.st_gid;
+
+    DIR *dir = fdopendir(dup(data_fd));
+    if (!dir) {
+        perror("Failed to open data directory");
+        return EXIT_FAILURE;
+    }
+
+    size_t moved = 0, failed = 0;
+    struct dirent *ent;
+    while ((ent = readdir(dir)) != NULL) {
+        const char *name = ent->d_name;
+        if (strcmp(name, ".") == 0 || strcmp(name, "..") == 0) continue;
+
+        struct stat user_st;
+        if (fstatat(data_fd, name, &user_st, AT_SYMLINK_NOFOLLOW) < 0 || !S_ISDIR(user_st.st_mode)) continue;
+
+        if (strncmp(name, PARKED_PREFIX, strlen(PARKED_PREFIX)) == 0) {
+            // Parked by an earlier, interrupted run
+            if (move_user(name, name + strlen(PARKED_PREFIX)) < 0) failed++;
+            else moved++;
+            continue;
+        }
+
+        // A user called e.g. "ab" looks like a shard, but shards never hold
+        // a passwd file
+        if (is_shard_name(name) && !has_passwd(name)) continue;
+
+        if (is_shard_name(name)) {
+            // Its shard may well be the directory itself, move it out of the way first
+            char parked[PATH_MAX];
+            snprintf(parked, sizeof(parked), PARKED_PREFIX "%s", name);
+            if (renameat(data_fd, name, data_fd, parked) < 0 || move_user(parked, name) < 0) failed++;
+            else moved++;
+        } else if (move_user(name, name) < 0) {
+            failed++;
+        } else {
+            moved++;
+        }
+    }
+    closedir(dir);
+
+    printf("migrate: moved %zu user directories, %zu failed\n", moved, failed);
+    return failed ? EXIT_FAILURE : EXIT_SUCCESS;
+}
@@ -0,0 +1,342 @@
+// Front end for bambi-notes, replacing xinetd.
+//
+// Keeps a pool of forked children that already dropped their privileges and
+// only wait for a connection. The front end accepts, checks its limits and
+// passes the socket to an idle child over a unix socketpair. The child puts
+// it on stdin/stdout/stderr and execs the service, so every session still
+// gets its own process, exactly like with xinetd. The pool is refilled
+// after every handoff.
+//
+// Backpressure: with -m sessions running the listening socket is not polled
+// anymore, so new connections wait in the kernel backlog (-b) instead.
+// Connections beyond -l per source address are closed right away.
+//
+// usage: prefork [-p port] [-n pool] [-m max_sessions] [-l per_ip] [-b backlog] [-u user] BINARY
+
+#define _GNU_SOURCE
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <errno.h>
+#include <signal.h>
+#include <time.h>
+#include <poll.h>
+#include <pwd.h>
+#include <grp.h>
+
+#include <fcntl.h>
+#include <netinet/in.h>
+#include <arpa/inet.h>
+#include <sys/signalfd.h>
+#include <sys/socket.h>
+#include <sys/wait.h>
+
+struct child {
+    pid_t pid;
+    int sock;
+};
+
+struct session {
+    pid_t pid;
+    struct in6_addr addr;
+};
+
+struct stats {
+    unsigned long accepted;
+    unsigned long rejected;
+    unsigned long spawned;
+    unsigned long spawn_failed;
+};
+
+static const char *binary;
+static int port = 8204;
+static int pool_size = 16;
+static int max_sessions = 512;
+static int max_per_ip = 0;
+static int backlog = 1024;
+static struct passwd *run_as;
+
+static struct child *idle;
+static int idle_count;
+static struct session *sessions;
+static int session_count;
+static struct stats stats;
+
+static void child_main(int sock) {
+    // Everything the child needs was set up before fork, it only waits for
+    // the connection and becomes the service
+    char byte;
+    char control[CMSG_SPACE(sizeof(int))];
+    struct iovec iov = { .iov_base = &byte, .iov_len = 1 };
+    struct msghdr msg = {
+        .msg_iov = &iov,
+        .msg_iovlen = 1,
+        .msg_control = control,
+        .msg_controllen = sizeof(control),
+    };
+
+    if (recvmsg(sock, &msg, 0) <= 0) _exit(EXIT_SUCCESS);
+    struct cmsghdr *cmsg = CMSG_FIRSTHDR(&msg);
+    if (!cmsg || cmsg->cmsg_type != SCM_RIGHTS) _exit(EXIT_FAILURE);
+
+    int conn;
+    memcpy(&conn, CMSG_DATA(cmsg), sizeof(int));
+    close(sock);
+
+    dup2(conn, STDIN_FILENO);
+    dup2(conn, STDOUT_FILENO);
+    dup2(conn, STDERR_FILENO);
+    if (conn > STDERR_FILENO) close(conn);
+
+    execl(binary, binary, NULL);
+    _exit(EXIT_FAILURE);
+}
+
+static int spawn() {
+    int pair[2];
+    if (socketpair(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0, pair) < 0) {
+        stats.spawn_failed++;
+        return -1;
+    }
+
+    pid_t pid = fork();
+    if (pid < 0) {
+        close(pair[0]);
+        close(pair[1]);
+        stats.spawn_failed++;
+        return -1;
+    }
+
+    if (pid == 0) {
+        // The parent's listening socket, signalfd and pool are all CLOEXEC,
+        // but there is no point in keeping them open until the exec
+        for (int idx = 0; idx < idle_count; idx++) close(idle[idx].sock);
+        close(pair[0]);
+
+        // Hand the service the signal setup it would get from xinetd. With
+        // SIGPIPE ignored a session whose client went away spins through
+        // its menu loop until the alarm, instead of dying on the next write.
+        sigset_t mask;
+        sigemptyset(&mask);
+        sigprocmask(SIG_SETMASK, &mask, NULL);
+        signal(SIGPIPE, SIG_DFL);
+
+        if (run_as) {
+            if (setgroups(0, NULL) < 0 || setgid(run_as->pw_gid) < 0 || setuid(run_as->pw_uid) < 0) {
+                _exit(EXIT_FAILURE);
+            }
+        }
+        child_main(pair[1]);
+    }
+
+    close(pair[1]);
+    idle[idle_count].pid = pid;
+    idle[idle_count].sock = pair[0];
+    idle_count++;
+    stats.spawned++;
+    return 0;
+}
+
+static void refill() {
+    while (idle_count < pool_size) {
+        if (spawn() < 0) break;
+    }
+}
+
+static int sessions_from(const struct in6_addr *addr) {
+    int count = 0;
+    for (int idx = 0; idx < session_count; idx++) {
+        if (memcmp(&sessions[idx].addr, addr, sizeof(*addr)) == 0) count++;
+    }
+    return count;
+}
+
+static int hand_off(int conn, const struct in6_addr *addr) {
+    char byte = 0;
+    char control[CMSG_SPACE(sizeof(int))];
+    memset(control, 0, sizeof(control));
+    struct iovec iov = { .iov_base = &byte, .iov_len = 1 };
+    struct msghdr msg = {
+        .msg_iov = &iov,
+        .msg_iovlen = 1,
+        .msg_control = control,
+        .msg_controllen = sizeof(control),
+    };
+    struct cmsghdr *cmsg = CMSG_FIRSTHDR(&msg);
+    cmsg->cmsg_level = SOL_SOCKET;
+    cmsg->cmsg_type = SCM_RIGHTS;
+    cmsg->cmsg_len = CMSG_LEN(sizeof(int));
+    memcpy(CMSG_DATA(cmsg), &conn, sizeof(int));
+
+    while (1) {
+        if (!idle_count && spawn() < 0) return -1;
+
+        struct child child = idle[--idle_count];
+        int sent = sendmsg(child.sock, &msg, MSG_NOSIGNAL);
+        close(child.sock);
+        if (sent < 0) {
+            // Died while waiting, the SIGCHLD handling reaps it
+            kill(child.pid, SIGKILL);
+            continue;
+        }
+
+        sessions[session_count].pid = child.pid;
+        sessions[session_count].addr = *addr;
+        session_count++;
+        return 0;
+    }
+}
+
+static void accept_all(int listen_fd) {
+    while (session_count < max_sessions) {
+        struct sockaddr_in6 peer;
+        socklen_t peer_len = sizeof(peer);
+        int conn = accept4(listen_fd, (struct sockaddr *) &peer, &peer_len, SOCK_CLOEXEC);
+        if (conn < 0) {
+            if (errno == EINTR || errno == ECONNABORTED) continue;
+            return;
+        }
+
+        if (max_per_ip && sessions_from(&peer.sin6_addr) >= max_per_ip) {
+            stats.rejected++;
+            close(conn);
+            continue;
+        }
+
+        if (hand_off(conn, &peer.sin6_addr) < 0) {
+            stats.rejected++;
+        } else {
+            stats.accepted++;
+        }
+        close(conn);
+    }
+}
+
+static void reap() {
+    pid_t pid;
+    while ((pid = waitpid(-1, NULL, WNOHANG)) > 0) {
+        for (int idx = 0; idx < session_count; idx++) {
+            if (sessions[idx].pid == pid) {
+                sessions[idx] = sessions[--session_count];
+                break;
+            }
+        }
+        for (int idx = 0; idx < idle_count; idx++) {
+            if (idle[idx].pid == pid) {
+                close(idle[idx].sock);
+                idle[idx] = idle[--idle_count];
+                break;
+            }
+        }
+    }
+}
+
+static int open_listener() {
+    int fd = socket(AF_INET6, SOCK_STREAM | SOCK_NONBLOCK | SOCK_CLOEXEC, 0);
+    if (fd < 0) {
+        perror("Failed to create socket");
+        exit(EXIT_FAILURE);
+    }
+
+    int one = 1, zero = 0;
+    setsockopt(fd, SOL_SOCKET, SO_REUSEADDR, &one, sizeof(one));
+    setsockopt(fd, IPPROTO_IPV6, IPV6_V6ONLY, &zero, sizeof(zero));
+
+    struct sockaddr_in6 addr = {
+        .sin6_family = AF_INET6,
+        .sin6_port = htons(port),
+        .sin6_addr = in6addr_any,
+    };
+    if (bind(fd, (struct sockaddr *) &addr, sizeof(addr)) < 0 || listen(fd, backlog) < 0) {
+        perror("Failed to listen");
+        exit(EXIT_FAILURE);
+    }
+    return fd;
+}
+
+static void usage(const char *name) {
+    fprintf(stderr, "usage: %s [-p port] [-n pool] [-m max_sessions] [-l per_ip] [-b backlog] [-u user] BINARY\n", name);
+    exit(EXIT_FAILURE);
+}
+
+int main(int argc, char * const argv[]) {
+    int opt;
+    while ((opt = getopt(argc, argv, "p:n:m:l:b:u:")) != -1) {
+        switch (opt) {
+        case 'p':
+            port = atoi(optarg);
+            break;
+        case 'n':
+            pool_size = atoi(optarg);
+            break;
+        case 'm':
+            max_sessions = atoi(optarg);
+            break;
+        case 'l':
+            max_per_ip = atoi(optarg);
+            break;
+        case 'b':
+            backlog = atoi(optarg);
+            break;
+        case 'u':
+            run_as = getpwnam(optarg);
+            if (!run_as) {
+                fprintf(stderr, "Unknown user %s\n", optarg);
+                return EXIT_FAILURE;
+            }
+            break;
+        default:
+            usage(argv[0]);
+        }
+    }
+    if (optind != argc - 1 || pool_size < 1 || max_sessions < 1) usage(argv[0]);
+    binary = argv[optind];
+    setvbuf(stdout, NULL, _IOLBF, 0);
+
+    idle = calloc(pool_size + 1, sizeof(struct child));
+    sessions = calloc(max_sessions, sizeof(struct session));
+
+    sigset_t mask;
+    sigemptyset(&mask);
+    sigaddset(&mask, SIGCHLD);
+    sigprocmask(SIG_BLOCK, &mask, NULL);
+    int signal_fd = signalfd(-1, &mask, SFD_NONBLOCK | SFD_CLOEXEC);
+    signal(SIGPIPE, SIG_IGN);
+
+    int listen_fd = open_listener();
+    refill();
+    printf("prefork: listening on port %d, %d children ready\n", port, idle_count);
+
+    time_t next_report = time(NULL) + 60;
+    while (1) {
+        struct pollfd fds[2] = {
+            { .fd = signal_fd, .events = POLLIN },
+            // Not polling the listener is the backpressure
+            { .fd = session_count < max_sessions ? listen_fd : -1, .events = POLLIN },
+        };
+        int timeout = idle_count < pool_size ? 100 : 1000;
+        if (poll(fds, 2, timeout) < 0 && errno != EINTR) {
+            perror("poll");
+            return EXIT_FAILURE;
+        }
+
+        if (fds[0].revents & POLLIN) {
+            struct signalfd_siginfo info;
+            while (read(signal_fd, &info, sizeof(info)) > 0);
+            reap();
+        }
+        if (fds[1].revents & POLLIN) {
+            accept_all(listen_fd);
+        }
+        refill();
+
+        if (time(NULL) >= next_report) {
+            printf(
+                "prefork: %lu accepted, %lu rejected, %lu spawned (%lu failed), %d sessions, %d idle\n",
+                stats.accepted, stats.rejected, stats.spawned, stats.spawn_failed, session_count, idle_count
+            );
+            next_report = time(NULL) + 60;
+        }
+    }
+}
@@ -2,13 +2,25 @@
 #include <stdlib.h>
 #include <string.h>
 #include <unistd.h>
+#include <errno.h>
 
 #include <dirent.h>
 #include <fcntl.h>
+#include <sys/file.h>
 #include <sys/stat.h>
 
 #define NL "\n"
-#define STORAGE_DIR "/service/data/%s/%s"
+// Users live in /service/data/ab/cd/<username>/, with ab and cd taken from
+// the hash of the username, so no directory grows beyond a handful of users
+#define STORAGE_ROOT "/service/data/"
+#define STORAGE_DIR STORAGE_ROOT "%02x/%02x/%s/%s"
+// Same room for filenames as with the old flat "/service/data/%s/%s"
+#define STORAGE_DIR_SIZE (sizeof(STORAGE_ROOT "%s/%s") + sizeof("ab/cd/") - 1)
+// The "Saved Notes" lines of the listing, kept next to the notes so a
+// listing doesn't read the directory. Filenames can't start with a dot, so
+// no note can clash with it or its temporary copy.
+#define INDEX_FILE ".index"
+#define INDEX_LINE " | %s" NL
 
 #define NOTE_SIZE 0x60
 #define DEFAULT_NOTE "Well, it's a note-taking service. What did you expect?"
@@ -16,17 +28,66 @@
 #define NOTE_COUNT 10
 #define VALID_NOTE_IDX(idx) ((idx >= 0) && (idx < NOTE_COUNT))
 
+// stdout is fully buffered. Output is only flushed right before the service
+// would block waiting for input, so a reply goes out with one write no matter
+// how many printf/puts it took, and a reply never waits for the client's
+// delayed ACK of its own first half. Input is read into a buffer of our own
+// rather than through stdin, so whether a whole line already arrived can be
+// told without looking into FILE internals. The buffers are static so the
+// heap looks exactly like it did with unbuffered stdio.
+static char stdin_buf[0x1000];
+static size_t stdin_pos, stdin_end;
+static char stdout_buf[0x4000];
+
 void setup() {
-    setbuf(stdin, NULL);
-    setbuf(stdout, NULL);
+    setvbuf(stdout, stdout_buf, _IOFBF, sizeof(stdout_buf));
     setbuf(stderr, NULL);
     alarm(120);
 }
 
+// Whether a whole line is already buffered, read_line won't block for it then
+int line_buffered() {
+    return memchr(stdin_buf + stdin_pos, '\n', stdin_end - stdin_pos) != NULL;
+}
+
+// fgets on stdin, with pending output flushed first unless the next line is
+// already there. Commands the client pipelined are answered with a single
+// write for all of them.
+char *read_line(char *buf, int size) {
+    if (!line_buffered()) fflush(stdout);
+
+    int len = 0;
+    while (len < size - 1) {
+        if (stdin_pos == stdin_end) {
+            ssize_t got = read(STDIN_FILENO, stdin_buf, sizeof(stdin_buf));
+            if (got < 0 && errno == EINTR) continue;
+            if (got <= 0) break;
+            stdin_pos = 0;
+            stdin_end = got;
+        }
+        char c = stdin_buf[stdin_pos++];
+        buf[len++] = c;
+        if (c == '\n') break;
+    }
+    if (len == 0) return NULL;
+    buf[len] = 0;
+    return buf;
+}
+
+// perror behind everything printed so far, stderr is the same socket
+void report_error(const char *msg) {
+    int saved_errno = errno;
+    fflush(stdout);
+    errno = saved_errno;
+    perror(msg);
+}
+
 long getlong() {
     char buf[40];
     char *endp = 0;
-    fgets(buf, sizeof(buf), stdin);
+    if (!read_line(buf, sizeof(buf))) {
+        return -1;
+    }
     long retval = strtol(buf, &endp, 0);
     if (!retval) {
         if (endp == buf) retval = -1;
@@ -52,6 +113,31 @@ void sanitize_string(char * input) {
     }
 }
 
+// FNV-1a, service/tools/migrate.c and the checker's fake_service.py have to agree
+unsigned int user_hash(const char *username) {
+    unsigned int hash = 2166136261u;
+    for (size_t offset = 0; username[offset] != 0; offset++) {
+        hash ^= (unsigned char) username[offset];
+        hash *= 16777619u;
+    }
+    return hash;
+}
+
+int user_path(char *buf, size_t size, const char *username, const char *filename) {
+    unsigned int hash = user_hash(username);
+    return snprintf(buf, size, STORAGE_DIR, hash >> 24, (hash >> 16) & 0xff, username, filename);
+}
+
+void create_shard(const char *username) {
+    // Whoever comes first creates the shard, everyone else gets EEXIST
+    unsigned int hash = user_hash(username);
+    char shard_buf[sizeof(STORAGE_ROOT "ab/cd")];
+    snprintf(shard_buf, sizeof(shard_buf), STORAGE_ROOT "%02x", hash >> 24);
+    mkdir(shard_buf, 0775);
+    snprintf(shard_buf, sizeof(shard_buf), STORAGE_ROOT "%02x/%02x", hash >> 24, (hash >> 16) & 0xff);
+    mkdir(shard_buf, 0775);
+}
+
 struct User {
     char username[40];
     char *notes[NOTE_COUNT];
@@ -82,14 +168,14 @@ struct User* user_register() {
         "Username:\n> "
     );
     char username[40];
-    if (!fgets(username, 40, stdin)) {
-        perror("Failed to read username");
+    if (!read_line(username, 40)) {
+        report_error("Failed to read username");
         exit(EXIT_FAILURE);
     }
     sanitize_string(username);
 
-    char path_buf[sizeof(username) + sizeof(STORAGE_DIR) + 0x20];
-    snprintf(path_buf, sizeof(path_buf), STORAGE_DIR, username, "passwd");
+    char path_buf[sizeof(username) + STORAGE_DIR_SIZE + 0x20];
+    user_path(path_buf, sizeof(path_buf), username, "passwd");
     int access_result = access(path_buf, F_OK);
     
     if ( access_result != -1 ) {
@@ -101,29 +187,38 @@ struct User* user_register() {
         "Password:\n> "
     );
     char password[40];
-    fgets(password, 40, stdin);
+    read_line(password, 40);
     
-    snprintf(path_buf, sizeof(path_buf), STORAGE_DIR, username, "");
+    create_shard(username);
+    user_path(path_buf, sizeof(path_buf), username, "");
     long res = mkdir(path_buf, 0775);
     if (res) {
-        perror("Failed to create user directory!");
+        report_error("Failed to create user directory!");
         exit(EXIT_FAILURE);
     }
 
-    snprintf(path_buf, sizeof(path_buf), STORAGE_DIR, username, "passwd");
+    user_path(path_buf, sizeof(path_buf), username, "passwd");
     long fd = open(path_buf, O_WRONLY|O_CREAT, 0644);
     if (fd < 0) { 
-        perror("Failed to create passwd file!");
+        report_error("Failed to create passwd file!");
         exit(EXIT_FAILURE);
     }
 
     sanitize_string(password);
     if (0 > write(fd, password, strlen(password))) {
-        perror("Failed to write passwd file!");
+        report_error("Failed to write passwd file!");
         exit(EXIT_FAILURE);
     };
     close(fd);
 
+    // What readdir shows of a new directory, save_note appends from here on
+    user_path(path_buf, sizeof(path_buf), username, INDEX_FILE);
+    fd = open(path_buf, O_WRONLY|O_CREAT|O_EXCL, 0644);
+    if (fd >= 0) {
+        dprintf(fd, INDEX_LINE INDEX_LINE, ".", "..");
+        close(fd);
+    }
+
     puts("Registration successful!");
 
     // Successful login
@@ -138,14 +233,14 @@ struct User* user_login() {
         "Username:\n> "
     );
     char username[40];
-    if (!fgets(username, 40, stdin)) {
-        perror("Failed to read username");
+    if (!read_line(username, 40)) {
+        report_error("Failed to read username");
         exit(EXIT_FAILURE);
     }
     sanitize_string(username);
 
-    char path_buf[sizeof(username) + sizeof(STORAGE_DIR) + 0x20];
-    snprintf(path_buf, sizeof(path_buf), STORAGE_DIR, username, "passwd");
+    char path_buf[sizeof(username) + STORAGE_DIR_SIZE + 0x20];
+    user_path(path_buf, sizeof(path_buf), username, "passwd");
     int access_result = access(path_buf, F_OK | R_OK);
     
     if ( access_result < 0 ) {
@@ -161,7 +256,7 @@ struct User* user_login() {
     
     int bytes_read = read(password_fd, password_buf, sizeof(password_buf) -1 );
     if (bytes_read < 0) {
-        perror("Failed to read passwd file!");
+        report_error("Failed to read passwd file!");
         exit(EXIT_FAILURE);
     }
 
@@ -172,7 +267,7 @@ struct User* user_login() {
         "Password:\n> "
     );
     char user_password[40];
-    fgets(user_password, 40, stdin);
+    read_line(user_password, 40);
         
     sanitize_string(user_password);
     if (strcmp(password_buf, user_password)) {
@@ -228,7 +323,7 @@ void create_note(struct User* user) {
 
     user->notes[idx] = malloc(NOTE_SIZE);
     printf("Note [%ld]\n> ", idx);
-    long result = fgets(user->notes[idx], NOTE_SIZE, stdin);
+    long result = read_line(user->notes[idx], NOTE_SIZE);
     int len = strlen(user->notes[idx]);
     if (user->notes[idx][len-1] == '\n') user->notes[idx][len-1] = 0;
 
@@ -238,38 +333,82 @@ void create_note(struct User* user) {
     puts("Note Created!");
 }
 
-void list_saved_notes(struct User* user) {
-
-    printf("\n\n===== [%s's Notes] =====\n", user->username);
-
-    char table_header = 0;
-    for (int note_idx = 0; note_idx < NOTE_COUNT; note_idx++) {
-        if (user->notes[note_idx]) {
-            if (!table_header) {
-                printf("Currently Loaded:\n");
-                table_header = 1;
-            }
-            printf("    %d | %s\n", note_idx, user->notes[note_idx]);
-        }
+// Locks the user directory against other sessions of the user, until the
+// returned fd is closed. Saves hold it from creating their files until
+// they are in the index, a rebuild from its readdir until the rename, so
+// no save can fall in between and go missing from the rebuilt index. It is
+// never held while waiting for input.
+int lock_user_dir(struct User* user) {
+    char path_buf[sizeof(user->username) + STORAGE_DIR_SIZE + 0x20];
+    user_path(path_buf, sizeof(path_buf), user->username, "");
+    int fd = open(path_buf, O_RDONLY|O_DIRECTORY);
+    if (fd < 0 || flock(fd, LOCK_EX) < 0) {
+        report_error("Failed to lock user directory");
+        exit(EXIT_FAILURE);
     }
+    return fd;
+}
 
+// Prints the saved notes from the index at path, -1 if there is none. An
+// index fits into the buffer unless hundreds of notes were saved, so this
+// is a single read. An empty index can't be right, it always lists "." and
+// "..", so it counts as none.
+int print_index(const char *path) {
+    int fd = open(path, O_RDONLY);
+    if (fd < 0) {
+        return -1;
+    }
 
-    // Dunno impl shell injection here?
+    char buf[0x1000];
+    int total = 0;
+    long bytes_read;
+    do {
+        bytes_read = read(fd, buf, sizeof(buf));
+        if (bytes_read < 0) {
+            report_error("Failed to read index");
+            exit(EXIT_FAILURE);
+        }
+        if (!total && !bytes_read) {
+            close(fd);
+            return -1;
+        }
+        if (!total) {
+            printf("Saved Notes:\n");
+        }
+        fwrite(buf, 1, bytes_read, stdout);
+        total += bytes_read;
+    } while (bytes_read == sizeof(buf));
+    close(fd);
+    return total;
+}
 
-    char path_buf[sizeof(user->username) + sizeof(STORAGE_DIR) + 0x20];
-    snprintf(path_buf, sizeof(path_buf), STORAGE_DIR, user->username, "");
+// Lists the user directory like before there was an index and writes what
+// it printed to a new index at path. The index is written to a temporary
+// file first, so other sessions of the user never read half of it.
+void rebuild_index(struct User* user, const char *path) {
+    int lock_fd = lock_user_dir(user);
+    char path_buf[sizeof(user->username) + STORAGE_DIR_SIZE + 0x20];
+    user_path(path_buf, sizeof(path_buf), user->username, "");
     DIR* dirfd = opendir(path_buf);
     if (dirfd <= 0) {
-        perror("Failed to open user directory");
+        report_error("Failed to open user directory");
         exit(EXIT_FAILURE);
     }
 
-    table_header = 0;
+    char tmp_path[sizeof(path_buf) + 0x10];
+    snprintf(tmp_path, sizeof(tmp_path), "%s.%d", path, getpid());
+    // Without an index the listing still works, it's just rebuilt next time
+    int index_fd = open(tmp_path, O_WRONLY|O_CREAT|O_TRUNC, 0644);
+
+    char table_header = 0;
     struct dirent* entry;
     while ((entry = readdir(dirfd)) != NULL) {
         if (strcmp(entry->d_name, "passwd") == 0) {
             continue;
         }
+        if (strncmp(entry->d_name, INDEX_FILE, strlen(INDEX_FILE)) == 0) {
+            continue;
+        }
 
         if (!table_header) {
             printf("Saved Notes:\n");
@@ -277,11 +416,64 @@ void list_saved_notes(struct User* user) {
         }
 
         // Sendfile trolololo?...
-        printf(" | %s\n", entry->d_name);
+        printf(INDEX_LINE, entry->d_name);
+        if (index_fd >= 0) {
+            dprintf(index_fd, INDEX_LINE, entry->d_name);
+        }
+    }
+    closedir(dirfd);
+
+    if (index_fd >= 0) {
+        close(index_fd);
+        if (rename(tmp_path, path) < 0) {
+            unlink(tmp_path);
+        }
+    }
+    close(lock_fd);
+}
+
+// Appends lines for saved notes to the index, under the lock the notes were
+// saved with. A missing index is left alone, the next listing rebuilds it
+// from the directory, which has them.
+void index_append(struct User* user, const char *lines, size_t len) {
+    char path_buf[sizeof(user->username) + STORAGE_DIR_SIZE + 0x20];
+    user_path(path_buf, sizeof(path_buf), user->username, INDEX_FILE);
+    int fd = open(path_buf, O_WRONLY|O_APPEND);
+    if (fd < 0) {
+        return;
+    }
+    if (0 > write(fd, lines, len)) {
+        report_error("Failed to write index!");
+        exit(EXIT_FAILURE);
+    }
+    close(fd);
+}
+
+void list_saved_notes(struct User* user) {
+
+    printf("\n\n===== [%s's Notes] =====\n", user->username);
+
+    char table_header = 0;
+    for (int note_idx = 0; note_idx < NOTE_COUNT; note_idx++) {
+        if (user->notes[note_idx]) {
+            if (!table_header) {
+                printf("Currently Loaded:\n");
+                table_header = 1;
+            }
+            printf("    %d | %s\n", note_idx, user->notes[note_idx]);
+        }
+    }
+
+
+    // Dunno impl shell injection here?
+
+    char path_buf[sizeof(user->username) + STORAGE_DIR_SIZE + 0x20];
+    user_path(path_buf, sizeof(path_buf), user->username, INDEX_FILE);
+    if (print_index(path_buf) < 0) {
+        rebuild_index(user, path_buf);
     }
 
     puts("===== [End of Notes] =====");
-    closedir(dirfd);
 }
 
 void delete_note(struct User* user) {
@@ -301,16 +493,54 @@ void delete_note(struct User* user) {
     }
 }
 
+// Reads the file at path into slot idx, which is allocated first if it is
+// empty. Returns the number of bytes read, -1 if the file can't be opened.
+int read_note_file(struct User* user, const char *path, long idx) {
+    if (user->notes[idx] == 0) {
+        user->notes[idx] = calloc(1, NOTE_SIZE);
+    }
+
+    int filefd = open(path, O_RDONLY);
+    if (filefd < 0) {
+        return -1;
+    }
+
+    int bytes_read = read(filefd, user->notes[idx], NOTE_SIZE);  
+    if (bytes_read < 0) {
+        report_error("Note read failed");
+        exit(EXIT_FAILURE);
+    }  
+    close(filefd);
+
+    user->notes[idx][bytes_read] = 0;
+    return bytes_read;
+}
+
+// Writes slot idx to a new file at path, -1 if it can't be created
+int write_note_file(struct User* user, const char *path, long idx) {
+    long filefd = open(path, O_WRONLY | O_CREAT | O_EXCL, 0644);
+    if (filefd < 0) {
+        return -1;
+    }
+
+    if (0 > write(filefd, user->notes[idx], strlen(user->notes[idx]))) {
+        report_error("Failed to write note!");
+        exit(EXIT_FAILURE);
+    }
+    close(filefd);
+    return 0;
+}
+
 void load_note(struct User* user) {
     printf(
         "Which note to load?" NL
         "Filename > "
     );
     
-    char path_buf[sizeof(STORAGE_DIR) + sizeof(user->username) + 0x20];
-    int bytes_written = snprintf(path_buf, sizeof(path_buf), STORAGE_DIR, user->username, "");
-    if (!fgets(path_buf + bytes_written, sizeof(path_buf) - bytes_written, stdin)) {
-        perror("Failed to get filename!");
+    char path_buf[STORAGE_DIR_SIZE + sizeof(user->username) + 0x20];
+    int bytes_written = user_path(path_buf, sizeof(path_buf), user->username, "");
+    if (!read_line(path_buf + bytes_written, sizeof(path_buf) - bytes_written)) {
+        report_error("Failed to get filename!");
         return;
     }
 
@@ -327,24 +557,10 @@ void load_note(struct User* user) {
         return;
     } 
 
-    if (user->notes[idx] == 0) {
-        user->notes[idx] = calloc(1, NOTE_SIZE);
-    }
-
-    int filefd = open(path_buf, O_RDONLY);
-    if (filefd < 0) {
+    if (read_note_file(user, path_buf, idx) < 0) {
         printf("Failed to open %s" NL, path_buf);
         return;
     }
-
-    int bytes_read = read(filefd, user->notes[idx], NOTE_SIZE);  
-    if (bytes_read < 0) {
-        perror("Note read failed");
-        exit(EXIT_FAILURE);
-    }  
-    close(filefd);
-
-    user->notes[idx][bytes_read] = 0;
     printf("Note %s was loaded into Slot %ld." NL, path_buf, idx);
 }
 
@@ -370,27 +586,119 @@ void save_note(struct User* user) {
         "Filename > "
     );
 
-    char path_buf[sizeof(STORAGE_DIR) + sizeof(user->username) + 0x20];
-    int bytes_written = snprintf(path_buf, sizeof(path_buf), STORAGE_DIR, user->username, "");
-    if (!fgets(path_buf + bytes_written, sizeof(path_buf) - bytes_written, stdin)) {
-        perror("Failed to get filename!");
+    char path_buf[STORAGE_DIR_SIZE + sizeof(user->username) + 0x20];
+    int bytes_written = user_path(path_buf, sizeof(path_buf), user->username, "");
+    if (!read_line(path_buf + bytes_written, sizeof(path_buf) - bytes_written)) {
+        report_error("Failed to get filename!");
     }
     sanitize_string(path_buf + bytes_written);
     
     // TODO: Sanitize path
-    long filefd = open(path_buf, O_WRONLY | O_CREAT | O_EXCL, 0644);
-    if (filefd < 0) {
-        perror("Failed to open file!");
+    int lock_fd = lock_user_dir(user);
+    if (write_note_file(user, path_buf, idx) < 0) {
+        report_error("Failed to open file!");
         exit(EXIT_FAILURE);
     }
+    char index_line[sizeof(path_buf) + 0x10];
+    index_append(user, index_line, snprintf(index_line, sizeof(index_line), INDEX_LINE, path_buf + bytes_written));
+    close(lock_fd);
 
-    if (0 > write(filefd, user->notes[idx], strlen(user->notes[idx]))) {
-        perror("Failed to write note!");
-        exit(EXIT_FAILURE);
+    puts("Note saved!");
+}
+
+// The bulk commands below take every entry up front, one "<idx> <filename>"
+// line each without a prompt in between, and answer with one result line per
+// entry and a summary, all in the same write. They are not in the menu, the
+// menu text stays as it always was.
+#define BULK_LINE_SIZE (0x20 + STORAGE_DIR_SIZE + sizeof(((struct User*) 0)->username) + 0x20)
+
+// Reads one "<idx> <filename>" line, the filename is appended to path_buf
+// behind the user directory, with the same room as in load_note/save_note
+long read_bulk_entry(struct User* user, char *path_buf, size_t size) {
+    char line[BULK_LINE_SIZE];
+    if (!read_line(line, sizeof(line))) {
+        exit(EXIT_SUCCESS);
     }
 
-    puts("Note saved!");
-    close(filefd);
+    char *endp = line;
+    long idx = strtol(line, &endp, 0);
+    if (endp == line) idx = -1;
+    if (*endp == ' ') endp++;
+    sanitize_string(endp);
+
+    int bytes_written = user_path(path_buf, size, user->username, "");
+    snprintf(path_buf + bytes_written, size - bytes_written, "%s", endp);
+    return idx;
+}
+
+long read_bulk_count(const char *prompt) {
+    printf("%s" NL "> ", prompt);
+    long count = getlong();
+    if (count < 1 || count > NOTE_COUNT) {
+        puts("Invalid count!");
+        return 0;
+    }
+    return count;
+}
+
+void save_notes(struct User* user) {
+    long count = read_bulk_count("How many notes to save?");
+    if (!count) return;
+
+    // Every entry is read before the user directory is locked
+    char paths[NOTE_COUNT][STORAGE_DIR_SIZE + sizeof(user->username) + 0x20];
+    long idxs[NOTE_COUNT];
+    for (long entry = 0; entry < count; entry++) {
+        idxs[entry] = read_bulk_entry(user, paths[entry], sizeof(paths[entry]));
+    }
+
+    int saved = 0;
+    // One append to the index for all of them
+    char index_lines[NOTE_COUNT * BULK_LINE_SIZE];
+    size_t index_len = 0;
+    int lock_fd = lock_user_dir(user);
+    for (long entry = 0; entry < count; entry++) {
+        char *path_buf = paths[entry];
+        long idx = idxs[entry];
+        if (!VALID_NOTE_IDX(idx)) {
+            printf("Invalid Idx!" NL);
+        } else if (!user->notes[idx]) {
+            printf("Note %ld does not exist!" NL, idx);
+        } else if (write_note_file(user, path_buf, idx) < 0) {
+            printf("Failed to save %s" NL, path_buf);
+        } else {
+            printf("Note %ld saved!" NL, idx);
+            index_len += snprintf(index_lines + index_len, sizeof(index_lines) - index_len, INDEX_LINE, strrchr(path_buf, '/') + 1);
+            saved++;
+        }
+    }
+    if (index_len) {
+        index_append(user, index_lines, index_len);
+    }
+    close(lock_fd);
+
+    printf("Saved %d of %ld notes!" NL, saved, count);
+}
+
+void load_notes(struct User* user) {
+    long count = read_bulk_count("How many notes to load?");
+    if (!count) return;
+
+    int loaded = 0;
+    for (long entry = 0; entry < count; entry++) {
+        char path_buf[STORAGE_DIR_SIZE + sizeof(user->username) + 0x20];
+        long idx = read_bulk_entry(user, path_buf, sizeof(path_buf));
+        if (!VALID_NOTE_IDX(idx)) {
+            printf("Invalid Idx!" NL);
+        } else if (read_note_file(user, path_buf, idx) < 0) {
+            printf("Failed to open %s" NL, path_buf);
+        } else {
+            printf("Note %s was loaded into Slot %ld." NL, path_buf, idx);
+            loaded++;
+        }
+    }
+
+    printf("Loaded %d of %ld notes!" NL, loaded, count);
 }
 
 int main(int argc, const char * argv[]) {
@@ -458,6 +766,12 @@ int main(int argc, const char * argv[]) {
         case 6:
             save_note(current_user);
             break;
+        case 7:
+            save_notes(current_user);
+            break;
+        case 8:
+            load_notes(current_user);
+            break;
         case -1:
             return 0;
         default: